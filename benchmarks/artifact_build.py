@@ -0,0 +1,175 @@
+#
+# Build time and size of the lambda function zip, and what shipping compiled
+# modules saves on a cold start. Checks that copies of the modules with
+# other modification times zip to the same bytes, and that a second build of
+# unchanged modules is read from the cache. The compiled modules are for the
+# Python running this, which the cold start is measured on too. Then compares
+# the peak memory of zipping a large package in memory with streaming it to
+# a file. Run from the repository root:
+#     python -m benchmarks.artifact_build
+#
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from zipfile import ZipFile
+
+# setup.py and the service modules log to rps.log unless logging is set up,
+# and create boto3 clients on import, which need a region
+logging.getLogger().addHandler(logging.NullHandler())
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import setup
+import util
+
+BUILDS = 5
+IMPORTS = 5
+# incompressible files standing in for vendored dependencies
+VENDORED_FILES = 16
+VENDORED_FILE_BYTES = 4 * 1024 * 1024
+# imports the handler without writing compiled modules, like on Lambda
+# where the code directory is read-only, and prints how long it took. boto3
+# is imported first, it is not part of the zip and takes most of the time.
+IMPORT_SCRIPT = (
+    "import time, boto3, boto3.dynamodb.conditions; start = time.perf_counter(); "
+    "import lambda_function_handler; print(time.perf_counter() - start)"
+)
+
+
+def copied_modules(directory: str, mtime: float) -> list:
+    # a copy of the lambda modules with every file modified at mtime
+    files = util.module_files(setup.LAMBDA_MODULES, setup.LAMBDA_MODULE_PATH)
+    for archive_name, file_path in files:
+        copy = os.path.join(directory, archive_name)
+        os.makedirs(os.path.dirname(copy), exist_ok=True)
+        shutil.copy(file_path, copy)
+        os.utime(copy, (mtime, mtime))
+    return util.module_files(setup.LAMBDA_MODULES, [directory])
+
+
+def vendored_package(directory: str) -> list:
+    package = os.path.join(directory, "vendored")
+    os.makedirs(package)
+    for index in range(VENDORED_FILES):
+        with open(os.path.join(package, f"data_{index:02}.bin"), "wb") as file:
+            file.write(os.urandom(VENDORED_FILE_BYTES))
+    return util.module_files(["vendored"], [directory])
+
+
+def zipped(files: list, level: int, compile_pyc: bool) -> bytes:
+    with tempfile.TemporaryFile() as file:
+        util.zip_files(files, file, level, compile_pyc)
+        file.seek(0)
+        return file.read()
+
+
+def streamed_zip(files: list) -> int:
+    # builds the zip and maps it like an upload does, returns its size
+    with util.mapped_artifact(util.build_artifact(files)) as mapped:
+        return len(mapped)
+
+
+def peak_memory(build) -> int:
+    # most bytes allocated by Python at once while building
+    tracemalloc.start()
+    build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def unreproducible_zip(files: list) -> bytes:
+    # how the function used to be zipped: stored, with the files' own mtimes
+    bytes_buffer = io.BytesIO()
+    with ZipFile(bytes_buffer, "w") as zip:
+        for archive_name, file_path in files:
+            zip.write(file_path, archive_name)
+    return bytes_buffer.getvalue()
+
+
+def best_seconds(build, runs: int = BUILDS) -> tuple:
+    # fastest of several runs, and what the last one returned
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = build()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def import_seconds(zip_bytes: bytes, directory: str) -> float:
+    # fastest import of the handler from the extracted zip, in a new process
+    with ZipFile(io.BytesIO(zip_bytes)) as zip:
+        zip.extractall(directory)
+    best = float("inf")
+    for _ in range(IMPORTS):
+        output = subprocess.run(
+            [sys.executable, "-B", "-c", IMPORT_SCRIPT],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        best = min(best, float(output.split()[-1]))
+    return best
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    files = copied_modules(os.path.join(directory, "a"), 1_000_000_000)
+    other_files = copied_modules(os.path.join(directory, "b"), 1_700_000_000)
+    cache_dir = os.path.join(directory, "cache")
+
+    print("compression  pyc  build ms   cached ms      bytes")
+    seconds, zip_bytes = best_seconds(lambda: unreproducible_zip(files))
+    assert zip_bytes != unreproducible_zip(other_files)
+    print(
+        f"{'stored, old':<11}  {'no':>3}  {seconds * 1000:>8.1f}  {'-':>10}  "
+        f"{len(zip_bytes):>9,}"
+    )
+    zips = {}
+    for compile_pyc in [False, True]:
+        for level in [1, 6, 9]:
+            seconds, zip_bytes = best_seconds(lambda: zipped(files, level, compile_pyc))
+            # the same bytes from files with other mtimes
+            assert zip_bytes == zipped(other_files, level, compile_pyc)
+            for cached in [False, True]:
+                start = time.perf_counter()
+                artifact = util.build_artifact(files, cache_dir, level, compile_pyc)
+                cached_seconds = time.perf_counter() - start
+                with util.mapped_artifact(artifact) as mapped:
+                    assert mapped[:] == zip_bytes and artifact.cached == cached
+            zips[compile_pyc] = zip_bytes
+            print(
+                f"{level:>11}  {'yes' if compile_pyc else 'no':>3}  "
+                f"{seconds * 1000:>8.1f}  {cached_seconds * 1000:>10.2f}  "
+                f"{len(zip_bytes):>9,}"
+            )
+
+    # and a changed module is built again
+    with open(files[0][1], "a") as file:
+        file.write("# changed\n")
+    artifact = util.build_artifact(files, cache_dir, 9, True)
+    artifact.file.close()
+    assert not artifact.cached
+
+    source = import_seconds(zips[False], os.path.join(directory, "source"))
+    compiled = import_seconds(zips[True], os.path.join(directory, "compiled"))
+    print(f"\nhandler import from source:   {source * 1000:.1f}ms")
+    print(f"handler import with .pyc:     {compiled * 1000:.1f}ms")
+
+    files = vendored_package(directory)
+    in_memory = peak_memory(lambda: unreproducible_zip(files))
+    streamed = peak_memory(lambda: streamed_zip(files))
+    total = VENDORED_FILES * VENDORED_FILE_BYTES
+    print(f"\npeak memory zipping {total / 2**20:.0f}MB in {VENDORED_FILES} files:")
+    print(f"in memory:   {in_memory / 2**20:>6.1f}MB")
+    print(f"streamed:    {streamed / 2**20:>6.1f}MB")
+    # bounded by the largest file and its compressed copy, not the package
+    assert streamed < 4 * VENDORED_FILE_BYTES < total < in_memory
+    shutil.rmtree(directory)
@@ -0,0 +1,61 @@
+#
+# Cold start and client initialisation costs of the lambda handler.
+#
+# Imports the handler with real boto3 clients (creating a client does not
+# call AWS) and reports the import time and what each lazily created client
+# costs on first use and on reuse. Then shows which clients a "test" text
+# creates, and checks that its invocation reports creating them and the next
+# one does not. Run from the repository root, in a fresh process each time:
+#     python -m benchmarks.cold_start
+#
+import logging
+import time
+
+from benchmarks.emf_metrics import CapturedDocuments
+from benchmarks.local_aws import LocalPinpointClient, load_handler, sms_event
+
+
+def first_and_second_use(getter) -> tuple:
+    start = time.perf_counter()
+    getter()
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    getter()
+    return first, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    # other log output is dropped, the invocation documents are checked
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    handler = load_handler(stand_ins=False)
+    print(f"handler import: {handler.IMPORT_SECONDS * 1000:.1f}ms\n")
+    print("client                 first use ms  reuse ms")
+    for name, getter in [
+        ("pinpoint", handler.get_pinpoint_client),
+        ("game state table", handler.get_game_state_table),
+        ("lock table", lambda: handler.get_lock_table(handler.config.lock_table_name)),
+    ]:
+        first, second = first_and_second_use(getter)
+        print(f"{name:<21}  {first * 1000:>12.1f}  {second * 1000:>8.3f}")
+
+    # a "test" text only needs pinpoint; nothing touches DynamoDB. SNS gives
+    # every delivery a MessageId, but only throws are claimed on theirs.
+    handler = load_handler(stand_ins=False)
+    handler.get_pinpoint_client = lambda: handler.clients.get(
+        "pinpoint", LocalPinpointClient
+    )
+    captured = CapturedDocuments()
+    handler.metrics_logger.handlers = [captured]
+    event = sms_event("test", "+18001234567")
+    event["Records"][0]["Sns"]["MessageId"] = "cold-start-test"
+    handler.lambda_handler(event, {})
+    clients = sorted(handler.clients.instances)
+    print(f"\nclients created by a 'test' text: {clients}")
+    assert clients == ["pinpoint"]
+    # reported in the invocation's document, and as a LatencyMs metric
+    document, *operations = captured.invocations[-1]
+    assert list(document["client_init_ms"]) == ["pinpoint"]
+    assert "client.pinpoint" in [d["Operation"] for d in operations]
+    handler.lambda_handler(event, {})
+    assert captured.invocations[-1][0]["client_init_ms"] is None
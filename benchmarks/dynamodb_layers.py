@@ -0,0 +1,113 @@
+#
+# Micro-benchmark of the two DynamoDB data-access layers: the boto3 resource
+# Table and ClientTable on top of the low-level client.
+#
+# Real boto3 clients are used with botocore's Stubber in front of them, so the
+# numbers include request building, parameter validation and (de)serialisation
+# but no network. Cold start cost is measured in fresh interpreters.
+# Run from the repository root:
+#     python -m benchmarks.dynamodb_layers
+#
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from botocore.stub import Stubber
+
+from benchmarks.local_aws import load_handler
+
+ITERATIONS = 2000
+COLD_START_RUNS = 5
+
+COLD_START_CODE = {
+    "resource": "import boto3; boto3.resource('dynamodb').Table('game_state')",
+    "client": "import boto3; boto3.client('dynamodb')",
+}
+
+
+def stubbed_handler(layer: str):
+    handler = load_handler(stand_ins=False, DYNAMODB_LAYER=layer)
+    table = handler.get_game_state_table()
+    client = table.meta.client if layer == "resource" else table.client
+    # both tables share the client, so one stubber covers game state and locks
+    handler.get_lock_table(handler.config.lock_table_name)
+    return handler, client
+
+
+def one_throw(handler) -> None:
+    # the DynamoDB calls of a locked throw that stores a waiting opponent
+    token = handler.acquire_lock("throw_lock", "self-id")
+    handler.get_item({"state": "opponent"})
+    handler.fenced_put_item(
+        {"state": "opponent", "throw": "rock", "phone_number": "+18001234567"}, token
+    )
+    handler.release_lock("throw_lock", "self-id")
+
+
+def queue_responses(stubber: Stubber) -> None:
+    stubber.add_response("update_item", {"Attributes": {"fencing_token": {"N": "7"}}})
+    stubber.add_response(
+        "get_item",
+        {
+            "Item": {
+                "state": {"S": "opponent"},
+                "fencing_token": {"N": "6"},
+            }
+        },
+    )
+    stubber.add_response("put_item", {})
+    stubber.add_response("update_item", {})
+
+
+def captured_requests(layer: str) -> list:
+    # the request bodies each layer sends for one throw
+    handler, client = stubbed_handler(layer)
+    bodies = []
+    client.meta.events.register(
+        "before-call.dynamodb.*",
+        lambda params, **kwargs: bodies.append(json.loads(params["body"])),
+    )
+    with Stubber(client) as stubber:
+        queue_responses(stubber)
+        one_throw(handler)
+    return bodies
+
+
+def cpu_per_throw(layer: str) -> float:
+    handler, client = stubbed_handler(layer)
+    with Stubber(client) as stubber:
+        for _ in range(ITERATIONS):
+            queue_responses(stubber)
+        start = time.process_time()
+        for _ in range(ITERATIONS):
+            one_throw(handler)
+        return (time.process_time() - start) / ITERATIONS
+
+
+def cold_start(layer: str) -> float:
+    code = (
+        "import time; start = time.perf_counter(); "
+        + COLD_START_CODE[layer]
+        + "; print(time.perf_counter() - start)"
+    )
+    env = dict(os.environ, AWS_DEFAULT_REGION="us-east-1")
+    runs = [
+        float(subprocess.check_output([sys.executable, "-c", code], env=env))
+        for _ in range(COLD_START_RUNS)
+    ]
+    return min(runs)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    same = captured_requests("resource") == captured_requests("client")
+    print(f"both layers send identical requests: {same}\n")
+    print("layer     cpu per throw ms  cold start ms")
+    for layer in ["resource", "client"]:
+        print(
+            f"{layer:<8}  {cpu_per_throw(layer) * 1000:>16.3f}  "
+            f"{cold_start(layer) * 1000:>13.1f}"
+        )
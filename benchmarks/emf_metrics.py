@@ -0,0 +1,163 @@
+#
+# Checks the CloudWatch Embedded Metric Format documents the lambda handler
+# writes at the end of every invocation, against the in-memory stand-ins for
+# each game state store: lock attempts, wait and hold times, games completed,
+# failed lock releases, failed texts by delivery status, redeliveries and the
+# latency of each timed operation.
+# Also checks that a debug sampled invocation leaves the AWS libraries'
+# loggers out of DEBUG. Run from the repository root:
+#     python -m benchmarks.emf_metrics
+#
+import json
+import logging
+
+from benchmarks.local_aws import LocalPinpointClient, load_handler, sms_event
+from benchmarks.simulator import generate_events, run_simulation
+
+FAILING_NUMBER = "+18009999999"
+
+
+class CapturedDocuments(logging.Handler):
+    # collects the EMF documents of every invocation, one list per invocation
+    def __init__(self):
+        super().__init__()
+        self.invocations = []
+
+    def emit(self, record):
+        lines = record.getMessage().split("\n")
+        self.invocations.append([json.loads(line) for line in lines])
+
+
+def metrics_handler(store: str, **params):
+    handler = load_handler(GAME_STATE_STORE=store, LOG_DEBUG_SAMPLE_RATE=0, **params)
+    captured = CapturedDocuments()
+    handler.metrics_logger.handlers = [captured]
+    return handler, captured
+
+
+def invoke(handler, captured, event) -> list:
+    # the invocation's documents, but for those of its operation latencies
+    handler.lambda_handler(event, {})
+    return [d for d in captured.invocations[-1] if "Operation" not in d]
+
+
+def latencies(handler, documents: list) -> dict:
+    # operation -> the durations of its calls in the invocation's documents
+    latencies = {}
+    for document in documents:
+        if "Operation" in document:
+            dimensions = {"Mode": document["Mode"], "Operation": document["Operation"]}
+            check_document(handler, document, dimensions)
+            latencies[document["Operation"]] = document["LatencyMs"]
+    return latencies
+
+
+def check_document(handler, document: dict, dimensions: dict) -> None:
+    # the metadata declares exactly the metrics the document has values for
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == handler.config.metrics_namespace
+    assert directive["Dimensions"] == [list(dimensions)]
+    for name, value in dimensions.items():
+        assert document[name] == value
+    for metric in directive["Metrics"]:
+        assert metric["Unit"] == handler.METRIC_UNITS[metric["Name"]]
+        assert metric["Name"] in document
+
+
+def check_store(store: str) -> None:
+    handler, captured = metrics_handler(store)
+
+    # a throw waits for an opponent under the lock, the next one finishes it
+    first = invoke(handler, captured, sms_event("rock", "+18001111111"))
+    second = invoke(handler, captured, sms_event("paper", "+18002222222"))
+    for documents, games in [(first, 0), (second, 1)]:
+        assert len(documents) == 1
+        document = documents[0]
+        check_document(handler, document, {"Mode": "locking"})
+        assert document["GamesCompleted"] == games
+        assert document["LockAttempts"] == [1]
+        assert len(document["LockWaitMs"]) == 1
+        assert len(document["LockHoldMs"]) == 1
+        assert "LockReleaseFailures" not in document
+        assert document["records"] == 1 and document["failed_records"] == 0
+    # with the duration of every lock and game state call
+    calls = latencies(handler, captured.invocations[-1])
+    assert len(calls["lock.acquire"]) == 1 and len(calls["lock.release"]) == 1
+
+    # two throws in one batch are paired in memory, without the lock
+    event = sms_event("rock", "+18001111111")
+    event["Records"] += sms_event("scissors", "+18002222222")["Records"]
+    [document] = invoke(handler, captured, event)
+    assert document["GamesCompleted"] == 1
+    assert "LockAttempts" not in document
+
+    # a text that is not delivered is counted under its delivery status
+    handler.clients.instances["pinpoint"] = LocalPinpointClient(
+        failures={FAILING_NUMBER: "PERMANENT_FAILURE"}
+    )
+    event = sms_event("test", FAILING_NUMBER)
+    event["Records"] += sms_event("test", "+18001111111")["Records"]
+    document, failures = invoke(handler, captured, event)
+    assert "SmsSendFailures" not in document
+    check_document(
+        handler, failures, {"Mode": "locking", "DeliveryStatus": "PERMANENT_FAILURE"}
+    )
+    assert failures["SmsSendFailures"] == 1
+
+    # a lock that cannot be released fails the record and is counted
+    store_release_lock = handler.get_game_state_store().release_lock
+    handler.get_game_state_store().release_lock = lambda *args: False
+    [document] = invoke(handler, captured, sms_event("rock", "+18003333333"))
+    assert document["LockReleaseFailures"] == 1
+    assert document["failed_records"] == 1
+    handler.get_game_state_store().release_lock = store_release_lock
+
+    # a redelivered text is counted and skipped before any lock is taken
+    event = sms_event("rock", "+18004444444")
+    event["Records"][0]["Sns"]["MessageId"] = "redelivered"
+    invoke(handler, captured, event)
+    [document] = invoke(handler, captured, event)
+    assert document["DuplicateMessages"] == 1
+    assert "LockAttempts" not in document
+
+    # under concurrency every game and every lock attempt is reported once
+    handler, captured = metrics_handler(store, GAME_STATE_CACHE_TTL_SECONDS=0)
+    events = generate_events(handler.THROWS, 20, 300, seed=1)
+    run_simulation(handler, events, concurrency=8)
+    documents = [invocation[0] for invocation in captured.invocations]
+    calls = [latencies(handler, invocation) for invocation in captured.invocations]
+    assert len(documents) == len(events)
+    games = sum(document["GamesCompleted"] for document in documents)
+    # every throw either waited for an opponent, finished that opponent's game
+    # or was rejected because the player's own throw was waiting
+    waiting = sum(
+        1
+        for _, body in handler.pinpoint_client.sent
+        if "Waiting" in body or "already have" in body
+    )
+    assert games + waiting == len(events)
+    attempts = sum(sum(document.get("LockAttempts", [])) for document in documents)
+    acquires = sum(len(latency.get("lock.acquire", [])) for latency in calls)
+    assert attempts == acquires
+    print(f"{store:<9} ok  {games:.0f} games, {attempts} lock attempts")
+
+
+def check_debug_sampling() -> None:
+    handler = load_handler(LOG_DEBUG_SAMPLE_RATE=1)
+    captured = CapturedDocuments()
+    handler.metrics_logger.handlers = [captured]
+    [document] = invoke(handler, captured, sms_event("test", "+18001111111"))
+    assert document["debug_sampled"]
+    assert handler.logger.isEnabledFor(logging.DEBUG)
+    # their DEBUG output has request headers and credentials in it
+    for library in ["boto3", "botocore", "urllib3"]:
+        assert not logging.getLogger(library).isEnabledFor(logging.DEBUG)
+
+
+if __name__ == "__main__":
+    # only the metrics are checked, other log output is dropped
+    logging.getLogger().addHandler(logging.NullHandler())
+    for store in ["dynamodb", "memory", "redis"]:
+        check_store(store)
+    check_debug_sampling()
+    print("debug sampling leaves the AWS libraries at INFO: ok")
@@ -0,0 +1,212 @@
+#
+# Checks the replies to the "stats", "history" and "top" texts against the
+# local stand-ins, after games played in each matchmaking mode, and reports
+# the game history table calls each reply costs. Then checks that a game whose
+# transaction with its history conflicts under the lock is still finished
+# and recorded, that outside DynamoDB a game whose history write fails is still
+# finished, that a game whose leaderboard update fails is still finished
+# and recorded, that the
+# winner's next win puts the leaderboard right, and that "top" finds a leader
+# far below another, past the buckets left empty when their deletes fail.
+# Run from the repository root:
+#     python -m benchmarks.game_history
+#
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+from benchmarks.local_aws import load_handler, sms_event
+
+MODES = {
+    "locking": {},
+    "no-locking": {"LOCKING": False},
+    "queue": {"MATCHMAKING_QUEUE": True},
+}
+# (first throw, second throw) of the games between PLAYER and OPPONENT
+GAMES = [("rock", "scissors"), ("scissors", "paper"), ("paper", "paper")]
+PLAYER = "+18001111111"
+OPPONENT = "+18002222222"
+OTHER_PLAYER = "+18003333333"
+
+
+def reply(handler, text: str, number: str) -> tuple:
+    # the last text sent to number in reply to text, and the history calls
+    handler.history_table.calls.clear()
+    handler.lambda_handler(sms_event(text, number), {})
+    address, body = handler.pinpoint_client.sent[-1]
+    assert address == number
+    return body, sum(handler.history_table.calls.values())
+
+
+def check_mode(settings: dict) -> dict:
+    handler = load_handler(**settings)
+    for first, second in GAMES:
+        handler.lambda_handler(sms_event(first, PLAYER), {})
+        handler.lambda_handler(sms_event(second, OPPONENT), {})
+        # games are ordered by their millisecond, a player has one at a time
+        time.sleep(0.002)
+    assert handler.pinpoint_client.games_reported() == len(GAMES)
+
+    calls = {}
+    body, calls["stats"] = reply(handler, "stats", PLAYER)
+    assert body.endswith("2 wins, 0 losses, 1 ties in 3 games."), body
+    body, calls["history"] = reply(handler, "history", OPPONENT)
+    # newest first, from the opponent's side
+    assert body.endswith(
+        "Last games:\n"
+        "paper vs paper (...1111): tied\n"
+        "paper vs scissors (...1111): lost\n"
+        "scissors vs rock (...1111): lost"
+    ), body
+    body, calls["top"] = reply(handler, "top", OPPONENT)
+    assert body.endswith("Leaders:\n1. ...1111 2 wins"), body
+    body, _ = reply(handler, "history", OTHER_PLAYER)
+    assert body.endswith("No games played yet."), body
+    return calls
+
+
+def play(handler, first: str, second: str, number: str = PLAYER) -> list:
+    # a game of number against OPPONENT, and the failed records of its throws
+    failures = []
+    for throw, number in [(first, number), (second, OPPONENT)]:
+        response = handler.lambda_handler(sms_event(throw, number), {})
+        failures += response["batchItemFailures"]
+    return failures
+
+
+def check_stats_conflict() -> None:
+    handler = load_handler()
+    transact_write_items = handler.dynamodb.transact_write_items
+    conflicts = []
+
+    def conflicting_transaction(TransactItems):
+        # the game's first transaction conflicts on the last player's stats
+        if not conflicts:
+            conflicts.append(TransactItems)
+            reasons = [{"Code": "None"}] * len(TransactItems)
+            reasons[-1] = {"Code": "TransactionConflict"}
+            raise ClientError(
+                {
+                    "Error": {"Code": "TransactionCanceledException", "Message": ""},
+                    "CancellationReasons": reasons,
+                },
+                "TransactWriteItems",
+            )
+        return transact_write_items(TransactItems=TransactItems)
+
+    handler.lambda_handler(sms_event("rock", PLAYER), {})
+    handler.dynamodb.transact_write_items = conflicting_transaction
+    response = handler.lambda_handler(sms_event("paper", OPPONENT), {})
+    assert not response["batchItemFailures"]
+    assert conflicts and handler.pinpoint_client.games_reported() == 1
+    body, _ = reply(handler, "stats", PLAYER)
+    assert body.endswith("0 wins, 1 losses, 0 ties in 1 games."), body
+
+
+def check_history_failure(store: str) -> None:
+    # outside DynamoDB the game is recorded after the slot write, and a game
+    # that could not be recorded is still over rather than failed
+    handler = load_handler(GAME_STATE_STORE=store)
+    transact_write_items = handler.transact_write_items
+
+    def cancelled_write(*args):
+        raise ClientError(
+            {"Error": {"Code": "TransactionCanceledException", "Message": ""}},
+            "TransactWriteItems",
+        )
+
+    handler.lambda_handler(sms_event("rock", PLAYER), {})
+    handler.transact_write_items = cancelled_write
+    response = handler.lambda_handler(sms_event("paper", OPPONENT), {})
+    handler.transact_write_items = transact_write_items
+    assert not response["batchItemFailures"]
+    assert handler.pinpoint_client.games_reported() == 1
+    body, _ = reply(handler, "stats", PLAYER)
+    assert body.endswith("No games played yet."), body
+
+
+def check_leaderboard_conflict() -> None:
+    handler = load_handler()
+    update_item = handler.history_table.update_item
+
+    def conflicting_update(Key, **kwargs):
+        if Key["phone_number"] == handler.LEADERBOARD_PARTITION:
+            raise ClientError(
+                {"Error": {"Code": "TransactionConflictException", "Message": ""}},
+                "UpdateItem",
+            )
+        return update_item(Key=Key, **kwargs)
+
+    handler.history_table.update_item = conflicting_update
+    assert not play(handler, "rock", "scissors")
+    assert handler.pinpoint_client.games_reported() == 1
+    body, _ = reply(handler, "stats", PLAYER)
+    assert body.endswith("1 wins, 0 losses, 0 ties in 1 games."), body
+    body, _ = reply(handler, "top", PLAYER)
+    assert body.endswith("No games won yet."), body
+
+    handler.history_table.update_item = update_item
+    assert not play(handler, "paper", "rock")
+    body, _ = reply(handler, "top", PLAYER)
+    assert body.endswith("Leaders:\n1. ...1111 2 wins"), body
+
+
+def win(handler, number: str, games: int) -> None:
+    # number wins the given number of games against OPPONENT
+    for _ in range(games):
+        assert not play(handler, "rock", "scissors", number)
+
+
+def buckets(handler) -> int:
+    partition = handler.LEADERBOARD_PARTITION
+    return sum(1 for number, _ in handler.history_table.items if number == partition)
+
+
+def check_climbing_leader() -> None:
+    handler = load_handler()
+    win(handler, OTHER_PLAYER, 5)
+    win(handler, PLAYER, 10)
+    # the buckets a player moves up from are deleted
+    assert buckets(handler) == 2
+    body, _ = reply(handler, "top", PLAYER)
+    assert body.endswith("Leaders:\n1. ...1111 10 wins\n2. ...3333 5 wins"), body
+
+    def failing_delete(**kwargs):
+        raise ClientError(
+            {
+                "Error": {
+                    "Code": "ProvisionedThroughputExceededException",
+                    "Message": "",
+                }
+            },
+            "DeleteItem",
+        )
+
+    handler.history_table.delete_item = failing_delete
+    win(handler, PLAYER, 10)
+    # buckets 10 to 19 are left empty, and more than a page of them is read
+    assert buckets(handler) == 12
+    body, calls = reply(handler, "top", PLAYER)
+    assert body.endswith("Leaders:\n1. ...1111 20 wins\n2. ...3333 5 wins"), body
+    assert calls > 1
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    print("mode          stats calls  history calls  top calls")
+    for mode, settings in MODES.items():
+        calls = check_mode(settings)
+        print(
+            f"{mode:<12}  {calls['stats']:>11}  {calls['history']:>13}  "
+            f"{calls['top']:>9}"
+        )
+    check_stats_conflict()
+    print("a conflict on a player's stats leaves the game finished and recorded: ok")
+    for store in ["memory", "redis"]:
+        check_history_failure(store)
+    print("a failed history write leaves the game finished: ok")
+    check_leaderboard_conflict()
+    print("a leaderboard conflict leaves the game finished and recorded: ok")
+    check_climbing_leader()
+    print("a leader is found below emptied buckets: ok")
@@ -0,0 +1,187 @@
+#
+# Latency comparison of the game state modes: lock table, no locking, lock-free
+# conditional writes and the matchmaking queue.
+#
+# Every throw runs through lambda_handler against the local DynamoDB stand-in.
+# Besides latency, each run checks that every throw is accounted for: a throw
+# must either end up in exactly one game or still be waiting in the tables.
+# Then checks that an event that is not an SNS batch fails, and that a record
+# without an SNS message fails without the others in its batch, that a throw
+# whose game state write fails releases the lock, that a warm
+# container whose cached opponent slot is out of date
+# does not turn a player's throw away, and that two throws arriving at an
+# empty matchmaking queue together are matched with each other, in every
+# game state store. Run from the repository root:
+#     python -m benchmarks.game_state_modes
+#
+import logging
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_aws import load_handler, sms_event
+
+DB_LATENCY_SECONDS = 0.005
+THROWS = 400
+CONCURRENCY_LEVELS = [1, 8, 32]
+MODES = {
+    "locking": {"LOCKING": True, "LOCK_FREE": False},
+    "no locking": {"LOCKING": False, "LOCK_FREE": False},
+    "lock-free": {"LOCKING": False, "LOCK_FREE": True},
+    "queue": {"LOCKING": False, "MATCHMAKING_QUEUE": True},
+}
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timed_throw(handler, phone_number: str) -> tuple:
+    throw = random.choice(["rock", "paper", "scissors"])
+    start = time.perf_counter()
+    response = handler.lambda_handler(sms_event(throw, phone_number), {})
+    return time.perf_counter() - start, response["statusCode"] == 200
+
+
+def run(mode: str, concurrency: int) -> dict:
+    handler = load_handler(db_latency_seconds=DB_LATENCY_SECONDS, **MODES[mode])
+    numbers = [f"+1800{i:07d}" for i in range(THROWS)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda n: timed_throw(handler, n), numbers))
+    latencies = [latency for latency, _ in results]
+    failed = sum(1 for _, succeeded in results if not succeeded)
+
+    games = handler.pinpoint_client.games_reported()
+    # slots cleared by a locked game keep their fencing token but no throw
+    waiting = sum(1 for item in handler.table.items.values() if "throw" in item)
+    waiting += len(handler.pending_table.items)
+    db_calls = sum(
+        table.call_count()
+        for table in (handler.table, handler.lock_table, handler.pending_table)
+    )
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "db_calls_per_throw": db_calls / THROWS,
+        "failed": failed,
+        # throws lost to (or double counted by) races on the game state
+        "unaccounted_throws": int(THROWS - failed - (2 * games + waiting)),
+    }
+
+
+def last_reply(handler, number: str) -> str:
+    return [
+        body for address, body in handler.pinpoint_client.sent if address == number
+    ][-1]
+
+
+def check_malformed_events() -> None:
+    handler = load_handler()
+    assert handler.lambda_handler({}, {})["statusCode"] == 500
+    event = sms_event("rock", "+18001111111")
+    event["Records"].append({})
+    response = handler.lambda_handler(event, {})
+    assert response["statusCode"] == 200 and len(response["batchItemFailures"]) == 1
+    assert last_reply(handler, "+18001111111").endswith("Waiting for opponent...")
+
+
+def check_failed_write_releases_lock(store: str) -> None:
+    handler = load_handler(GAME_STATE_STORE=store)
+    game_state = handler.get_game_state_store()
+
+    def cancelled_write(*args):
+        raise handler.ClientError(
+            {"Error": {"Code": "TransactionCanceledException", "Message": ""}},
+            "TransactWriteItems",
+        )
+
+    game_state.fenced_put_item = cancelled_write
+    response = handler.lambda_handler(sms_event("paper", "+18001111111"), {})
+    assert response["statusCode"] == 500
+    del game_state.fenced_put_item
+    _, lock_name = handler.shard_names(0)
+    assert handler.acquire_lock(lock_name, "next holder")
+
+
+def check_warm_containers() -> None:
+    # two warm containers in locking mode, sharing the tables but not caches
+    first = load_handler()
+    first.lambda_handler(sms_event("rock", "+18001111111"), {})
+    second = load_handler()
+    second.clients.instances = first.clients.instances
+    second.lambda_handler(sms_event("paper", "+18002222222"), {})
+    # the first container's cache still has the player's throw waiting
+    first.lambda_handler(sms_event("scissors", "+18001111111"), {})
+    assert "Waiting for opponent" in last_reply(first, "+18001111111")
+    assert first.table.items["opponent"]["throw"] == "scissors"
+
+
+def check_queue_race(store: str) -> None:
+    handler = load_handler(MATCHMAKING_QUEUE=True, GAME_STATE_STORE=store)
+    claim_pending_throw = handler.claim_pending_throw
+    queue = handler.get_game_state_store()
+    # the first two throws look at the queue before either is added to it
+    missed = []
+
+    def racing_claim(queue_name, phone_number, before=None):
+        if before is None and len(missed) < 2:
+            missed.append(phone_number)
+            return None
+        return claim_pending_throw(queue_name, phone_number, before)
+
+    handler.claim_pending_throw = racing_claim
+    handler.lambda_handler(sms_event("rock", "+18001111111"), {})
+    # arrivals in the same millisecond are in random order
+    time.sleep(0.002)
+    handler.lambda_handler(sms_event("paper", "+18002222222"), {})
+    assert handler.pinpoint_client.games_reported() == 1
+    assert not queue.claim_pending_throw("opponent", "", 10)
+
+    # and if a third throw claims the second one while it takes its entry
+    # back, the second is played there and the first waits on
+    missed.clear()
+    remove_pending_throw = handler.remove_pending_throw
+
+    def overtaken_remove(queue_name, arrival):
+        handler.lambda_handler(sms_event("scissors", "+18003333333"), {})
+        return remove_pending_throw(queue_name, arrival)
+
+    handler.remove_pending_throw = overtaken_remove
+    handler.lambda_handler(sms_event("rock", "+18001111111"), {})
+    time.sleep(0.002)
+    handler.lambda_handler(sms_event("paper", "+18002222222"), {})
+    assert handler.pinpoint_client.games_reported() == 2
+    waiting = queue.claim_pending_throw("opponent", "", 10)
+    assert waiting["phone_number"] == "+18001111111"
+    assert not queue.claim_pending_throw("opponent", "", 10)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    print(
+        f"{THROWS} throws, {DB_LATENCY_SECONDS * 1000:.0f}ms simulated "
+        "DynamoDB latency\n"
+    )
+    print(
+        "mode        concurrency  p50 ms  p99 ms  db calls/throw  failed  unaccounted"
+    )
+    for mode in MODES:
+        for concurrency in CONCURRENCY_LEVELS:
+            result = run(mode, concurrency)
+            print(
+                f"{mode:<10}  {concurrency:>11}  {result['p50_ms']:>6.1f}  "
+                f"{result['p99_ms']:>6.1f}  {result['db_calls_per_throw']:>14.1f}  "
+                f"{result['failed']:>6}  {result['unaccounted_throws']:>11}"
+            )
+    check_malformed_events()
+    print("\nmalformed events and records fail alone: ok")
+    for store in ["dynamodb", "memory", "redis"]:
+        check_failed_write_releases_lock(store)
+    print("a failed game state write releases the lock: ok")
+    check_warm_containers()
+    print("a stale cached slot does not reject a throw: ok")
+    for store in ["dynamodb", "memory", "redis"]:
+        check_queue_race(store)
+    print("throws arriving at an empty queue together are matched: ok")
@@ -0,0 +1,79 @@
+#
+# Checks the claims that keep a redelivered text from being played twice,
+# against the local stand-ins for each game state store: a redelivered throw
+# is answered once, texts that are not throws are not claimed, a throw's
+# claim lasts until Lambda would time its invocation out and is kept for
+# IDEMPOTENCY_TTL_SECONDS once the throw is played. Run from the repository
+# root:
+#     python -m benchmarks.idempotency
+#
+import logging
+import time
+
+from benchmarks.local_aws import load_handler, sms_event
+
+
+class Crash(BaseException):
+    # an invocation that dies without handling its records
+    pass
+
+
+def crash(*args):
+    raise Crash
+
+
+class RemainingTime:
+    # a lambda context with the given time left
+    def __init__(self, remaining_ms: int):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+
+def redelivered(text: str, number: str, message_id: str) -> dict:
+    event = sms_event(text, number)
+    event["Records"][0]["Sns"]["MessageId"] = message_id
+    return event
+
+
+def replies(handler, number: str) -> int:
+    return sum(1 for address, _ in handler.pinpoint_client.sent if address == number)
+
+
+def check_store(store: str) -> None:
+    handler = load_handler(GAME_STATE_STORE=store)
+
+    # a redelivered throw is skipped, a redelivered "test" is answered again
+    for text, number, times in [
+        ("rock", "+18001111111", 1),
+        ("test", "+18002222222", 2),
+    ]:
+        event = redelivered(text, number, text + "-message")
+        for _ in range(2):
+            assert not handler.lambda_handler(event, {})["batchItemFailures"]
+        assert replies(handler, number) == times
+
+    # a throw's claim lasts until Lambda would time its invocation out, and
+    # is kept for IDEMPOTENCY_TTL_SECONDS once the throw is played
+    game_state = handler.get_game_state_store()
+    process_throws = handler.process_throws
+    for message_id, crashes in [("timed-out", True), ("played", False)]:
+        event = redelivered("scissors", "+18003333333", message_id)
+        if crashes:
+            handler.process_throws = crash
+        try:
+            handler.lambda_handler(event, RemainingTime(3000))
+        except Crash:
+            pass
+        handler.process_throws = process_throws
+        key, now = handler.message_key(message_id), int(time.time())
+        assert not game_state.claim_message(key, now, now)
+        assert game_state.claim_message(key, now + 10, now + 10) == crashes
+    print(f"{store:<9} ok")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    for store in ["dynamodb", "memory", "redis"]:
+        check_store(store)
@@ -0,0 +1,669 @@
+#
+# In-memory stand-ins for the AWS services used by the lambda handler.
+#
+# These let the handler run locally (for load tests and benchmarks) without an
+# AWS account. Every call can be given an artificial latency so that results
+# reflect round trips rather than python dict access.
+#
+import importlib.util
+import json
+import operator
+import os
+import re
+import threading
+import time
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+try:
+    # fakeredis runs Lua scripts with lupa, which it does not depend on
+    import fakeredis
+    import lupa  # noqa: F401
+except ImportError:
+    fakeredis = None
+
+HANDLER_FILE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "lambda_function_handler.py",
+)
+
+# settings of every local handler, on top of the handler's defaults
+LOCAL_HANDLER_SETTINGS = {"PINPOINT_APP_ID": "local-pinpoint-app"}
+
+# the texts announcing a game result end with one of these, see format_result
+RESULT_ENDINGS = (" wins.", "No winner")
+
+COMPARISONS = {
+    "=": operator.eq,
+    "<>": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def conditional_check_failed(operation_name: str) -> ClientError:
+    return ClientError(
+        {
+            "Error": {
+                "Code": "ConditionalCheckFailedException",
+                "Message": "The conditional request failed",
+            }
+        },
+        operation_name,
+    )
+
+
+def evaluate_condition(condition, item: dict) -> bool:
+    """
+    Evaluate a boto3.dynamodb.conditions expression against an item
+    (None if the item does not exist).
+    """
+    item = item or {}
+    expression = condition.get_expression()
+    op, values = expression["operator"], expression["values"]
+    if op == "AND":
+        return all(evaluate_condition(value, item) for value in values)
+    if op == "OR":
+        return any(evaluate_condition(value, item) for value in values)
+    if op == "NOT":
+        return not evaluate_condition(values[0], item)
+    if op == "attribute_exists":
+        return values[0].name in item
+    if op == "attribute_not_exists":
+        return values[0].name not in item
+    if op == "begins_with":
+        name = values[0].name
+        return name in item and item[name].startswith(values[1])
+    if op in COMPARISONS:
+        name = values[0].name
+        return name in item and COMPARISONS[op](item[name], values[1])
+    raise NotImplementedError(f"Condition operator {op} is not supported locally.")
+
+
+def split_top_level(text: str) -> list:
+    # split on commas that are not inside a function call's parentheses
+    parts, depth, current = [], 0, ""
+    for char in text:
+        if char == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def apply_update_expression(
+    item: dict, expression: str, names: dict, values: dict
+) -> set:
+    """
+    Apply a DynamoDB UpdateExpression to an item in place. Supports SET (with
+    '+', '-' and if_not_exists), REMOVE, ADD and DELETE on top level attributes.
+    Returns the names of the attributes that were updated.
+    """
+
+    def name(token: str) -> str:
+        return names.get(token, token)
+
+    def operand(token: str):
+        token = token.strip()
+        if token.startswith(":"):
+            return values[token]
+        match = re.fullmatch(r"if_not_exists\((.+),(.+)\)", token)
+        if match:
+            attribute = name(match.group(1).strip())
+            return item[attribute] if attribute in item else operand(match.group(2))
+        return item[name(token)]
+
+    updated = set()
+    clauses = re.split(r"\b(SET|REMOVE|ADD|DELETE)\b", expression)
+    for action, clause in zip(clauses[1::2], clauses[2::2]):
+        for part in split_top_level(clause):
+            if action == "SET":
+                attribute, value = (side.strip() for side in part.split("=", 1))
+                math = re.fullmatch(r"(.+?)\s*([+-])\s*(:\w+)", value)
+                if math and "(" not in math.group(3):
+                    left, right = operand(math.group(1)), operand(math.group(3))
+                    new_value = left + right if math.group(2) == "+" else left - right
+                else:
+                    new_value = operand(value)
+                item[name(attribute)] = new_value
+                updated.add(name(attribute))
+            elif action == "REMOVE":
+                item.pop(name(part), None)
+                updated.add(name(part))
+            else:
+                attribute, value = part.split()
+                attribute, value = name(attribute), values[value]
+                if action == "ADD" and isinstance(value, set):
+                    item[attribute] = item.get(attribute, set()) | value
+                elif action == "ADD":
+                    item[attribute] = item.get(attribute, 0) + value
+                else:
+                    item[attribute] = item.get(attribute, set()) - value
+                    # DynamoDB has no empty sets, the attribute goes instead
+                    if not item[attribute]:
+                        del item[attribute]
+                updated.add(attribute)
+    return updated
+
+
+def returned_values(old_item: dict, return_values: str) -> dict:
+    # put_item and delete_item only return the old item, and only if asked to.
+    if return_values == "ALL_OLD" and old_item is not None:
+        return {"Attributes": dict(old_item)}
+    return {}
+
+
+class LocalTable:
+    """
+    Thread safe, in-memory stand-in for a boto3 dynamodb Table with a hash key
+    and an optional range key. Supports the subset of the Table API used by
+    the lambda handler. Items are stored in 'items' by hash key value, or by
+    (hash, range) tuple.
+    """
+
+    def __init__(
+        self,
+        hash_key: str,
+        latency_seconds: float = 0.0,
+        range_key: str = None,
+        table_name: str = None,
+        client=None,
+    ):
+        self.hash_key = hash_key
+        self.table_name = table_name
+        # the LocalDynamoDB that created the table, for transactions
+        self.client = client
+        self.range_key = range_key
+        self.latency_seconds = latency_seconds
+        self.items = {}
+        self.calls = {}
+        self._mutex = threading.Lock()
+
+    def _round_trip(self, operation_name: str) -> None:
+        # simulated network time is spent outside the mutex so that calls from
+        # different threads overlap like they would against DynamoDB.
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._mutex:
+            self.calls[operation_name] = self.calls.get(operation_name, 0) + 1
+
+    def call_count(self) -> int:
+        return sum(self.calls.values())
+
+    def key(self, item: dict):
+        if self.range_key is None:
+            return item[self.hash_key]
+        return item[self.hash_key], item[self.range_key]
+
+    def _check(self, operation_name: str, condition, current: dict) -> None:
+        if condition is not None and not evaluate_condition(condition, current):
+            raise conditional_check_failed(operation_name)
+
+    def _put(self, Item: dict, ConditionExpression=None, **kwargs) -> dict:
+        # the following methods must be called holding the mutex
+        key = self.key(Item)
+        current = self.items.get(key)
+        self._check("PutItem", ConditionExpression, current)
+        self.items[key] = dict(Item)
+        return current
+
+    def _update(
+        self,
+        Key: dict,
+        UpdateExpression: str,
+        ConditionExpression=None,
+        ExpressionAttributeNames: dict = None,
+        ExpressionAttributeValues: dict = None,
+        **kwargs,
+    ) -> tuple:
+        key = self.key(Key)
+        current = self.items.get(key)
+        self._check("UpdateItem", ConditionExpression, current)
+        item = dict(current or Key)
+        updated = apply_update_expression(
+            item,
+            UpdateExpression,
+            ExpressionAttributeNames or {},
+            ExpressionAttributeValues or {},
+        )
+        self.items[key] = item
+        return current, item, updated
+
+    def _delete(self, Key: dict, ConditionExpression=None, **kwargs) -> dict:
+        key = self.key(Key)
+        current = self.items.get(key)
+        self._check("DeleteItem", ConditionExpression, current)
+        self.items.pop(key, None)
+        return current
+
+    def put_item(self, Item: dict, ReturnValues="NONE", **kwargs) -> dict:
+        self._round_trip("PutItem")
+        with self._mutex:
+            current = self._put(Item, **kwargs)
+        return returned_values(current, ReturnValues)
+
+    def update_item(self, ReturnValues: str = "NONE", **kwargs) -> dict:
+        self._round_trip("UpdateItem")
+        with self._mutex:
+            current, item, updated = self._update(**kwargs)
+        if ReturnValues == "ALL_NEW":
+            return {"Attributes": dict(item)}
+        if ReturnValues == "UPDATED_NEW":
+            return {"Attributes": {k: item[k] for k in updated if k in item}}
+        if ReturnValues == "UPDATED_OLD" and current is not None:
+            return {"Attributes": {k: current[k] for k in updated if k in current}}
+        return returned_values(current, ReturnValues)
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        self._round_trip("GetItem")
+        with self._mutex:
+            item = self.items.get(self.key(Key))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def delete_item(self, Key: dict, ReturnValues="NONE", **kwargs) -> dict:
+        self._round_trip("DeleteItem")
+        with self._mutex:
+            current = self._delete(Key, **kwargs)
+        return returned_values(current, ReturnValues)
+
+    def query(
+        self,
+        KeyConditionExpression,
+        ScanIndexForward: bool = True,
+        Limit: int = None,
+        ExclusiveStartKey: dict = None,
+        **kwargs,
+    ) -> dict:
+        self._round_trip("Query")
+        with self._mutex:
+            items = [
+                dict(item)
+                for item in self.items.values()
+                if evaluate_condition(KeyConditionExpression, item)
+            ]
+        items.sort(key=lambda item: item[self.range_key], reverse=not ScanIndexForward)
+        if ExclusiveStartKey is not None:
+            # the page starts after the last item of the one before
+            start = self.key(ExclusiveStartKey)
+            items = items[[self.key(item) for item in items].index(start) + 1 :]
+        response = {"Items": items[:Limit]}
+        if Limit is not None and len(items) > Limit:
+            last = items[Limit - 1]
+            response["LastEvaluatedKey"] = {
+                self.hash_key: last[self.hash_key],
+                self.range_key: last[self.range_key],
+            }
+        return response
+
+    def transact_item(self, entry: dict) -> dict:
+        ((operation, params),) = entry.items()
+        return {operation: dict(params, TableName=self.table_name)}
+
+
+class LocalDynamoDB:
+    """
+    Stand-in for the dynamodb client the handler's tables share, holding the
+    LocalTables it creates. Only transactions, which can span tables, are
+    made through it; everything else goes through the tables themselves.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.tables = {}
+        self.calls = {}
+        self._mutex = threading.Lock()
+
+    def create_table(self, table_name: str, hash_key: str, **kwargs) -> LocalTable:
+        table = LocalTable(
+            hash_key, self.latency_seconds, table_name=table_name, client=self, **kwargs
+        )
+        self.tables[table_name] = table
+        return table
+
+    def call_count(self) -> int:
+        return sum(self.calls.values())
+
+    def transact_write_items(self, TransactItems: list) -> dict:
+        # all or nothing: every table in the transaction is locked (in name
+        # order) and its items restored if any condition does not hold.
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._mutex:
+            self.calls["TransactWriteItems"] = (
+                self.calls.get("TransactWriteItems", 0) + 1
+            )
+        entries = []
+        for entry in TransactItems:
+            ((operation, params),) = entry.items()
+            params = dict(params)
+            entries.append((operation, self.tables[params.pop("TableName")], params))
+        tables = sorted({table.table_name: table for _, table, _ in entries}.items())
+        for _, table in tables:
+            table._mutex.acquire()
+        saved = {name: dict(table.items) for name, table in tables}
+        try:
+            for index, (operation, table, params) in enumerate(entries):
+                write = {
+                    "Put": table._put,
+                    "Update": table._update,
+                    "Delete": table._delete,
+                }[operation]
+                try:
+                    write(**params)
+                except ClientError:
+                    for name, table in tables:
+                        table.items = saved[name]
+                    reasons = [{"Code": "None"}] * len(entries)
+                    reasons[index] = {"Code": "ConditionalCheckFailed"}
+                    raise ClientError(
+                        {
+                            "Error": {
+                                "Code": "TransactionCanceledException",
+                                "Message": "Transaction cancelled",
+                            },
+                            "CancellationReasons": reasons,
+                        },
+                        "TransactWriteItems",
+                    )
+        finally:
+            for _, table in tables:
+                table._mutex.release()
+        return {}
+
+
+class LocalPinpointClient:
+    """
+    In-memory stand-in for the boto3 pinpoint client. Every address is reported
+    as delivered, except those given a DeliveryStatus in 'failures'. Each
+    delivered (phone number, body) pair is recorded in 'sent', and 'requests'
+    counts send_messages calls.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0, failures: dict = None):
+        self.latency_seconds = latency_seconds
+        self.failures = failures or {}
+        self.sent = []
+        self.requests = 0
+        self._mutex = threading.Lock()
+
+    def send_messages(self, ApplicationId: str, MessageRequest: dict) -> dict:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        body = MessageRequest["MessageConfiguration"]["SMSMessage"]["Body"]
+        addresses = MessageRequest["Addresses"]
+        with self._mutex:
+            self.requests += 1
+            self.sent.extend(
+                (address, config.get("BodyOverride", body))
+                for address, config in addresses.items()
+                if address not in self.failures
+            )
+        return {
+            "MessageResponse": {
+                "ApplicationId": ApplicationId,
+                "Result": {
+                    address: {
+                        "DeliveryStatus": self.failures.get(address, "SUCCESSFUL"),
+                        "StatusCode": 400 if address in self.failures else 200,
+                    }
+                    for address in addresses
+                },
+            }
+        }
+
+    def games_reported(self) -> float:
+        # every finished game texts its result to both players
+        results = sum(1 for _, body in self.sent if body.endswith(RESULT_ENDINGS))
+        return results / 2
+
+
+class LocalRedis:
+    """
+    In-memory stand-in for the redis-py client used by the handler's
+    RedisStore: hgetall, delete and registered scripts.
+
+    With fakeredis and lupa installed (pip install "fakeredis[lua]") the
+    commands go to a fakeredis server, which runs the Lua of the given
+    scripts (RedisStore.SCRIPTS). Without them the Lua is NOT run, and so not
+    verified: each script is run by the script_<name> method, a Python
+    rewrite meant to have the same semantics, under one mutex, just as Redis
+    runs one script at a time. Values are stored as strings like Redis.
+    """
+
+    def __init__(self, scripts: dict, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        # a server of its own, FakeRedis clients otherwise share one
+        self.server = fakeredis and fakeredis.FakeRedis(
+            server=fakeredis.FakeServer(), decode_responses=True
+        )
+        self.hashes = {}
+        # sorted sets as member -> score
+        self.sorted_sets = {}
+        self.calls = {}
+        self.script_names = {source: name for name, source in scripts.items()}
+        self._mutex = threading.Lock()
+
+    @property
+    def runs_lua(self) -> bool:
+        return self.server is not None
+
+    def _round_trip(self, command: str) -> None:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._mutex:
+            self.calls[command] = self.calls.get(command, 0) + 1
+
+    def call_count(self) -> int:
+        return sum(self.calls.values())
+
+    def hgetall(self, key: str) -> dict:
+        self._round_trip("HGETALL")
+        if self.runs_lua:
+            return self.server.hgetall(key)
+        with self._mutex:
+            return dict(self.hashes.get(key, {}))
+
+    def delete(self, key: str) -> int:
+        self._round_trip("DEL")
+        if self.runs_lua:
+            return self.server.delete(key)
+        with self._mutex:
+            return int(self.hashes.pop(key, None) is not None)
+
+    def register_script(self, source: str):
+        if self.runs_lua:
+            script = self.server.register_script(source)
+
+            def run(keys: list, args: list = ()):
+                self._round_trip("EVALSHA")
+                return script(keys=keys, args=args)
+
+            return run
+        script = getattr(self, "script_" + self.script_names[source])
+
+        def run(keys: list, args: list = ()):
+            self._round_trip("EVALSHA")
+            with self._mutex:
+                return script(keys[0], [str(arg) for arg in args])
+
+        return run
+
+    @staticmethod
+    def pairs(fields: list) -> dict:
+        return dict(zip(fields[::2], fields[1::2]))
+
+    def script_put_item(self, key: str, args: list):
+        self.hashes[key] = self.pairs(args)
+
+    def script_claim_item(self, key: str, args: list) -> list:
+        if args and self.hashes.get(key, {}).get("phone_number", args[0]) == args[0]:
+            return []
+        item = self.hashes.pop(key, {})
+        return [part for pair in item.items() for part in pair]
+
+    def script_add_pending_throw(self, key: str, args: list):
+        self.hashes[key + ":" + args[0]] = self.pairs(args[1:])
+        self.sorted_sets.setdefault(key, {})[args[0]] = 0
+
+    def script_claim_pending_throw(self, key: str, args: list) -> list:
+        # members of equal score are ordered by their name, like Redis
+        phone_number, limit, *before = args
+        arrivals = self.sorted_sets.get(key, {})
+        for arrival in sorted(arrivals)[: int(limit)]:
+            if before and arrival >= before[0]:
+                break
+            if self.hashes[key + ":" + arrival].get("phone_number") != phone_number:
+                entry = self.hashes.pop(key + ":" + arrival)
+                del arrivals[arrival]
+                return [part for pair in entry.items() for part in pair]
+        return []
+
+    def script_remove_pending_throw(self, key: str, args: list) -> int:
+        if self.sorted_sets.get(key, {}).pop(args[0], None) is None:
+            return 0
+        del self.hashes[key + ":" + args[0]]
+        return 1
+
+    def script_put_item_if_absent(self, key: str, args: list) -> int:
+        if key in self.hashes:
+            return 0
+        self.hashes[key] = self.pairs(args)
+        return 1
+
+    def script_claim_message(self, key: str, args: list) -> int:
+        # the key is not expired, only the expiry is checked
+        now, expires = args
+        stored = self.hashes.get(key, {})
+        if "expires" in stored and int(stored["expires"]) >= int(now):
+            return 0
+        self.hashes[key] = {"expires": expires}
+        return 1
+
+    def script_complete_message(self, key: str, args: list):
+        self.hashes[key] = {"expires": args[0]}
+
+    def script_fenced_put_item(self, key: str, args: list) -> int:
+        stored = self.hashes.get(key, {})
+        if "fencing_token" in stored and int(stored["fencing_token"]) > int(args[0]):
+            return 0
+        if args[1] != "" and int(stored.get("version", 0)) != int(args[1]):
+            return 0
+        self.hashes[key] = self.pairs(args[2:])
+        return 1
+
+    def script_acquire_lock(self, key: str, args: list):
+        holder, now, expires = args
+        lock = self.hashes.setdefault(key, {})
+        if "holder" in lock and int(lock["lease_expires"]) >= int(now):
+            return None
+        lock.update(holder=holder, time_acquired=now, lease_expires=expires)
+        lock["fencing_token"] = str(int(lock.get("fencing_token", 0)) + 1)
+        return int(lock["fencing_token"])
+
+    def script_renew_lock(self, key: str, args: list) -> int:
+        holder, fencing_token, expires = args
+        lock = self.hashes.get(key, {})
+        if lock.get("holder") != holder or lock.get("fencing_token") != fencing_token:
+            return 0
+        lock["lease_expires"] = expires
+        return 1
+
+    def script_release_lock(self, key: str, args: list) -> int:
+        lock = self.hashes.get(key, {})
+        if lock.get("holder") != args[0]:
+            return 0
+        del lock["holder"], lock["lease_expires"]
+        return 1
+
+
+def load_handler(
+    db_latency_seconds: float = 0.0,
+    sms_latency_seconds: float = 0.0,
+    redis_latency_seconds: float = 0.0,
+    stand_ins: bool = True,
+    **parameters,
+):
+    """
+    Import a fresh copy of the lambda handler wired to local stand-ins.
+
+    The parameters are the handler's settings, named like the environment
+    variables setup.py sets on the function (e.g. LOCKING=False). They are in
+    the environment while the module is executed, where its config is read
+    from, and the others keep their defaults. Unless stand_ins
+    is False, the handler's game state table, lock table, pending throws table,
+    game history table, redis client and pinpoint client are replaced with
+    local stand-ins, which are also reachable as module.table,
+    module.lock_table, module.pending_table, module.history_table,
+    module.redis and module.pinpoint_client. Which of
+    them are used depends on GAME_STATE_STORE. The tables share the
+    module.dynamodb client stand-in, which counts transactions.
+    """
+    # boto3 needs a region to build clients, even ones that are never called
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    spec = importlib.util.spec_from_file_location(
+        "lambda_function_handler", HANDLER_FILE_PATH
+    )
+    module = importlib.util.module_from_spec(spec)
+    settings = dict(LOCAL_HANDLER_SETTINGS, **parameters)
+    with mock.patch.dict(
+        os.environ, {name: str(value) for name, value in settings.items()}
+    ):
+        spec.loader.exec_module(module)
+    unknown = set(parameters) - {field.upper() for field in module.Config._fields}
+    if unknown:
+        raise TypeError(f"Unknown handler settings: {sorted(unknown)}")
+    if not stand_ins:
+        return module
+
+    config = module.config
+    module.dynamodb = LocalDynamoDB(db_latency_seconds)
+    module.table = module.dynamodb.create_table(config.game_state_table_name, "state")
+    module.lock_table = module.dynamodb.create_table(
+        config.lock_table_name, "lock_name"
+    )
+    module.pending_table = module.dynamodb.create_table(
+        config.pending_throws_table_name, "queue", range_key="arrival"
+    )
+    module.history_table = module.dynamodb.create_table(
+        config.game_history_table_name,
+        "phone_number",
+        range_key="record",
+    )
+    module.redis = LocalRedis(module.RedisStore.SCRIPTS, redis_latency_seconds)
+    module.pinpoint_client = LocalPinpointClient(sms_latency_seconds)
+    module.clients.instances.update(
+        {
+            "game_state_table": module.table,
+            "lock_table:" + config.lock_table_name: module.lock_table,
+            "pending_throws_table": module.pending_table,
+            "history_table": module.history_table,
+            "redis": module.redis,
+            "pinpoint": module.pinpoint_client,
+        }
+    )
+    return module
+
+
+def sms_event(message: str, phone_number: str) -> dict:
+    """
+    Build an SNS event carrying one inbound text, shaped like
+    test_events/lambda_test_event.json.
+    """
+    return {
+        "Records": [
+            {
+                "Sns": {
+                    "Message": json.dumps(
+                        {"messageBody": message, "originationNumber": phone_number}
+                    )
+                }
+            }
+        ]
+    }
@@ -0,0 +1,72 @@
+#
+# Contention benchmark for the lock retry policies.
+#
+# Many workers repeatedly acquire the same named lock, hold it for a short
+# critical section and release it, against the local DynamoDB stand-in.
+# Reports DynamoDB calls per acquired lock and time spent waiting per policy.
+# Run from the repository root:
+#     python -m benchmarks.lock_contention
+#
+import logging
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_aws import load_handler
+
+DB_LATENCY_SECONDS = 0.005
+# roughly a get_item, a put_item and an SMS while holding the lock
+CRITICAL_SECTION_SECONDS = 0.03
+WORKERS = 16
+ACQUISITIONS_PER_WORKER = 5
+
+
+def work(handler, policy_name: str) -> list:
+    attempts = []
+    for _ in range(ACQUISITIONS_PER_WORKER):
+        self_id = str(uuid.uuid4())
+        policy = handler.RETRY_POLICIES[policy_name]()
+        acquired = handler.retry_acquire_lock("throw_lock", self_id, policy)
+        if acquired:
+            time.sleep(CRITICAL_SECTION_SECONDS)
+            handler.release_lock("throw_lock", self_id)
+        attempts.append((policy, bool(acquired)))
+    return attempts
+
+
+def run(policy_name: str) -> dict:
+    handler = load_handler(db_latency_seconds=DB_LATENCY_SECONDS)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        results = list(pool.map(lambda _: work(handler, policy_name), range(WORKERS)))
+    elapsed = time.perf_counter() - start
+
+    attempts = [attempt for worker in results for attempt in worker]
+    policies = [policy for policy, _ in attempts]
+    acquired = sum(1 for _, succeeded in attempts if succeeded)
+    return {
+        "seconds": elapsed,
+        "acquired": acquired,
+        "calls_per_lock": handler.lock_table.call_count() / max(acquired, 1),
+        "attempts_per_lock": statistics.mean(p.attempts for p in policies),
+        "mean_wait_ms": statistics.mean(p.waited_seconds for p in policies) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    total = WORKERS * ACQUISITIONS_PER_WORKER
+    print(
+        f"{WORKERS} workers x {ACQUISITIONS_PER_WORKER} acquisitions, "
+        f"{CRITICAL_SECTION_SECONDS * 1000:.0f}ms critical section, "
+        f"{DB_LATENCY_SECONDS * 1000:.0f}ms simulated DynamoDB latency\n"
+    )
+    print("policy               seconds  acquired  calls/lock  attempts  wait ms")
+    for name in ["immediate", "exponential", "full_jitter", "decorrelated_jitter"]:
+        result = run(name)
+        print(
+            f"{name:<19}  {result['seconds']:>7.2f}  "
+            f"{result['acquired']:>4}/{total:<3}  {result['calls_per_lock']:>10.1f}  "
+            f"{result['attempts_per_lock']:>8.1f}  {result['mean_wait_ms']:>7.1f}"
+        )
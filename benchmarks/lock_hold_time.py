@@ -0,0 +1,91 @@
+#
+# Lock hold time with texts sent inside vs. after the critical section.
+#
+# Runs throws through lambda_handler in locking mode against the local
+# DynamoDB stand-in and a deliberately slow Pinpoint stand-in. "inline" sends
+# every text as soon as it is produced, like the handler used to do while
+# holding the lock. "outbox" is the current behaviour: texts are queued and
+# sent after the lock is released.
+# Run from the repository root:
+#     python -m benchmarks.lock_hold_time
+#
+import logging
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_aws import load_handler, sms_event
+
+DB_LATENCY_SECONDS = 0.005
+SMS_LATENCY_SECONDS = 0.1
+THROWS = 100
+CONCURRENCY = 8
+
+
+def instrument_lock(handler) -> list:
+    """
+    Wrap the handler's acquire/release functions to record how long each
+    lock is held. Returns the list hold times are appended to.
+    """
+    acquired_at, hold_times = {}, []
+    acquire_lock, release_lock = handler.acquire_lock, handler.release_lock
+
+    def timed_acquire_lock(lock_name, self_id):
+        fencing_token = acquire_lock(lock_name, self_id)
+        if fencing_token:
+            acquired_at[self_id] = time.perf_counter()
+        return fencing_token
+
+    def timed_release_lock(lock_name, self_id):
+        released = release_lock(lock_name, self_id)
+        hold_times.append(time.perf_counter() - acquired_at.pop(self_id))
+        return released
+
+    handler.acquire_lock = timed_acquire_lock
+    handler.release_lock = timed_release_lock
+    return hold_times
+
+
+def run(inline: bool) -> dict:
+    handler = load_handler(
+        db_latency_seconds=DB_LATENCY_SECONDS, sms_latency_seconds=SMS_LATENCY_SECONDS
+    )
+    if inline:
+
+        class InlineOutbox(handler.Outbox):
+            def add(self, phone_numbers, message):
+                handler.send_sms_to_all(phone_numbers, message)
+
+        handler.Outbox = InlineOutbox
+    hold_times = instrument_lock(handler)
+
+    def throw(i):
+        move = random.choice(["rock", "paper", "scissors"])
+        handler.lambda_handler(sms_event(move, f"+1800{i:07d}"), {})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        list(pool.map(throw, range(THROWS)))
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "hold_mean_ms": statistics.mean(hold_times) * 1000,
+        "hold_max_ms": max(hold_times) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    print(
+        f"{THROWS} throws, concurrency {CONCURRENCY}, "
+        f"{DB_LATENCY_SECONDS * 1000:.0f}ms DynamoDB, "
+        f"{SMS_LATENCY_SECONDS * 1000:.0f}ms Pinpoint\n"
+    )
+    print("sends    seconds  mean hold ms  max hold ms")
+    for name, inline in [("inline", True), ("outbox", False)]:
+        result = run(inline)
+        print(
+            f"{name:<7}  {result['seconds']:>7.2f}  {result['hold_mean_ms']:>12.1f}  "
+            f"{result['hold_max_ms']:>11.1f}"
+        )
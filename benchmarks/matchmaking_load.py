@@ -0,0 +1,73 @@
+#
+# Load test for the sharded matchmaking queue.
+#
+# Drives many simulated concurrent players through lambda_handler against the
+# local DynamoDB stand-in and reports throughput for increasing shard counts.
+# Run from the repository root:
+#     python -m benchmarks.matchmaking_load
+#
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_aws import load_handler, sms_event
+
+# simulated DynamoDB round trip, the lock hold time is a few of these.
+DB_LATENCY_SECONDS = 0.005
+CONCURRENT_PLAYERS = 64
+THROWS_PER_PLAYER = 10
+SHARD_COUNTS = [1, 2, 4, 8, 16]
+
+
+def play(handler, phone_number: str) -> None:
+    for _ in range(THROWS_PER_PLAYER):
+        throw = random.choice(["rock", "paper", "scissors"])
+        handler.lambda_handler(sms_event(throw, phone_number), {})
+
+
+def run(shards: int, strategy: str) -> dict:
+    handler = load_handler(
+        db_latency_seconds=DB_LATENCY_SECONDS,
+        MATCHMAKING_SHARDS=shards,
+        MATCHMAKING_SHARD_STRATEGY=strategy,
+    )
+    numbers = [f"+1800{i:07d}" for i in range(CONCURRENT_PLAYERS)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENT_PLAYERS) as pool:
+        list(pool.map(lambda number: play(handler, number), numbers))
+    elapsed = time.perf_counter() - start
+
+    games = handler.pinpoint_client.games_reported()
+    throws = CONCURRENT_PLAYERS * THROWS_PER_PLAYER
+    lock_calls = handler.lock_table.call_count()
+    return {
+        "shards": shards,
+        "strategy": strategy,
+        "seconds": elapsed,
+        "throws_per_second": throws / elapsed,
+        "games_per_second": games / elapsed,
+        "lock_calls_per_throw": lock_calls / throws,
+    }
+
+
+if __name__ == "__main__":
+    # the handler logs every call at INFO, which would dominate the timing.
+    logging.disable(logging.ERROR)
+    print(
+        f"{CONCURRENT_PLAYERS} players x {THROWS_PER_PLAYER} throws, "
+        f"{DB_LATENCY_SECONDS * 1000:.0f}ms simulated DynamoDB latency\n"
+    )
+    print("shards  strategy  seconds  throws/s  games/s  lock calls/throw")
+    for strategy in ["random", "hash"]:
+        baseline = None
+        for shards in SHARD_COUNTS:
+            result = run(shards, strategy)
+            baseline = baseline or result["throws_per_second"]
+            print(
+                f"{result['shards']:>6}  {result['strategy']:>8}  "
+                f"{result['seconds']:>7.2f}  {result['throws_per_second']:>8.1f}  "
+                f"{result['games_per_second']:>7.1f}  "
+                f"{result['lock_calls_per_throw']:>16.1f}  "
+                f"(x{result['throws_per_second'] / baseline:.1f})"
+            )
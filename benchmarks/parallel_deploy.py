@@ -0,0 +1,277 @@
+#
+# Wall-clock time of setup.py's deploy steps, one at a time versus on the
+# deploy thread pool, against stand-ins for the service modules that sleep
+# for a typical provisioning time instead of calling AWS. Checks that every
+# step starts only after its dependencies, that the parallel deploy takes
+# about as long as the critical path, that a redeploy from the deploy state
+# only updates what changed, and that teardown deletes resources in reverse
+# dependency order. Then checks that tables the settings no longer use are
+# deleted by the next deploy or by teardown, and that teardown keeps the
+# deploy state when it holds something it cannot delete. Run from the
+# repository root:
+#     python -m benchmarks.parallel_deploy
+#
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# setup.py and the service modules log to rps.log unless logging is set up,
+# and create boto3 clients on import, which need a region
+logging.getLogger().addHandler(logging.NullHandler())
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import setup
+import util
+
+# seconds each stubbed call takes, roughly what AWS takes to provision
+TABLE_SECONDS = 0.6
+ROLE_SECONDS = 0.4
+FUNCTION_SECONDS = 0.3
+CALL_SECONDS = 0.05
+# run() points setup.py at a copy of the handler file
+HANDLER_FILE_NAME = "lambda_function_handler.py"
+
+
+class StubServices:
+    """
+    Stand-ins for the IAm, Lambda, Pinpoint, SNS and Dynamodb modules used by
+    setup.py, recording when each resource was created and deleted.
+    """
+
+    def __init__(self):
+        self.started = {}
+        self.created = {}
+        self.deleted = {}
+        self._mutex = threading.Lock()
+
+    def call(self, seconds: float, created: str = None, deleted: str = None):
+        if created:
+            self.started[created] = time.perf_counter()
+        time.sleep(seconds)
+        with self._mutex:
+            if created:
+                self.created[created] = time.perf_counter()
+            if deleted:
+                self.deleted[deleted] = time.perf_counter()
+
+    def modules(self) -> dict:
+        def create_table(table_name, **kwargs):
+            self.call(TABLE_SECONDS, created=table_name)
+            return SimpleNamespace(table_name=table_name)
+
+        def create_topic(name):
+            self.call(CALL_SECONDS, created="sns_topic")
+            return SimpleNamespace(arn="arn:sns:" + name)
+
+        def create_pinpoint_app(name):
+            self.call(CALL_SECONDS, created="pinpoint_app")
+            return {"ApplicationResponse": {"Id": "app-id"}}
+
+        def create_policy(name, policy_json):
+            self.call(CALL_SECONDS, created="iam_policy")
+            return SimpleNamespace(arn="arn:iam:" + name)
+
+        def create_role(name, assume_role_json, policy_arns):
+            self.call(ROLE_SECONDS, created="iam_role")
+            return SimpleNamespace(name=name, arn="arn:iam:" + name)
+
+        def create_lambda_function(name, *args):
+            self.call(FUNCTION_SECONDS, created="lambda_function")
+            return {"FunctionArn": "arn:lambda:" + name}
+
+        def add_subscription(**kwargs):
+            self.call(CALL_SECONDS, created="sns_subscription")
+
+        def update_lambda_code(name, code_bytes):
+            self.call(CALL_SECONDS, created="lambda_code")
+            return {"FunctionArn": "arn:lambda:" + name}
+
+        def update_lambda_configuration(name, environment):
+            self.call(CALL_SECONDS, created="lambda_configuration")
+
+        def deleted(name):
+            return lambda *args: self.call(CALL_SECONDS, deleted=name)
+
+        return {
+            "Dynamodb": SimpleNamespace(
+                create_table=create_table,
+                enable_time_to_live=lambda *args: self.call(CALL_SECONDS),
+                delete_table=lambda table_name: self.call(
+                    CALL_SECONDS, deleted=table_name
+                ),
+            ),
+            "SNS": SimpleNamespace(
+                create_topic=create_topic,
+                add_policy_statement=lambda *args: self.call(CALL_SECONDS),
+                add_subscription=add_subscription,
+                get_topic=lambda arn: SimpleNamespace(arn=arn),
+                delete_topic=deleted("sns_topic"),
+            ),
+            "Pinpoint": SimpleNamespace(
+                create_pinpoint_app=create_pinpoint_app,
+                enable_pinpoint_SMS=lambda *args: self.call(CALL_SECONDS),
+                delete_pinpoint_app=deleted("pinpoint_app"),
+            ),
+            "IAm": SimpleNamespace(
+                create_policy=create_policy,
+                create_role=create_role,
+                get_policy=lambda arn: SimpleNamespace(arn=arn),
+                get_role=lambda name: SimpleNamespace(name=name, arn="arn:iam:" + name),
+                update_policy=lambda policy, policy_json: policy,
+                update_assume_role_policy=lambda role, assume_role_json: role,
+                delete_policy=deleted("iam_policy"),
+                delete_role=deleted("iam_role"),
+            ),
+            "Lambda": SimpleNamespace(
+                create_lambda_function=create_lambda_function,
+                update_lambda_code=update_lambda_code,
+                update_lambda_configuration=update_lambda_configuration,
+                add_permission=lambda **kwargs: self.call(CALL_SECONDS),
+                delete_lambda_function=deleted("lambda_function"),
+            ),
+        }
+
+
+def resource_name(step) -> str:
+    # tables are recorded by table name, everything else by step name
+    names = {
+        "game_table": setup.GAME_STATE_TABLE_NAME,
+        "lock_table": setup.LOCK_TABLE_NAME,
+        "pending_throws_table": setup.PENDING_THROWS_TABLE_NAME,
+        "history_table": setup.GAME_HISTORY_TABLE_NAME,
+    }
+    return names.get(step.name, step.name)
+
+
+def timed_apply(steps: list, state: dict, max_workers: int, timings: dict) -> tuple:
+    start = time.perf_counter()
+    results, actions = util.apply_steps(steps, state, max_workers, timings)
+    changed = {name for name, action in actions.items() if action != "keep"}
+    return time.perf_counter() - start, results, changed
+
+
+def stub_setup(handler_copy: str) -> StubServices:
+    services = StubServices()
+    for name, module in services.modules().items():
+        setattr(setup, name, module)
+    # a copy of the handler file is hashed, but an empty zip is uploaded
+    shutil.copy(HANDLER_FILE_NAME, handler_copy)
+    setup.LAMBDA_MODULE_PATH = [os.path.dirname(handler_copy)]
+    setup.build_lambda_artifact = lambda: util.build_artifact([])
+    return services
+
+
+def run(max_workers: int, handler_copy: str) -> dict:
+    services = stub_setup(handler_copy)
+    steps = setup.deployment_steps()
+    state, timings = {}, {}
+    elapsed, results, _ = timed_apply(steps, state, max_workers, timings)
+    assert set(state) == {step.name for step in steps}
+    # creation order is checked against the first deploy, updates come later
+    started, created = dict(services.started), dict(services.created)
+    # nothing changed, so nothing is called
+    redeploy, _, changed = timed_apply(steps, state, max_workers, {})
+    assert not changed and util.plan_steps(steps, state)["lambda_function"] == "keep"
+    # only the code of the function is updated after the handler changed
+    with open(handler_copy, "a") as file:
+        file.write("# changed\n")
+    assert util.plan_steps(steps, state)["lambda_function"] == "update"
+    code_update, _, changed = timed_apply(steps, state, max_workers, {})
+    assert changed == {"lambda_function"} and "lambda_code" in services.created
+    # and only the configuration after a parameter changed
+    setup.METRICS_NAMESPACE, namespace = "Changed", setup.METRICS_NAMESPACE
+    _, _, changed = timed_apply(steps, state, max_workers, {})
+    setup.METRICS_NAMESPACE = namespace
+    assert changed == {"lambda_configuration"}
+    start = time.perf_counter()
+    util.teardown_steps(steps, results, max_workers)
+    teardown = time.perf_counter() - start
+
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        for need in step.depends_on:
+            # created before the step needing it starts, deleted after it
+            need_created = created.get(resource_name(by_name[need]))
+            if need_created is not None and resource_name(step) in created:
+                assert need_created <= started[resource_name(step)]
+            deleted = services.deleted.get(resource_name(by_name[need]))
+            if deleted is not None and resource_name(step) in services.deleted:
+                assert services.deleted[resource_name(step)] < deleted
+    seconds, path = util.critical_path(steps, timings)
+    return {
+        "deploy_seconds": elapsed,
+        "critical_path_seconds": seconds,
+        "critical_path": path,
+        "redeploy_seconds": redeploy,
+        "code_update_seconds": code_update,
+        "teardown_seconds": teardown,
+    }
+
+
+def check_unused_tables(handler_copy: str) -> None:
+    services = stub_setup(handler_copy)
+    settings = setup.GAME_HISTORY, setup.LOCK_FREE
+    known = list(setup.table_steps().values())
+    setup.DEPLOY_STATE_FILE_NAME = os.path.join(
+        os.path.dirname(handler_copy), ".deploy_state.json"
+    )
+    state = {}
+    util.apply_steps(setup.deployment_steps(), state, 4, known=known)
+    assert "history_table" in state and "lock_table" in state
+
+    # a deploy without history deletes the history table
+    setup.GAME_HISTORY = False
+    steps = setup.deployment_steps()
+    assert util.plan_steps(steps, state, known)["history_table"] == "delete"
+    _, actions = util.apply_steps(steps, state, 4, known=known)
+    assert actions["history_table"] == "delete" and "history_table" not in state
+    assert setup.GAME_HISTORY_TABLE_NAME in services.deleted
+
+    # and teardown deletes the lock table once it is no longer used
+    setup.LOCK_FREE = True
+    util.save_deploy_state(setup.DEPLOY_STATE_FILE_NAME, state)
+    setup.teardown(4)
+    assert setup.LOCK_TABLE_NAME in services.deleted
+    assert not os.path.exists(setup.DEPLOY_STATE_FILE_NAME)
+
+    # what is not known is not deleted, and neither is its record
+    state = {"queue_table": {"id": "rps-queue", "hash": None}}
+    assert util.plan_steps(steps, state, known)["queue_table"] == "orphaned"
+    util.save_deploy_state(setup.DEPLOY_STATE_FILE_NAME, state)
+    try:
+        setup.teardown(4)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("teardown deleted an unknown resource")
+    assert util.load_deploy_state(setup.DEPLOY_STATE_FILE_NAME) == state
+    try:
+        util.apply_steps(steps, state, 4, known=known)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("deploy dropped an unknown resource")
+    setup.GAME_HISTORY, setup.LOCK_FREE = settings
+
+
+if __name__ == "__main__":
+    handler_copy = os.path.join(tempfile.mkdtemp(), HANDLER_FILE_NAME)
+    print("workers  deploy s  critical path s  redeploy s  code update s  teardown s")
+    for workers in [1, setup.DEPLOY_MAX_WORKERS]:
+        result = run(workers, handler_copy)
+        print(
+            f"{workers:>7}  {result['deploy_seconds']:>8.2f}  "
+            f"{result['critical_path_seconds']:>15.2f}  "
+            f"{result['redeploy_seconds']:>10.2f}  "
+            f"{result['code_update_seconds']:>13.2f}  "
+            f"{result['teardown_seconds']:>10.2f}"
+        )
+    # with enough workers nothing waits for a free thread
+    assert result["deploy_seconds"] < result["critical_path_seconds"] + 0.2
+    print("\ncritical path: " + " > ".join(result["critical_path"]))
+    check_unused_tables(handler_copy)
+    print("tables no longer used are deleted by deploy and teardown: ok")
@@ -0,0 +1,48 @@
+#
+# Throughput of the rules engine: determine_winner one game at a time vs.
+# RuleSet.score over millions of encoded throw pairs with NumPy.
+# Run from the repository root:
+#     python -m benchmarks.rules_engine
+#
+import logging
+import random
+import time
+
+import numpy
+
+from benchmarks.local_aws import load_handler
+
+SCALAR_GAMES = 200_000
+VECTOR_GAMES = 10_000_000
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    print("rules          scalar games/s  vector games/s  first/second/tie %")
+    for name in ["classic", "lizard_spock"]:
+        handler = load_handler(GAME_RULES=name)
+        rules = handler.RULES
+
+        pairs = [
+            (random.choice(rules.throws), random.choice(rules.throws))
+            for _ in range(SCALAR_GAMES)
+        ]
+        start = time.perf_counter()
+        for first, second in pairs:
+            handler.determine_winner([first, "A"], [second, "B"])
+        scalar = SCALAR_GAMES / (time.perf_counter() - start)
+
+        generator = numpy.random.default_rng()
+        first = generator.integers(0, len(rules.throws), VECTOR_GAMES, dtype=numpy.int8)
+        second = generator.integers(
+            0, len(rules.throws), VECTOR_GAMES, dtype=numpy.int8
+        )
+        start = time.perf_counter()
+        outcomes = rules.score(first, second)
+        vector = VECTOR_GAMES / (time.perf_counter() - start)
+
+        shares = [numpy.mean(outcomes == value) * 100 for value in (1, -1, 0)]
+        print(
+            f"{name:<13}  {scalar:>14,.0f}  {vector:>14,.0f}  "
+            + "/".join(f"{share:.1f}" for share in shares)
+        )
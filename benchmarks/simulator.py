@@ -0,0 +1,198 @@
+#
+# Bulk tournament / replay simulator for the lambda handler.
+#
+# Generates synthetic inbound texts shaped like test_events/lambda_test_event.json
+# (or replays recorded ones) and feeds them through lambda_handler at a given
+# concurrency, against in-memory DynamoDB and Pinpoint stand-ins. Reports
+# throughput, invocation latency percentiles, lock wait time and games
+# completed per second. This is the regression benchmark for the hot path.
+# Run from the repository root, e.g.:
+#     python -m benchmarks.simulator --players 200 --throws 2000 --concurrency 16
+#     python -m benchmarks.simulator --record events.jsonl
+#     python -m benchmarks.simulator --replay events.jsonl --mode lock-free
+#
+import argparse
+import json
+import logging
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_aws import load_handler
+
+MODES = {
+    "locking": {"LOCKING": True, "LOCK_FREE": False},
+    "no-locking": {"LOCKING": False, "LOCK_FREE": False},
+    "lock-free": {"LOCKING": False, "LOCK_FREE": True},
+    "queue": {"LOCKING": False, "MATCHMAKING_QUEUE": True},
+}
+
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def generate_events(
+    throws: list, players: int, count: int, batch_size: int = 1, seed: int = None
+) -> list:
+    """
+    Build SNS events carrying 'count' texts in total, from 'players' distinct
+    phone numbers, 'batch_size' records per event.
+    """
+    generator = random.Random(seed)
+    numbers = [f"+1800{i:07d}" for i in range(players)]
+    records = [
+        {
+            "Sns": {
+                "MessageId": str(i),
+                "Message": json.dumps(
+                    {
+                        "messageBody": generator.choice(throws),
+                        "originationNumber": generator.choice(numbers),
+                    }
+                ),
+            }
+        }
+        for i in range(count)
+    ]
+    return [
+        {"Records": records[i : i + batch_size]}
+        for i in range(0, len(records), batch_size)
+    ]
+
+
+def instrument_lock_wait(handler) -> list:
+    """
+    Wrap the handler's retry_acquire_lock to record how long each acquisition
+    took. Returns the list the wait times are appended to.
+    """
+    waits = []
+    retry_acquire_lock = handler.retry_acquire_lock
+
+    def timed_retry_acquire_lock(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return retry_acquire_lock(*args, **kwargs)
+        finally:
+            waits.append(time.perf_counter() - start)
+
+    handler.retry_acquire_lock = timed_retry_acquire_lock
+    return waits
+
+
+def run_simulation(handler, events: list, concurrency: int) -> dict:
+    """
+    Feed the events through handler.lambda_handler on 'concurrency' threads.
+    The handler's game state table, lock table and pinpoint client can be any
+    stand-ins, see benchmarks.local_aws.load_handler.
+    """
+    lock_waits = instrument_lock_wait(handler)
+    latencies, failed = [], []
+    mutex = threading.Lock()
+
+    def invoke(event):
+        start = time.perf_counter()
+        response = handler.lambda_handler(event, {})
+        latency = time.perf_counter() - start
+        failures = len(response["batchItemFailures"])
+        with mutex:
+            latencies.append(latency)
+            failed.append(failures)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(invoke, events))
+    elapsed = time.perf_counter() - start
+
+    records = sum(len(event["Records"]) for event in events)
+    games = handler.pinpoint_client.games_reported()
+    db_calls = sum(
+        backend.call_count()
+        for backend in (
+            handler.table,
+            handler.lock_table,
+            handler.pending_table,
+            handler.history_table,
+            handler.dynamodb,
+            handler.redis,
+        )
+    )
+    return {
+        "seconds": elapsed,
+        "invocations": len(events),
+        "records": records,
+        "failed_records": sum(failed),
+        "records_per_second": records / elapsed,
+        "games_per_second": games / elapsed,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p90_ms": percentile(latencies, 0.9) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "lock_wait_mean_ms": statistics.mean(lock_waits) * 1000 if lock_waits else 0,
+        "lock_wait_p99_ms": percentile(lock_waits, 0.99) * 1000,
+        "db_calls_per_record": db_calls / records,
+        "cache_hit_rate": handler.game_state_cache.hits
+        / max(1, handler.game_state_cache.hits + handler.game_state_cache.misses),
+        "sms_requests": handler.pinpoint_client.requests,
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Rock Paper Scissors simulator")
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--throws", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=1, help="records per event")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mode", choices=list(MODES), default="locking")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--rules", default="classic")
+    parser.add_argument(
+        "--store", choices=["dynamodb", "memory", "redis"], default="dynamodb"
+    )
+    parser.add_argument("--db-latency-ms", type=float, default=5)
+    parser.add_argument("--redis-latency-ms", type=float, default=0.5)
+    parser.add_argument("--sms-latency-ms", type=float, default=50)
+    parser.add_argument("--cache-ttl-seconds", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--record", help="write the generated events to this file")
+    parser.add_argument("--replay", help="replay events from this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    arguments = parse_arguments()
+    handler = load_handler(
+        db_latency_seconds=arguments.db_latency_ms / 1000,
+        sms_latency_seconds=arguments.sms_latency_ms / 1000,
+        redis_latency_seconds=arguments.redis_latency_ms / 1000,
+        GAME_STATE_STORE=arguments.store,
+        GAME_STATE_CACHE_TTL_SECONDS=arguments.cache_ttl_seconds,
+        GAME_RULES=arguments.rules,
+        MATCHMAKING_SHARDS=arguments.shards,
+        **MODES[arguments.mode],
+    )
+
+    if arguments.replay:
+        # one event per line
+        with open(arguments.replay) as file:
+            events = [json.loads(line) for line in file]
+    else:
+        events = generate_events(
+            handler.THROWS,
+            arguments.players,
+            arguments.throws,
+            arguments.batch_size,
+            arguments.seed,
+        )
+    if arguments.record:
+        with open(arguments.record, "w") as file:
+            file.writelines(json.dumps(event) + "\n" for event in events)
+
+    result = run_simulation(handler, events, arguments.concurrency)
+    for name, value in result.items():
+        print(f"{name:<20} {value:>12,.2f}")
@@ -0,0 +1,86 @@
+#
+# Wall-clock time of flushing an outbox that needs several Pinpoint requests,
+# sending them one at a time vs. on the handler's bounded thread pool. Checks
+# first that a player queued the same text twice receives it twice, and that
+# a request failing with an error other than a ClientError is not raised.
+# Run from the repository root:
+#     python -m benchmarks.sms_fanout
+#
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_aws import load_handler, sms_event
+
+SMS_LATENCY_SECONDS = 0.1
+# 100 numbers fit in one request, so this is 10 requests
+RECIPIENTS = 1000
+
+
+def run(workers: int, deadline_seconds: float = None) -> dict:
+    handler = load_handler(sms_latency_seconds=SMS_LATENCY_SECONDS)
+    if workers is not None:
+        handler.sms_executor = ThreadPoolExecutor(max_workers=workers)
+    outbox = handler.Outbox()
+    for i in range(RECIPIENTS):
+        outbox.add([f"+1800{i:07d}"], f"ROCK PAPER SCISSORS:\nmessage {i}")
+
+    start = time.perf_counter()
+    deadline = None if deadline_seconds is None else time.monotonic() + deadline_seconds
+    results = outbox.flush(deadline)
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "requests": handler.pinpoint_client.requests,
+        "delivered": sum(1 for _, _, status in results if status == "SUCCESSFUL"),
+    }
+
+
+def check_repeated_messages() -> None:
+    # the winner of two games in one batch gets the same result text twice
+    handler = load_handler()
+    outbox = handler.Outbox()
+    body = "ROCK PAPER SCISSORS:\n+18001111111 wins."
+    outbox.add(["+18001111111", "+18002222222"], body)
+    outbox.add(["+18001111111", "+18003333333"], body)
+    results = outbox.flush()
+    assert len(results) == 4 and handler.pinpoint_client.requests == 2
+    assert handler.pinpoint_client.sent.count(("+18001111111", body)) == 2
+
+
+class UnreachablePinpointClient:
+    def send_messages(self, **kwargs):
+        raise ConnectionError("Pinpoint is unreachable")
+
+
+def check_send_errors() -> None:
+    # the texts are reported as failed, the invocation still succeeds
+    handler = load_handler()
+    outbox = handler.Outbox()
+    outbox.add(["+18001111111", "+18002222222"], "ROCK PAPER SCISSORS:\nmessage")
+    handler.clients.instances["pinpoint"] = UnreachablePinpointClient()
+    results = outbox.flush()
+    assert [status for _, _, status in results] == [None, None]
+    event = sms_event("test", "+18001111111")
+    assert handler.lambda_handler(event, {})["statusCode"] == 200
+
+
+if __name__ == "__main__":
+    logging.disable(logging.ERROR)
+    check_repeated_messages()
+    check_send_errors()
+    print(
+        f"{RECIPIENTS} recipients, {SMS_LATENCY_SECONDS * 1000:.0f}ms "
+        "per Pinpoint request\n"
+    )
+    print("workers          seconds  requests  delivered")
+    for name, workers, deadline in [
+        ("1", 1, None),
+        ("default", None, None),
+        ("default, 50ms", None, 0.05),
+    ]:
+        result = run(workers, deadline)
+        print(
+            f"{name:<15}  {result['seconds']:>7.2f}  {result['requests']:>8}  "
+            f"{result['delivered']:>9}"
+        )
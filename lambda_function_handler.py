@@ -1,242 +1,2597 @@
+import time
+
+# import time is the start of a cold start, see IMPORT_SECONDS.
+IMPORT_STARTED = time.perf_counter()
+
 import logging
+import os
 import boto3
+import contextvars
+import functools
 import uuid
-import time
 import json
-import datetime
+import bisect
+import random
+import sys
+import threading
+import zlib
+from typing import NamedTuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from decimal import Decimal
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.conditions import Attr, Key, ConditionExpressionBuilder
+
+logging.getLogger().setLevel(logging.INFO)
+# the handler's own logger, which alone is turned up to DEBUG in sampled
+# invocations. boto3, botocore and urllib3 stay at INFO through the root
+# logger, their DEBUG output has request headers and credentials in it.
+logger = logging.getLogger(__name__)
+
+
+### Configuration ##################################################
+class Config(NamedTuple):
+    """
+    Settings of the lambda function, see setup.py for what each one does.
+    setup.py sets them as environment variables on the function, named like
+    the fields in upper case. They are parsed once per container, at cold
+    start, into the module's config. A variable that is not set keeps the
+    default given here.
+    """
+
+    pinpoint_app_id: str = ""
+    game_state_table_name: str = "game_state"
+    dynamodb_layer: str = "client"
+    game_state_store: str = "dynamodb"
+    redis_url: str = "redis://localhost:6379/0"
+    idempotency: bool = True
+    idempotency_ttl_seconds: int = 6 * 60 * 60
+    idempotency_cache_max_entries: int = 1024
+    game_state_cache_ttl_seconds: float = 60
+    game_state_cache_max_entries: int = 128
+    game_history: bool = True
+    game_history_table_name: str = "game_history"
+    game_rules: str = "classic"
+    locking: bool = True
+    lock_free: bool = False
+    matchmaking_shards: int = 1
+    matchmaking_shard_strategy: str = "random"
+    matchmaking_queue: bool = False
+    matchmaking_queue_scan_limit: int = 10
+    pending_throws_table_name: str = "pending_throws"
+    lock_table_name: str = "lock_table"
+    lock_expiration_time_ms: int = 2000
+    lock_heartbeat: bool = True
+    lock_retry_backoff_multiplier: float = 2
+    initial_lock_wait_seconds: float = 0.05
+    max_lock_wait_seconds: float = 6
+    max_lock_retry_delay_seconds: float = 0.5
+    lock_retry_policy: str = "full_jitter"
+    log_debug_sample_rate: float = 0.01
+    metrics_namespace: str = "RockPaperScissors"
+
+    @classmethod
+    def from_environment(cls, environ) -> "Config":
+        """
+        Build the config from the variables of environ, a dict of strings.
+        Raises ValueError naming the variable if one does not parse.
+        """
+        settings = {}
+        for field, kind in cls.__annotations__.items():
+            name = field.upper()
+            if name not in environ:
+                continue
+            try:
+                settings[field] = parse_setting(environ[name], kind)
+            except ValueError:
+                raise ValueError(
+                    f"{name}={environ[name]!r} is not a valid {kind.__name__}"
+                )
+        return cls(**settings)
+
+
+def parse_setting(text: str, kind: type):
+    # environment variables are strings, bool accepts true/false in any case
+    if kind is bool:
+        if text.lower() in ("true", "1"):
+            return True
+        if text.lower() in ("false", "0"):
+            return False
+        raise ValueError(text)
+    return kind(text)
+
+
+config = Config.from_environment(os.environ)
+
+
+### AWS clients ####################################################
+class ClientRegistry:
+    """
+    Creates boto3 clients and resources on first use and caches them for the
+    life of the container. Warm invocations reuse them, and an invocation
+    that never touches a service never pays for creating its client.
+    The time taken to create each one is recorded in init_seconds, and
+    reported by the invocation that created it.
+    """
+
+    def __init__(self):
+        self.instances = {}
+        self.init_seconds = {}
+        # reentrant, factories may get the instances they are built from
+        self._mutex = threading.RLock()
+
+    def get(self, name: str, factory):
+        """
+        Return the cached instance called name, calling factory() to create
+        it if this is the first use.
+        """
+        try:
+            return self.instances[name]
+        except KeyError:
+            pass
+        with self._mutex:
+            # another thread may have created it while we waited
+            if name not in self.instances:
+                start = time.perf_counter()
+                self.instances[name] = factory()
+                self.init_seconds[name] = time.perf_counter() - start
+                logger.debug(
+                    "Created %s in %.1fms", name, self.init_seconds[name] * 1000
+                )
+                client_created(name, self.init_seconds[name])
+            return self.instances[name]
+
+
+clients = ClientRegistry()
+
+
+def get_dynamodb_resource():
+    return clients.get("dynamodb", lambda: boto3.resource("dynamodb"))
+
+
+def get_dynamodb_client():
+    return clients.get("dynamodb_client", lambda: boto3.client("dynamodb"))
+
+
+def make_table(table_name: str):
+    """
+    Build a table object for the DYNAMODB_LAYER configured in setup.py:
+    a boto3 resource Table, or a ClientTable with the same methods on top of
+    the low-level client.
+    """
+    if config.dynamodb_layer == "client":
+        return ClientTable(get_dynamodb_client(), table_name)
+    return get_dynamodb_resource().Table(table_name)
+
+
+def get_game_state_table():
+    return clients.get(
+        "game_state_table", lambda: make_table(config.game_state_table_name)
+    )
+
+
+def get_history_table():
+    return clients.get(
+        "history_table", lambda: make_table(config.game_history_table_name)
+    )
+
+
+def get_pending_throws_table():
+    return clients.get(
+        "pending_throws_table", lambda: make_table(config.pending_throws_table_name)
+    )
+
+
+def get_pinpoint_client():
+    return clients.get("pinpoint", lambda: boto3.client("pinpoint"))
+
+
+def connect_redis():
+    # imported here, the redis package is only deployed with GAME_STATE_STORE "redis"
+    import redis
+
+    return redis.Redis.from_url(config.redis_url, decode_responses=True)
+
+
+def get_redis_client():
+    return clients.get("redis", connect_redis)
+
+
+### Instrumentation ################################################
+# the most durations kept per operation, and values per metric, in one
+# invocation's documents. EMF takes up to 100 values of a metric.
+MAX_TIMING_SAMPLES = 100
+# CloudWatch units of the metrics an invocation can report. GamesCompleted is
+# reported by every invocation, the others only once they have a value.
+METRIC_UNITS = {
+    "GamesCompleted": "Count",
+    "LockAttempts": "Count",
+    "LockWaitMs": "Milliseconds",
+    "LockHoldMs": "Milliseconds",
+    "LockAcquireFailures": "Count",
+    "LockReleaseFailures": "Count",
+    "SmsSendFailures": "Count",
+    "DuplicateMessages": "Count",
+    "LatencyMs": "Milliseconds",
+}
+# the game state mode, the dimension every metric is reported under
+if config.matchmaking_queue:
+    GAME_MODE = "queue"
+elif config.lock_free:
+    GAME_MODE = "lock-free"
+else:
+    GAME_MODE = "locking" if config.locking else "no-locking"
+
+# metrics are written to stdout as they are, without the lambda log prefix,
+# since CloudWatch only extracts them from log events that are pure JSON.
+metrics_logger = logging.getLogger("metrics")
+metrics_logger.propagate = False
+metrics_logger.setLevel(logging.INFO)
+if not metrics_logger.handlers:
+    metrics_handler = logging.StreamHandler(sys.stdout)
+    metrics_handler.setFormatter(logging.Formatter("%(message)s"))
+    metrics_logger.addHandler(metrics_handler)
+
+
+class InvocationLog:
+    """
+    What one invocation did, written out once when it ends (see
+    lambda_handler) rather than a line per call: CloudWatch metrics in
+    Embedded Metric Format, including the duration of every timed call as a
+    LatencyMs metric per operation. Per-call detail is logged at DEBUG, for a
+    LOG_DEBUG_SAMPLE_RATE sample of invocations only. Timed calls can come
+    from other threads.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # operation -> durations in ms, in call order
+        self.timings = {}
+        # metric -> a total, or a list of values for observed metrics
+        self.metrics = {"GamesCompleted": 0}
+        # Pinpoint delivery status -> messages not delivered
+        self.send_failures = {}
+        # client name -> ms taken to create it, for those this one created
+        self.client_init_ms = {}
+        self._mutex = threading.Lock()
+
+    def add_timing(self, operation: str, seconds: float) -> None:
+        with self._mutex:
+            samples = self.timings.setdefault(operation, [])
+            if len(samples) < MAX_TIMING_SAMPLES:
+                samples.append(round(seconds * 1000, 3))
+
+    def count(self, metric: str, amount: int = 1) -> None:
+        with self._mutex:
+            self.metrics[metric] = self.metrics.get(metric, 0) + amount
+
+    def observe(self, metric: str, value: float) -> None:
+        # EMF takes up to 100 values of a metric per document
+        with self._mutex:
+            values = self.metrics.setdefault(metric, [])
+            if len(values) < MAX_TIMING_SAMPLES:
+                values.append(value)
+
+    def client_created(self, name: str, seconds: float) -> None:
+        # also timed as the "client.<name>" operation, so it is a metric too
+        with self._mutex:
+            self.client_init_ms[name] = round(seconds * 1000, 3)
+        self.add_timing("client." + name, seconds)
+
+    def send_failed(self, status: str, amount: int = 1) -> None:
+        with self._mutex:
+            self.send_failures[status] = self.send_failures.get(status, 0) + amount
+
+    def documents(self, **properties) -> list:
+        """
+        The EMF documents of the invocation: one with every metric and the
+        given properties, then one per Pinpoint status that messages failed
+        with and one per timed operation, since each holds a single value of
+        the DeliveryStatus or Operation dimension.
+        """
+        timestamp = ms_timestamp()
+        properties["duration_ms"] = round(
+            (time.perf_counter() - self.started) * 1000, 3
+        )
+        document = emf_document(timestamp, {"Mode": GAME_MODE}, self.metrics)
+        document.update(properties)
+        documents = [document]
+        for status, failures in sorted(self.send_failures.items()):
+            document = emf_document(
+                timestamp,
+                {"Mode": GAME_MODE, "DeliveryStatus": status},
+                {"SmsSendFailures": failures},
+            )
+            document["request_id"] = properties.get("request_id")
+            documents.append(document)
+        for operation, durations in sorted(self.timings.items()):
+            document = emf_document(
+                timestamp,
+                {"Mode": GAME_MODE, "Operation": operation},
+                {"LatencyMs": durations},
+            )
+            document["request_id"] = properties.get("request_id")
+            documents.append(document)
+        return documents
+
+    def flush(self, **properties) -> None:
+        # write every document of the invocation at once
+        if metrics_logger.isEnabledFor(logging.INFO):
+            metrics_logger.info(
+                "%s", "\n".join(map(json.dumps, self.documents(**properties)))
+            )
+
+
+def emf_document(timestamp: int, dimensions: dict, metrics: dict) -> dict:
+    # a CloudWatch Embedded Metric Format document reporting the metrics
+    document = {
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": config.metrics_namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [
+                        {"Name": name, "Unit": METRIC_UNITS[name]} for name in metrics
+                    ],
+                }
+            ],
+        }
+    }
+    document.update(dimensions)
+    document.update(metrics)
+    return document
+
+
+# the InvocationLog of the invocation running in this context, None outside one
+current_invocation = contextvars.ContextVar("current_invocation", default=None)
+
+
+def timed(operation: str):
+    """
+    Decorator recording the duration of every call of the function in the
+    current InvocationLog under the operation name. Costs one ContextVar
+    lookup when called outside an invocation.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            invocation = current_invocation.get()
+            if invocation is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                invocation.add_timing(operation, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def count(metric: str, amount: int = 1) -> None:
+    # add to a metric of the current InvocationLog, if any
+    invocation = current_invocation.get()
+    if invocation is not None:
+        invocation.count(metric, amount)
+
+
+def observe(metric: str, value: float) -> None:
+    # record a value of a metric in the current InvocationLog, if any
+    invocation = current_invocation.get()
+    if invocation is not None:
+        invocation.observe(metric, value)
+
+
+def client_created(name: str, seconds: float) -> None:
+    # report a client created by the current invocation, if any
+    invocation = current_invocation.get()
+    if invocation is not None:
+        invocation.client_created(name, seconds)
+
+
+def count_send_failure(status: str, amount: int = 1) -> None:
+    # count messages Pinpoint did not deliver, by delivery status
+    invocation = current_invocation.get()
+    if invocation is not None:
+        invocation.send_failed(status, amount)
+
+
+def in_current_context(function):
+    # function bound to a copy of the calling context, so calls timed on
+    # another thread are recorded in the calling invocation's log
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def lambda_handler(event, context):
+    global cold_start
+    was_cold_start, cold_start = cold_start, False
+    # per-call detail is only logged for a sample of invocations
+    debug_sampled = random.random() < config.log_debug_sample_rate
+    logger.setLevel(logging.DEBUG if debug_sampled else logging.INFO)
+
+    invocation = InvocationLog()
+    token = current_invocation.set(invocation)
+    try:
+        response = process_event(event, context)
+    except Exception:
+        # not an SNS event at all. The metrics are still written.
+        logger.exception("Failed to process event")
+        response = {"statusCode": 500, "records": [], "batchItemFailures": []}
+    finally:
+        current_invocation.reset(token)
+    invocation.flush(
+        request_id=getattr(context, "aws_request_id", None),
+        cold_start=was_cold_start,
+        import_ms=round(IMPORT_SECONDS * 1000, 3) if was_cold_start else None,
+        client_init_ms=invocation.client_init_ms or None,
+        debug_sampled=debug_sampled,
+        records=len(response["records"]),
+        failed_records=len(response["batchItemFailures"]),
+    )
+    return response
+
+
+def process_event(event, context) -> dict:
+    logger.debug("Event: %s", event)
+    # SNS may deliver several texts in one invocation. Every record gets its
+    # own result so one bad message does not fail the whole batch.
+    records = event["Records"]
+    results = [None] * len(records)
+    throws = []
+    # record index -> dedupe id of the throws claimed by this invocation
+    claimed = {}
+    claim_expires = message_claim_expiry(context)
+    # texts are only sent once all game state work (and locking) is done
+    outbox = Outbox()
+    for index, record in enumerate(records):
+        message_id = str(index)
+        # grab the event from pinpoint
+        try:
+            message_id = record["Sns"].get("MessageId", message_id)
+            pinpointEvent = json.loads(record["Sns"]["Message"])
+            msg_txt = pinpointEvent["messageBody"].lower().strip()
+            fromNumber = pinpointEvent["originationNumber"]
+        except Exception:
+            logger.exception("Unreadable record %s", message_id)
+            results[index] = record_result(message_id, False)
+            continue
+
+        if msg_txt not in THROWS:
+            # other texts change no game state, a redelivery is answered again
+            try:
+                process_msg(msg_txt, fromNumber, outbox)
+            except Exception:
+                logger.exception("Failed to process record %s", message_id)
+                results[index] = record_result(message_id, False)
+            else:
+                results[index] = record_result(message_id, True)
+            continue
+
+        # a redelivered throw is acknowledged without being played again
+        dedupe_id = message_dedupe_id(record, pinpointEvent)
+        try:
+            duplicate = dedupe_id is not None and not claim_message(
+                dedupe_id, claim_expires
+            )
+        except Exception:
+            logger.exception("Failed to check for redelivery of %s", dedupe_id)
+            results[index] = record_result(message_id, False)
+            continue
+        if duplicate:
+            logger.info("Skipped redelivered message %s", dedupe_id)
+            count("DuplicateMessages")
+            results[index] = record_result(message_id, True)
+            continue
+        if dedupe_id is not None:
+            claimed[index] = dedupe_id
+        # throws are held back so they can be paired with each other
+        throws.append((index, message_id, msg_txt, fromNumber))
+
+    for index, message_id, succeeded in process_throws(throws, outbox):
+        results[index] = record_result(message_id, succeeded)
+    # the claims of played throws are kept, failed ones will be redelivered
+    # and must be played then
+    for index, dedupe_id in claimed.items():
+        try:
+            if results[index]["statusCode"] == 200:
+                complete_message(dedupe_id)
+            else:
+                release_message(dedupe_id)
+        except Exception:
+            logger.exception("Failed to settle the claim of message %s", dedupe_id)
+    outbox.flush(invocation_deadline(context))
+
+    failures = [r for r in results if r["statusCode"] != 200]
+    return {
+        # the invocation only fails outright if no record could be processed
+        "statusCode": 500 if records and len(failures) == len(results) else 200,
+        "records": results,
+        "batchItemFailures": [{"itemIdentifier": r["messageId"]} for r in failures],
+    }
+
+
+def record_result(message_id: str, succeeded: bool) -> dict:
+    return {"messageId": message_id, "statusCode": 200 if succeeded else 500}
+
+
+def invocation_deadline(context) -> float:
+    """
+    Return the time.monotonic() value by which outbound work has to finish,
+    leaving INVOCATION_DEADLINE_MARGIN_MS before Lambda times the invocation
+    out. Returns None when not running in Lambda (no remaining time to read).
+    """
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    remaining_ms = context.get_remaining_time_in_millis()
+    return (
+        time.monotonic() + max(0, remaining_ms - INVOCATION_DEADLINE_MARGIN_MS) / 1000
+    )
+
+
+### Game rules #####################################################
+class RuleSet:
+    """
+    A game variant. Throws are encoded as small ints, their position in
+    'throws', and outcomes[a][b] is precomputed for every pair of codes:
+    1 if throw a beats throw b, -1 if it loses to it and 0 for a tie.
+    """
+
+    def __init__(self, name: str, beats: dict):
+        """
+        :param beats: dict of each throw to the list of throws it beats
+        """
+        self.name = name
+        self.throws = list(beats)
+        self.codes = {throw: code for code, throw in enumerate(self.throws)}
+        self.outcomes = [[0] * len(self.throws) for _ in self.throws]
+        for winner, losers in beats.items():
+            for loser in losers:
+                self.outcomes[self.codes[winner]][self.codes[loser]] = 1
+                self.outcomes[self.codes[loser]][self.codes[winner]] = -1
+        self._outcome_array = None
+
+    def outcome(self, first_throw: str, second_throw: str) -> int:
+        return self.outcomes[self.codes[first_throw]][self.codes[second_throw]]
+
+    def score(self, first_codes, second_codes):
+        """
+        Vectorised outcome of many games at once: takes two equal length
+        arrays of throw codes and returns a numpy int8 array of outcomes.
+        NumPy is only needed (and imported) here, not in the Lambda.
+        """
+        import numpy
+
+        if self._outcome_array is None:
+            self._outcome_array = numpy.array(self.outcomes, dtype=numpy.int8)
+        return self._outcome_array[
+            numpy.asarray(first_codes, dtype=numpy.intp),
+            numpy.asarray(second_codes, dtype=numpy.intp),
+        ]
+
+
+RULE_SETS = {
+    "classic": RuleSet(
+        "classic", {"rock": ["scissors"], "paper": ["rock"], "scissors": ["paper"]}
+    ),
+    "lizard_spock": RuleSet(
+        "lizard_spock",
+        {
+            "rock": ["scissors", "lizard"],
+            "paper": ["rock", "spock"],
+            "scissors": ["paper", "lizard"],
+            "lizard": ["spock", "paper"],
+            "spock": ["scissors", "rock"],
+        },
+    ),
+}
+
+RULES = RULE_SETS[config.game_rules]
+THROWS = RULES.throws
+
+
+class GameResult(NamedTuple):
+    first_number: str
+    first_throw: str
+    second_number: str
+    second_throw: str
+    # 1 if the first player won, -1 if the second did, 0 for a tie
+    outcome: int
+
+    @property
+    def winner(self) -> str:
+        if self.outcome == 0:
+            return None
+        return self.first_number if self.outcome > 0 else self.second_number
+
+
+def play_game(first_throw, second_throw, rules: RuleSet = None) -> GameResult:
+    """
+    input parameters are each a list with contents: ["throw", "phone_number"]
+    Raises KeyError for a throw that is not part of the rules.
+    """
+    rules = rules or RULES
+    outcome = rules.outcome(first_throw[0], second_throw[0])
+    return GameResult(
+        first_throw[1], first_throw[0], second_throw[1], second_throw[0], outcome
+    )
+
+
+def format_result(result: GameResult) -> str:
+    if result.winner is None:
+        return "Tie! No winner"
+    return result.winner + " wins."
+
+
+### Rock Paper Scissors methods ####################################
+def process_msg(msg, number, outbox) -> None:
+    """
+    Process the incoming message
+    :param msg: a list consisting of [message text, phone number], both strings
+    :param outbox: Outbox collecting the replies to send
+    """
+    if msg in THROWS:
+        process_throw(msg, number, outbox)
+    elif msg == "test":
+        outbox.add([number], "ROCK PAPER SCISSORS:\nYour RPS game is up and running.")
+    elif msg == "stats" and config.game_history:
+        outbox.add([number], "ROCK PAPER SCISSORS:\n" + format_stats(number))
+    elif msg == "history" and config.game_history:
+        outbox.add([number], "ROCK PAPER SCISSORS:\n" + format_history(number))
+    elif msg == "top" and config.game_history:
+        outbox.add([number], "ROCK PAPER SCISSORS:\n" + format_leaders())
+    else:
+        outbox.add(
+            [number], f"ROCK PAPER SCISSORS:\nUnable to process input ... try again."
+        )
+        logger.error("Unable to process input: %s", msg)
+
+
+def process_throw(current_throw, current_number, outbox) -> None:
+    # match against (or become) the stored opponent of one matchmaking shard
+    shard = choose_shard(current_number)
+    if config.matchmaking_queue:
+        process_throw_queued(current_throw, current_number, outbox, shard)
+    elif config.lock_free:
+        process_throw_lock_free(current_throw, current_number, outbox, shard)
+    elif config.locking:
+        process_throw_with_locking(current_throw, current_number, outbox, shard)
+    else:
+        process_throw_without_locking(current_throw, current_number, outbox, shard)
+
+
+def process_throws(throws: list, outbox) -> list:
+    """
+    Resolve all throws received in one invocation.
+
+    :param throws: list of (index, message_id, throw, phone_number) tuples in
+    arrival order
+    :param outbox: Outbox collecting the replies to send
+    :return: list of (index, message_id, succeeded) tuples
+
+    Throws are paired with each other in memory, each with the earliest
+    unpaired throw of another player, so a batch only touches the game state
+    (and the lock) for the throws left over: one when the count is odd, more
+    when a player sent several.
+    """
+    results = []
+    pairs, unpaired = [], []
+    for throw in throws:
+        for waiting in unpaired:
+            if waiting[3] != throw[3]:
+                unpaired.remove(waiting)
+                pairs.append((waiting, throw))
+                break
+        else:
+            unpaired.append(throw)
+
+    for first, second in pairs:
+        try:
+            complete_game(first[2], first[3], second[2], second[3], outbox)
+        except Exception:
+            logger.exception("Failed to play %s against %s", first[3], second[3])
+            succeeded = False
+        else:
+            succeeded = True
+        results.append((first[0], first[1], succeeded))
+        results.append((second[0], second[1], succeeded))
+
+    for index, message_id, throw, number in unpaired:
+        try:
+            process_throw(throw, number, outbox)
+        except Exception:
+            logger.exception("Failed to process throw of %s", number)
+            results.append((index, message_id, False))
+        else:
+            results.append((index, message_id, True))
+    return results
+
+
+def complete_game(
+    opponent_throw, opponent_number, current_throw, current_number, outbox
+):
+    """
+    Determine the winner of a game, record it and queue the result for both
+    players.
+    :return: the GameResult
+    """
+    result = play_game(
+        [opponent_throw, opponent_number], [current_throw, current_number]
+    )
+    announce_result(result, outbox)
+    if config.game_history:
+        record_game(result)
+    return result
+
+
+def announce_result(result: GameResult, outbox) -> None:
+    count("GamesCompleted")
+    winner_message = format_result(result)
+    outbox.add(
+        [result.first_number, result.second_number],
+        "ROCK PAPER SCISSORS:\n" + winner_message,
+    )
+    logger.debug("Game completed: %s", winner_message)
+
+
+class FailedToAcquireLock(Exception):
+    pass
+
+
+class FailedToReleaseLock(Exception):
+    pass
+
+
+class FailedToClaimOpponentSlot(Exception):
+    pass
+
+
+class StaleFencingToken(Exception):
+    pass
+
+
+class StaleCacheEntry(Exception):
+    # a versioned write found the cached item out of date; holds the current one
+    def __init__(self, item: dict):
+        super().__init__(item)
+        self.item = item
+
+
+def process_throw_with_locking(current_throw, current_number, outbox, shard=0):
+    """
+    Given a throw and a number it belongs to (both strings),
+    determine the winner or store throw in the given matchmaking shard.
+    """
+    state_key, lock_name = shard_names(shard)
+    self_id = str(uuid.uuid4())
+    # acquire lock to prevent other lambda functions from messing with the game
+    # state while processing throw. Keep trying for exponential retry time.
+    fencing_token = retry_acquire_lock(lock_name, self_id)
+    if fencing_token:
+        acquired = time.perf_counter()
+        try:
+            # keep the lease alive while the game state is being worked on
+            with LockHeartbeat(lock_name, self_id, fencing_token):
+                # the game state comes from this container's cache when it has it
+                opponent = get_cached_item({"state": state_key})
+                try:
+                    result = settle_throw(
+                        opponent,
+                        state_key,
+                        fencing_token,
+                        current_throw,
+                        current_number,
+                    )
+                except StaleCacheEntry as stale:
+                    # another container changed the game state since it was
+                    # cached, try once more with the current one.
+                    opponent = stale.item
+                    result = settle_throw(
+                        opponent,
+                        state_key,
+                        fencing_token,
+                        current_throw,
+                        current_number,
+                    )
+                if result:
+                    # text players
+                    announce_result(result, outbox)
+                elif own_throw_pending(opponent, current_number):
+                    outbox.add(
+                        [current_number],
+                        "ROCK PAPER SCISSORS:\nYou already have a throw waiting.",
+                    )
+                else:
+                    # notify the player the game is waiting for another throw
+                    outbox.add(
+                        [current_number],
+                        "ROCK PAPER SCISSORS:\nWaiting for opponent...",
+                    )
+        finally:
+            # release the lock, also when the game state work failed, so the
+            # next throw does not wait for the lease to expire.
+            lock_released = release_lock(lock_name, self_id)
+            observe("LockHoldMs", round((time.perf_counter() - acquired) * 1000, 3))
+        if result and config.game_history:
+            # outside the game's transaction, and once the lock is released
+            update_leaderboard(result)
+        if lock_released:
+            pass
+        else:
+            logger.error("Failed to release lock %s", self_id)
+            raise FailedToReleaseLock
+    else:
+        # under normal circumstances acquire lock is very unlikely to fail.
+        logger.exception("Failed to acquire lock %s", self_id)
+        raise FailedToAcquireLock
+
+
+def settle_throw(opponent, state_key, fencing_token, current_throw, current_number):
+    """
+    With the lock held, play the current throw against the opponent slot item
+    (None if there is none) and write the new game state.
+    :return: the GameResult, or None if the throw was stored to wait instead,
+    or was rejected because the slot holds this player's own throw.
+    Raises StaleCacheEntry if opponent was not the stored item.
+    """
+    if own_throw_pending(opponent, current_number):
+        # the rejection writes nothing, so unlike the writes below it would not
+        # find out a stale cached slot. It is only made on the stored one.
+        current = refresh_cached_item({"state": state_key}, opponent)
+        if item_version(current) != item_version(opponent):
+            raise StaleCacheEntry(current)
+        return None
+    # the slot left behind by a finished game only holds a fencing token
+    if opponent and "throw" in opponent:
+        # determine the winner
+        result = play_game(
+            [opponent["throw"], opponent["phone_number"]],
+            [current_throw, current_number],
+        )
+        # clear the game state for next round. The write is fenced, so
+        # it fails if our lease expired and a newer holder took over,
+        # and players are only texted once the game state is consistent.
+        # The game's history is written in the same transaction, where
+        # the game state store allows it, or after it if that fails.
+        put_cached_item(
+            {"state": state_key},
+            fencing_token,
+            item_version(opponent),
+            game_writes(result) if config.game_history else None,
+        )
+        return result
+    # otherwise there is no previous game state stored.
+    # therefore store the new game state.
+    put_cached_item(
+        {
+            "state": state_key,
+            "throw": current_throw,
+            "phone_number": current_number,
+        },
+        fencing_token,
+        item_version(opponent),
+    )
+    return None
+
+
+def own_throw_pending(opponent: dict, current_number: str) -> bool:
+    # whether the opponent slot holds a throw of the current player, who
+    # cannot play themselves. Their new throw is rejected instead.
+    return bool(opponent) and opponent.get("phone_number") == current_number
+
+
+def process_throw_without_locking(current_throw, current_number, outbox, shard=0):
+    # same as above but without locking.
+    state_key, _ = shard_names(shard)
+    opponent = get_item({"state": state_key})
+
+    if own_throw_pending(opponent, current_number):
+        outbox.add(
+            [current_number], "ROCK PAPER SCISSORS:\nYou already have a throw waiting."
+        )
+    elif opponent:
+        complete_game(
+            opponent["throw"],
+            opponent["phone_number"],
+            current_throw,
+            current_number,
+            outbox,
+        )
+        delete_item({"state": state_key})
+    else:
+        put_item(
+            {
+                "state": state_key,
+                "throw": current_throw,
+                "phone_number": current_number,
+            }
+        )
+        outbox.add([current_number], "ROCK PAPER SCISSORS:\nWaiting for opponent...")
+
+
+def process_throw_lock_free(current_throw, current_number, outbox, shard=0):
+    """
+    Same outcome as process_throw_with_locking, but mutual exclusion comes from
+    atomic single-item writes on the game state instead of a lock table.
+
+    A delete returning the old item claims a stored opponent: only one
+    concurrent delete can get it back, and it is conditional on the opponent
+    being another player. If there was no opponent, a put conditional on the
+    slot still being empty stores the throw. If that put loses to another
+    throw, the slot now holds an opponent, so try again.
+    This is one round trip to finish a game and two to start one.
+    """
+    state_key, _ = shard_names(shard)
+    start = time.time()
+    while time.time() - start < config.max_lock_wait_seconds:
+        opponent = claim_item({"state": state_key}, unless_number=current_number)
+        if opponent:
+            complete_game(
+                opponent["throw"],
+                opponent["phone_number"],
+                current_throw,
+                current_number,
+                outbox,
+            )
+            return
+
+        stored = put_item_if_absent(
+            {
+                "state": state_key,
+                "throw": current_throw,
+                "phone_number": current_number,
+            },
+            "state",
+        )
+        if stored:
+            outbox.add(
+                [current_number], "ROCK PAPER SCISSORS:\nWaiting for opponent..."
+            )
+            return
+        # the slot was taken by a throw that arrived meanwhile, or holds this
+        # player's own
+        if own_throw_pending(get_item({"state": state_key}), current_number):
+            outbox.add(
+                [current_number],
+                "ROCK PAPER SCISSORS:\nYou already have a throw waiting.",
+            )
+            return
+        logger.debug("Opponent slot %s filled concurrently, retrying.", state_key)
+
+    logger.error("Failed to claim opponent slot %s", state_key)
+    raise FailedToClaimOpponentSlot
+
+
+def process_throw_queued(current_throw, current_number, outbox, shard=0):
+    """
+    Match the throw against the oldest pending throw of another player in the
+    shard's queue, or add it to the queue to wait. A player can have any
+    number of throws waiting, each one its own game.
+
+    Claiming an opponent is atomic, so no lock is needed, and only the oldest
+    MATCHMAKING_QUEUE_SCAN_LIMIT pending throws are looked at, so the cost of a
+    throw does not grow with the backlog.
+
+    Two throws arriving at an empty queue together both find nothing to claim,
+    so a throw that was added looks once more, for a throw of another player
+    added before it. The later of the two finds the earlier one, and takes
+    its own entry back to play it. If its entry was claimed in the meantime,
+    it is already in that game, and the opponent it found goes back into the
+    queue in its place. Arrivals in the same millisecond are in random order,
+    so two throws that close together can still both wait.
+    """
+    queue, _ = shard_names(shard)
+    opponent = claim_pending_throw(queue, current_number)
+    if not opponent:
+        entry = add_pending_throw(queue, current_throw, current_number)
+        opponent = claim_pending_throw(queue, current_number, entry["arrival"])
+        if not opponent:
+            outbox.add(
+                [current_number], "ROCK PAPER SCISSORS:\nWaiting for opponent..."
+            )
+            return
+        if not remove_pending_throw(queue, entry["arrival"]):
+            return_pending_throw(opponent)
+            return
+    complete_game(
+        opponent["throw"],
+        opponent["phone_number"],
+        current_throw,
+        current_number,
+        outbox,
+    )
+
+
+def determine_winner(first_throw, second_throw):
+    """
+    input parameters are each a list with contents: ["throw", "phone_number"]
+    returns a string of format "phone_number wins."
+    """
+    try:
+        return format_result(play_game(first_throw, second_throw))
+    except KeyError:
+        return "Something went wrong..."
+
+
+### Matchmaking shard methods #####################################
+def choose_shard(phone_number: str) -> int:
+    """
+    Pick the matchmaking shard a throw is played in.
+
+    "hash" keeps a player on the same shard for every throw, "random" spreads
+    throws evenly regardless of who sent them. Either way each shard has its
+    own opponent slot and its own lock, so up to MATCHMAKING_SHARDS games can
+    be resolved concurrently.
+    """
+    if config.matchmaking_shards <= 1:
+        return 0
+    if config.matchmaking_shard_strategy == "hash":
+        # crc32 rather than hash(), which is salted per process
+        return zlib.crc32(phone_number.encode()) % config.matchmaking_shards
+    return random.randrange(config.matchmaking_shards)
+
+
+def shard_names(shard: int) -> tuple:
+    """
+    Return the (game state key, lock name) pair of a matchmaking shard.
+    Shard 0 keeps the original single-slot names.
+    """
+    if shard == 0:
+        return "opponent", "throw_lock"
+    return f"opponent#{shard}", f"throw_lock#{shard}"
+
+
+### Game history methods ##########################################
+# partition of the game history table holding the leaderboard buckets
+LEADERBOARD_PARTITION = "LEADERBOARD"
+# number of leaders listed in reply to "top"
+LEADERBOARD_SIZE = 5
+# number of games listed in reply to "history"
+HISTORY_SIZE = 5
+# how a player's game is described from each of its outcomes
+OUTCOME_NAMES = {1: "won", -1: "lost", 0: "tied"}
+
+
+def stats_key(phone_number: str) -> dict:
+    return {"phone_number": phone_number, "record": "STATS"}
+
+
+def leaderboard_key(wins: int) -> dict:
+    # zero padded, so buckets sort by number of wins
+    return {"phone_number": LEADERBOARD_PARTITION, "record": f"WINS#{wins:010d}"}
+
+
+def game_writes(result: GameResult) -> list:
+    """
+    The game history table writes recording a finished game, as (table, entry)
+    pairs for transact_write_items, so they can share a transaction with the
+    game state change that finishes the game.
+
+    The table has one partition per player (single-table design):
+      "GAME#<ms timestamp>#<id>" items, one per game played, so a player's
+          last N games are one Query in descending order of record;
+      a "STATS" item of counters (games, wins, losses, ties) aggregated at
+          write time with ADD, so a player's totals are one GetItem.
+
+    The winner's leaderboard bucket is moved apart from these writes, see
+    update_leaderboard.
+    """
+    table = get_history_table()
+    now = ms_timestamp()
+    writes = []
+    for number, throw, opponent, opponent_throw, outcome in [
+        (
+            result.first_number,
+            result.first_throw,
+            result.second_number,
+            result.second_throw,
+            result.outcome,
+        ),
+        (
+            result.second_number,
+            result.second_throw,
+            result.first_number,
+            result.first_throw,
+            -result.outcome,
+        ),
+    ]:
+        item = {
+            "phone_number": number,
+            "record": f"GAME#{now:013d}#{uuid.uuid4().hex[:8]}",
+            "throw": throw,
+            "opponent": opponent,
+            "opponent_throw": opponent_throw,
+            "outcome": outcome,
+        }
+        writes.append((table, {"Put": {"Item": item}}))
+        update = {
+            "Key": stats_key(number),
+            "UpdateExpression": "SET last_played = :now "
+            "ADD games :one, wins :wins, losses :losses, ties :ties",
+            "ExpressionAttributeValues": {
+                ":now": now,
+                ":one": 1,
+                ":wins": int(outcome == 1),
+                ":losses": int(outcome == -1),
+                ":ties": int(outcome == 0),
+            },
+        }
+        writes.append((table, {"Update": update}))
+    return writes
+
+
+def record_game(result: GameResult) -> None:
+    # write a finished game to the history table in one transaction. A failure
+    # is logged rather than raised, the game itself is already over.
+    try:
+        transact_write_items(game_writes(result))
+    except ClientError as error:
+        logger.error("Failed to record game %s: %s", result, error)
+    else:
+        logger.debug("Game recorded %s", result)
+        update_leaderboard(result)
+
+
+@timed("db.update_leaderboard")
+def update_leaderboard(result: GameResult) -> None:
+    """
+    Move the winner of a recorded game up to the leaderboard bucket of their
+    new number of wins.
+
+    The LEADERBOARD partition has one bucket item per number of wins, holding
+    the set of players with that many wins, so reading the top players is a
+    Query of a few buckets however many players and games there are (see
+    get_top_players). Every win writes to that one partition, so the move is
+    kept out of the game's transaction, where contention on it would cancel
+    the game. Like record_game it is best effort: a failure is logged, and
+    the winner's next win puts them in the right bucket.
+
+    The bucket follows the winner's STATS item, read consistently, so a game
+    that failed to be recorded does not move them. They are added to the new
+    bucket before they are taken out of the old one, and a failure in between
+    leaves them in both, where only the highest counts.
+    """
+    if not result.winner:
+        return
+    table = get_history_table()
+    player = {":player": {result.winner}}
+    try:
+        stats = table.get_item(Key=stats_key(result.winner), ConsistentRead=True)
+        wins = int(stats.get("Item", {}).get("wins", 0))
+        if not wins:
+            return
+        table.update_item(
+            Key=leaderboard_key(wins),
+            UpdateExpression="ADD players :player",
+            ExpressionAttributeValues=player,
+        )
+        if wins > 1:
+            old_bucket = table.update_item(
+                Key=leaderboard_key(wins - 1),
+                UpdateExpression="DELETE players :player",
+                ExpressionAttributeValues=player,
+                ReturnValues="ALL_NEW",
+            )["Attributes"]
+            if "players" not in old_bucket:
+                # the winner was the last player in it
+                delete_empty_bucket(wins - 1)
+    except ClientError as error:
+        logger.error("Failed to update leaderboard for %s: %s", result, error)
+
+
+def delete_empty_bucket(wins: int) -> None:
+    # delete a leaderboard bucket left without players, unless one has joined
+    # it since, so get_top_players does not read past it.
+    try:
+        get_history_table().delete_item(
+            Key=leaderboard_key(wins),
+            ConditionExpression=Attr("players").not_exists(),
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+@timed("db.get_player_stats")
+def get_player_stats(phone_number: str) -> dict:
+    # the player's counters, None if they have not finished a game yet
+    response = get_history_table().get_item(Key=stats_key(phone_number))
+    return response.get("Item")
+
+
+@timed("db.get_recent_games")
+def get_recent_games(phone_number: str, count: int = HISTORY_SIZE) -> list:
+    # the player's last 'count' games, newest first
+    response = get_history_table().query(
+        KeyConditionExpression=Key("phone_number").eq(phone_number)
+        & Key("record").begins_with("GAME#"),
+        ScanIndexForward=False,
+        Limit=count,
+    )
+    return response["Items"]
+
+
+@timed("db.get_top_players")
+def get_top_players(count: int = LEADERBOARD_SIZE) -> list:
+    """
+    (phone number, wins) of the 'count' players with the most wins, most first.
+
+    Reads the highest leaderboard buckets, 'count' at a time. Buckets are
+    deleted once their last player moves up (see update_leaderboard), so the
+    first page is usually enough. A player whose two games finished at the
+    same moment can be left in a lower bucket as well, where only their
+    highest one counts, and a bucket whose delete failed stays behind empty;
+    the pages that follow are read until 'count' players are found.
+    """
+    leaders, page = {}, {}
+    while len(leaders) < count:
+        response = get_history_table().query(
+            KeyConditionExpression=Key("phone_number").eq(LEADERBOARD_PARTITION)
+            & Key("record").begins_with("WINS#"),
+            ScanIndexForward=False,
+            Limit=count,
+            **page,
+        )
+        for bucket in response["Items"]:
+            wins = int(bucket["record"].split("#")[1])
+            for number in sorted(bucket.get("players", ())):
+                leaders.setdefault(number, wins)
+        if "LastEvaluatedKey" not in response:
+            break
+        page = {"ExclusiveStartKey": response["LastEvaluatedKey"]}
+    return list(leaders.items())[:count]
+
+
+def format_stats(phone_number: str) -> str:
+    stats = get_player_stats(phone_number)
+    if not stats:
+        return "No games played yet."
+    return (
+        f"{stats['wins']} wins, {stats['losses']} losses, {stats['ties']} ties "
+        f"in {stats['games']} games."
+    )
+
+
+def format_history(phone_number: str) -> str:
+    games = get_recent_games(phone_number)
+    if not games:
+        return "No games played yet."
+    # only the last digits of the opponents' numbers are shown
+    return "Last games:\n" + "\n".join(
+        f"{game['throw']} vs {game['opponent_throw']} "
+        f"(...{game['opponent'][-4:]}): {OUTCOME_NAMES[int(game['outcome'])]}"
+        for game in games
+    )
+
+
+def format_leaders() -> str:
+    leaders = get_top_players()
+    if not leaders:
+        return "No games won yet."
+    # only the last digits of other players' numbers are shown
+    return "Leaders:\n" + "\n".join(
+        f"{rank}. ...{number[-4:]} {wins} wins"
+        for rank, (number, wins) in enumerate(leaders, 1)
+    )
+
+
+### DB methods #####################################################
+def get_game_state_store():
+    # the GameStateStore selected by GAME_STATE_STORE, one per container
+    return clients.get(
+        "game_state_store", lambda: GAME_STATE_STORES[config.game_state_store]()
+    )
+
+
+@timed("db.put_item")
+def put_item(item: dict) -> None:
+    # item must at least have keys that match table primary keys
+    # see Dynamodb.py file for more info
+    get_game_state_store().put_item(item)
+
+
+@timed("db.get_item")
+def get_item(keys: dict) -> dict:
+    # keys must have only the dict keys that match table primary keys
+    # see Dynamodb.py file for more info
+    return get_game_state_store().get_item(keys)
+
+
+@timed("db.delete_item")
+def delete_item(keys: dict) -> None:
+    # keys must have only the dict keys that match table primary key
+    # see Dynamodb.py file for more info
+    get_game_state_store().delete_item(keys)
+
+
+@timed("db.claim_item")
+def claim_item(keys: dict, unless_number: str = None) -> dict:
+    # atomically delete an item and return what was stored, None if nothing was,
+    # or if the stored item's phone_number is unless_number.
+    # Concurrent callers can never both receive the same item.
+    item = get_game_state_store().claim_item(keys, unless_number)
+    if item:
+        logger.debug("DB item claimed %s", keys)
+    return item
+
+
+@timed("db.claim_pending_throw")
+def claim_pending_throw(queue: str, phone_number: str, before: str = None) -> dict:
+    # remove and return the oldest pending throw of another player among the
+    # first MATCHMAKING_QUEUE_SCAN_LIMIT in the queue, None if there is none.
+    # Only throws that arrived before 'before' count, if it is given.
+    # Concurrent callers can never both receive the same throw.
+    entry = get_game_state_store().claim_pending_throw(
+        queue, phone_number, config.matchmaking_queue_scan_limit, before
+    )
+    if entry:
+        logger.debug("Pending throw claimed %s", entry)
+    return entry
+
+
+@timed("db.add_pending_throw")
+def add_pending_throw(queue: str, throw: str, phone_number: str) -> dict:
+    # the queue is ordered by arrival, the random suffix keeps apart throws
+    # arriving in the same millisecond
+    entry = {
+        "queue": queue,
+        "arrival": f"{ms_timestamp():013d}#{uuid.uuid4().hex[:8]}",
+        "throw": throw,
+        "phone_number": phone_number,
+    }
+    get_game_state_store().add_pending_throw(entry)
+    logger.debug("Pending throw added %s", entry)
+    return entry
+
+
+@timed("db.remove_pending_throw")
+def remove_pending_throw(queue: str, arrival: str) -> bool:
+    # take a throw back out of the queue, False if it was claimed already
+    removed = get_game_state_store().remove_pending_throw(queue, arrival)
+    if removed:
+        logger.debug("Pending throw removed %s %s", queue, arrival)
+    return removed
+
+
+@timed("db.return_pending_throw")
+def return_pending_throw(entry: dict) -> None:
+    # put a claimed throw back in its place in the queue
+    get_game_state_store().add_pending_throw(entry)
+    logger.debug("Pending throw returned %s", entry)
+
+
+@timed("db.put_item_if_absent")
+def put_item_if_absent(item: dict, key_name: str) -> bool:
+    # store the item only if no item with the same key exists.
+    stored = get_game_state_store().put_item_if_absent(item, key_name)
+    if stored:
+        logger.debug("DB entry made %s", item)
+    return stored
+
+
+@timed("db.fenced_put_item")
+def fenced_put_item(
+    item: dict, fencing_token: int, writes: list = None, version: int = None
+) -> None:
+    # store the item along with the lock fencing token of the writer. Fails if
+    # the item was last written under a newer token, i.e. by a later lock holder,
+    # or, if a version is given, if the stored item is not at that version.
+    # writes are DynamoDB writes to make together with it, see transact_write_items.
+    store = get_game_state_store()
+    if writes:
+        stored = store.fenced_put_item_with_writes(item, fencing_token, writes, version)
+    else:
+        stored = store.fenced_put_item(item, fencing_token, version)
+    if not stored:
+        logger.error("Fenced write rejected, token %s for %s", fencing_token, item)
+        raise StaleFencingToken
+    logger.debug("DB entry made %s", item)
+
+
+### Game state cache ###############################################
+class GameStateCache:
+    """
+    Read-through cache of game state items for the life of a warm container,
+    so a throw does not have to read back the opponent slot this container
+    wrote last. Cached items carry a version, and writes through the cache
+    are conditional on it (see put_cached_item), so an item changed by
+    another container is found out and read again rather than trusted.
+
+    Holds at most max_entries items, least recently used evicted first, each
+    for at most ttl_seconds. A ttl of 0 turns the cache off.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (expiry time, item), an item of None caches its absence
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._mutex = threading.Lock()
+
+    def lookup(self, key: str) -> tuple:
+        # (True, item) on a hit, (False, None) on a miss
+        with self._mutex:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, dict(entry[1]) if entry[1] else None
+            self.entries.pop(key, None)
+            self.misses += 1
+            return False, None
+
+    def store(self, key: str, item: dict) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._mutex:
+            expires = time.monotonic() + self.ttl_seconds
+            self.entries[key] = (expires, dict(item) if item else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        with self._mutex:
+            self.entries.pop(key, None)
+
+
+game_state_cache = GameStateCache(
+    config.game_state_cache_max_entries, config.game_state_cache_ttl_seconds
+)
+
+
+def item_version(item: dict) -> int:
+    # version of a game state item, 0 if it does not exist or has none yet
+    return int(item.get("version", 0)) if item else 0
+
+
+def get_cached_item(keys: dict) -> dict:
+    # get_item, served from the cache when the item is in it
+    key = keys["state"]
+    hit, item = game_state_cache.lookup(key)
+    if not hit:
+        item = get_item(keys)
+        game_state_cache.store(key, item)
+    return item
+
+
+def refresh_cached_item(keys: dict, item: dict) -> dict:
+    """
+    The stored version of an item that may have come from the cache, for
+    decisions that make no versioned write (see put_cached_item) to check it.
+    Read again and cached, unless the cache is off and the item was read just
+    now.
+    """
+    if game_state_cache.ttl_seconds <= 0:
+        return item
+    current = get_item(keys)
+    game_state_cache.store(keys["state"], current)
+    return current
+
+
+def put_cached_item(
+    item: dict, fencing_token: int, version: int, writes: list = None
+) -> None:
+    """
+    fenced_put_item, replacing the stored item only if it is still at the
+    given version (the version of the item it was decided from), and storing
+    the item with the next version. The cache is updated on success.
+
+    If the write is rejected the cache entry is invalidated and the item read
+    again. Raises StaleFencingToken if a later lock holder wrote it, and
+    StaleCacheEntry, carrying the current item, if the version was out of
+    date.
+    """
+    keys = {"state": item["state"]}
+    item = dict(item, version=version + 1)
+    try:
+        fenced_put_item(item, fencing_token, writes, version)
+    except StaleFencingToken:
+        game_state_cache.invalidate(keys["state"])
+        current = get_item(keys)
+        game_state_cache.store(keys["state"], current)
+        if current and int(current.get("fencing_token", 0)) > fencing_token:
+            raise
+        logger.debug("Cached version %d of %s was stale", version, keys)
+        raise StaleCacheEntry(current)
+    game_state_cache.store(keys["state"], dict(item, fencing_token=fencing_token))
+
+
+### Idempotency methods ##########################################
+# dedupe ids of messages this container has claimed, so a redelivery to the
+# same warm container is caught without a round trip.
+processed_messages = GameStateCache(
+    config.idempotency_cache_max_entries, config.idempotency_ttl_seconds
+)
+
+
+def message_dedupe_id(record: dict, pinpoint_event: dict) -> str:
+    """
+    The id a message is deduplicated on: Pinpoint's inboundMessageId, which
+    stays the same if the text is published more than once, else the SNS
+    MessageId, which stays the same when SNS or Lambda retries a delivery.
+    None if the message has neither or IDEMPOTENCY is off.
+    """
+    if not config.idempotency:
+        return None
+    return pinpoint_event.get("inboundMessageId") or record["Sns"].get("MessageId")
+
+
+def message_key(dedupe_id: str) -> dict:
+    # the message's record among the game state items
+    return {"state": "message#" + dedupe_id}
+
+
+def message_claim_expiry(context) -> int:
+    """
+    When the claims taken by an invocation expire (epoch seconds) unless it
+    completes them: once Lambda would have timed the invocation out, so the
+    redelivery of a message whose invocation timed out or crashed is
+    processed. Lambda's longest timeout when not running in Lambda.
+    """
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return int(time.time()) + MAX_INVOCATION_SECONDS
+    return int(time.time()) + context.get_remaining_time_in_millis() // 1000 + 1
+
+
+def claim_message(dedupe_id: str, expires: int) -> bool:
+    """
+    Claim the message for processing until 'expires' (see
+    message_claim_expiry). False if it is claimed already, by this or another
+    invocation, either in progress or completed (see complete_message), so a
+    redelivery costs no lock or game state call.
+    """
+    hit, _ = processed_messages.lookup(dedupe_id)
+    if hit:
+        return False
+    claimed = record_message(dedupe_id, expires)
+    if claimed:
+        # a claim seen from another invocation is not cached, that invocation
+        # may yet fail and release it
+        processed_messages.store(dedupe_id, None)
+    return claimed
+
+
+@timed("db.record_message")
+def record_message(dedupe_id: str, expires: int) -> bool:
+    # the conditional write behind claim_message, expiring with a TTL
+    return get_game_state_store().claim_message(
+        message_key(dedupe_id), int(time.time()), expires
+    )
+
+
+@timed("db.complete_message")
+def complete_message(dedupe_id: str) -> None:
+    # keep the claim of a processed message for IDEMPOTENCY_TTL_SECONDS
+    get_game_state_store().complete_message(
+        message_key(dedupe_id), int(time.time()) + config.idempotency_ttl_seconds
+    )
+
+
+def release_message(dedupe_id: str) -> None:
+    # forget a claimed message that failed, so its redelivery is processed
+    processed_messages.invalidate(dedupe_id)
+    delete_item(message_key(dedupe_id))
+
+
+### Game state stores ##############################################
+class GameStateStore:
+    """
+    Where the game state and the locks live. Everything above reaches storage
+    through the DB methods and lock methods, which delegate to the store
+    selected by GAME_STATE_STORE in setup.py.
+
+    Items are dicts keyed by a single string attribute ("state"). Locks are
+    leases carrying a fencing token that increases on every acquisition, see
+    acquire_lock. Conditional operations report failure by return value.
+    """
+
+    def get_item(self, keys: dict) -> dict:
+        raise NotImplementedError
+
+    def put_item(self, item: dict) -> None:
+        raise NotImplementedError
+
+    def delete_item(self, keys: dict) -> None:
+        raise NotImplementedError
+
+    def claim_item(self, keys: dict, unless_number: str = None) -> dict:
+        # delete and return the item, None if there was none or, when
+        # unless_number is given, if it is that player's or has no phone_number
+        raise NotImplementedError
+
+    def put_item_if_absent(self, item: dict, key_name: str) -> bool:
+        raise NotImplementedError
 
+    def claim_message(self, keys: dict, now: int, expires: int) -> bool:
+        # store a message record expiring at 'expires' (epoch seconds). False
+        # if one is stored that has not expired by 'now'.
+        raise NotImplementedError
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+    def complete_message(self, keys: dict, expires: int) -> None:
+        # move the expiry of a message record claimed by this invocation
+        self.put_item(dict(keys, expires=expires))
 
-# the following line tells the setup script where to insert relevant parameters
-# such as the new pinpoint app id and all errored references below.
-# insert new parameters after this line:
+    def add_pending_throw(self, entry: dict) -> None:
+        # entry has the queue, its arrival (the sort order), throw and number
+        raise NotImplementedError
 
-# insert new parameters before this line.
+    def claim_pending_throw(
+        self, queue: str, phone_number: str, limit: int, before: str = None
+    ) -> dict:
+        # remove and return the oldest entry of the queue with another phone
+        # number, looking at no more than the oldest 'limit' entries, and if
+        # given only at those with an arrival before 'before'
+        raise NotImplementedError
 
-sns_client = boto3.client("sns")
-db_resource = boto3.resource("dynamodb")
-table = db_resource.Table(GAME_STATE_TABLE_NAME)
-pinpoint_client = boto3.client("pinpoint")
+    def remove_pending_throw(self, queue: str, arrival: str) -> bool:
+        # delete the entry, False if there was none
+        raise NotImplementedError
 
+    def fenced_put_item(
+        self, item: dict, fencing_token: int, version: int = None
+    ) -> bool:
+        # False if the stored item carries a newer fencing token, or if a
+        # version is given and the stored item's version is not that one
+        # (0 standing for an item, or a version, that does not exist).
+        raise NotImplementedError
 
-def lambda_handler(event, context):
+    def fenced_put_item_with_writes(
+        self, item: dict, fencing_token: int, writes: list, version: int = None
+    ) -> bool:
+        """
+        fenced_put_item, and if it succeeds the given DynamoDB writes (see
+        transact_write_items). Only the DynamoDB store can make both in one
+        transaction, other stores make the writes after the put. By then the
+        game is over, so like record_game a failure of the writes is logged
+        rather than raised, which would have the throw retried as a new game.
+        """
+        stored = self.fenced_put_item(item, fencing_token, version)
+        if stored:
+            try:
+                transact_write_items(writes)
+            except ClientError as error:
+                logger.error("Failed to record game after %s: %s", item, error)
+        return stored
 
-    logger.info("Event: %s", event)
-    # grab the event from pinpoint
-    try:
-        pinpointEvent = json.loads(event["Records"][0]["Sns"]["Message"])
-        msg_txt = pinpointEvent["messageBody"].lower().strip()
-        fromNumber = pinpointEvent["originationNumber"]
+    def acquire_lock(self, lock_name: str, self_id: str, now: int, expires: int):
+        # the new fencing token, None if the lock is held and its lease is live
+        raise NotImplementedError
 
-        process_msg(msg_txt, fromNumber)
+    def renew_lock(
+        self, lock_name: str, self_id: str, fencing_token: int, expires: int
+    ) -> bool:
+        raise NotImplementedError
 
-    except Exception as e:
-        logger.exception(str(e))
-        return {"statusCode": 500}
-    else:
-        return {"statusCode": 200}
+    def release_lock(self, lock_name: str, self_id: str) -> bool:
+        raise NotImplementedError
 
 
-### Rock Paper Scissors methods ####################################
-def process_msg(msg, number) -> None:
+class DynamoDBStore(GameStateStore):
     """
-    Process the incoming message
-    :param msg: a list consisting of [message text, phone number], both strings
+    The default store: game state in the GAME_STATE_TABLE_NAME table and locks
+    in the LOCK_TABLE_NAME table, using conditional writes for atomicity.
     """
-    if msg in ["rock", "paper", "scissors"]:
-        if LOCKING:
-            process_throw_with_locking(msg, number)
+
+    def put_item(self, item: dict) -> None:
+        try:
+            get_game_state_table().put_item(Item=item)
+        except ClientError as e:
+            logger.error(e.response["Error"]["Message"])
         else:
-            process_throw_without_locking(msg, number)
-    elif msg == "test":
-        send_sms(number, "ROCK PAPER SCISSORS:\nYour RPS game is up and running.")
-    else:
-        send_sms(
-            number, f"ROCK PAPER SCISSORS:\nUnable to process input ... try again."
+            logger.debug("DB entry made %s", item)
+
+    def get_item(self, keys: dict) -> dict:
+        try:
+            response = get_game_state_table().get_item(Key=keys)
+        except ClientError as e:
+            logger.error(e.response["Error"]["Message"])
+        else:
+            if "Item" in response:
+                logger.debug("DB entry retrieved %s", keys)
+                return response["Item"]
+            else:
+                logger.debug("No entry retrieved for get: %s", keys)
+                return None
+
+    def delete_item(self, keys: dict) -> None:
+        try:
+            get_game_state_table().delete_item(Key=keys)
+        except ClientError as e:
+            logger.error(e.response["Error"]["Message"])
+        else:
+            logger.debug("DB item deleted %s", keys)
+
+    def claim_item(self, keys: dict, unless_number: str = None) -> dict:
+        if unless_number is None:
+            response = get_game_state_table().delete_item(
+                Key=keys, ReturnValues="ALL_OLD"
+            )
+            return response.get("Attributes")
+        try:
+            response = get_game_state_table().delete_item(
+                Key=keys,
+                ConditionExpression=Attr("phone_number").ne(unless_number),
+                ReturnValues="ALL_OLD",
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return None
+            else:
+                raise
+        return response.get("Attributes")
+
+    def put_item_if_absent(self, item: dict, key_name: str) -> bool:
+        return self.conditional(
+            get_game_state_table().put_item,
+            Item=item,
+            ConditionExpression=Attr(key_name).not_exists(),
         )
-        logger.error(f"ROCK PAPER SCISSORS:\nUnable to process input: {msg}")
 
+    def claim_message(self, keys: dict, now: int, expires: int) -> bool:
+        # expires is the table's TTL attribute. TTL deletes lag behind, so an
+        # expired record still in the table does not count.
+        return self.conditional(
+            get_game_state_table().put_item,
+            Item=dict(keys, expires=expires),
+            ConditionExpression=Attr("state").not_exists() | Attr("expires").lt(now),
+        )
 
-class FailedToAcquireLock(Exception):
-    pass
+    def add_pending_throw(self, entry: dict) -> None:
+        get_pending_throws_table().put_item(Item=entry)
 
+    def claim_pending_throw(
+        self, queue: str, phone_number: str, limit: int, before: str = None
+    ) -> dict:
+        # one Query for the oldest entries, then a delete returning the old
+        # item for each of another player until one is won. Only one of
+        # concurrent deletes gets the item back, the others try the next.
+        table = get_pending_throws_table()
+        condition = Key("queue").eq(queue)
+        if before is not None:
+            condition &= Key("arrival").lt(before)
+        response = table.query(
+            KeyConditionExpression=condition,
+            ConsistentRead=True,
+            Limit=limit,
+        )
+        for entry in response["Items"]:
+            if entry["phone_number"] == phone_number:
+                continue
+            response = table.delete_item(
+                Key={"queue": queue, "arrival": entry["arrival"]},
+                ReturnValues="ALL_OLD",
+            )
+            if "Attributes" in response:
+                return response["Attributes"]
+        return None
 
-class FailedToReleaseLock(Exception):
-    pass
+    def remove_pending_throw(self, queue: str, arrival: str) -> bool:
+        response = get_pending_throws_table().delete_item(
+            Key={"queue": queue, "arrival": arrival}, ReturnValues="ALL_OLD"
+        )
+        return "Attributes" in response
+
+    def fenced_put_item(
+        self, item: dict, fencing_token: int, version: int = None
+    ) -> bool:
+        return self.conditional(
+            get_game_state_table().put_item,
+            **self.fenced_put(item, fencing_token, version),
+        )
+
+    def fenced_put_item_with_writes(
+        self, item: dict, fencing_token: int, writes: list, version: int = None
+    ) -> bool:
+        # the put is the first write of the transaction
+        put = self.fenced_put(item, fencing_token, version)
+        put = (get_game_state_table(), {"Put": put})
+        try:
+            transact_write_items([put] + list(writes))
+        except ClientError as error:
+            if transaction_condition_failed(error, 0):
+                return False
+            # the game is over whatever the writes ran into, a conflict on a
+            # busy player's stats for one, so the put is made on its own and
+            # the writes after it, as other stores do
+            logger.warning("Failed to record game with %s: %s", item, error)
+            return super().fenced_put_item_with_writes(
+                item, fencing_token, writes, version
+            )
+        else:
+            return True
+
+    @staticmethod
+    def fenced_put(item: dict, fencing_token: int, version: int = None) -> dict:
+        condition = Attr("fencing_token").not_exists() | Attr("fencing_token").lte(
+            fencing_token
+        )
+        if version is not None:
+            condition &= (
+                Attr("version").eq(version) if version else Attr("version").not_exists()
+            )
+        return {
+            "Item": dict(item, fencing_token=fencing_token),
+            "ConditionExpression": condition,
+        }
+
+    def acquire_lock(self, lock_name: str, self_id: str, now: int, expires: int):
+        try:
+            # Conditional expression is used to ensure locks are acquired atomically.
+            # The lock item is never deleted, so the token keeps increasing.
+            response = get_lock_table(config.lock_table_name).update_item(
+                Key={"lock_name": lock_name},
+                UpdateExpression="SET holder = :holder, time_acquired = :now, "
+                "lease_expires = :expires ADD fencing_token :one",
+                # requester only gets the lock if nobody holds it or the lease
+                # has expired.
+                ConditionExpression=Attr("holder").not_exists()
+                | Attr("lease_expires").lt(now),
+                ExpressionAttributeValues={
+                    ":holder": self_id,
+                    ":now": now,
+                    ":expires": expires,
+                    ":one": 1,
+                },
+                ReturnValues="UPDATED_NEW",
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return None
+            else:
+                raise
+        else:
+            return int(response["Attributes"]["fencing_token"])
+
+    def renew_lock(
+        self, lock_name: str, self_id: str, fencing_token: int, expires: int
+    ) -> bool:
+        return self.conditional(
+            get_lock_table(config.lock_table_name).update_item,
+            Key={"lock_name": lock_name},
+            UpdateExpression="SET lease_expires = :expires",
+            ConditionExpression=Attr("holder").eq(self_id)
+            & Attr("fencing_token").eq(fencing_token),
+            ExpressionAttributeValues={":expires": expires},
+        )
+
+    def release_lock(self, lock_name: str, self_id: str) -> bool:
+        # remove the holder but keep the item, and with it the fencing token.
+        return self.conditional(
+            get_lock_table(config.lock_table_name).update_item,
+            Key={"lock_name": lock_name},
+            UpdateExpression="REMOVE holder, lease_expires",
+            ConditionExpression=Attr("holder").eq(self_id),
+        )
+
+    @staticmethod
+    def conditional(write, **kwargs) -> bool:
+        # run a conditional write, False if its condition did not hold
+        try:
+            write(**kwargs)
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            else:
+                raise
+        else:
+            return True
 
 
-def process_throw_with_locking(current_throw, current_number):
+class MemoryStore(GameStateStore):
     """
-    Given a throw and a number it belongs to (both strings),
-    determine the winner or store throw.
+    Game state and locks in dicts inside this process, behind one mutex.
+    Only invocations in the same container see the same state, so this is for
+    benchmarks and running the handler locally, not for deployments.
     """
-    self_id = str(uuid.uuid4())
-    # acquire lock to prevent other lambda functions from messing with the game
-    # state while processing throw. Keep trying for exponential retry time.
-    lock_acquired = retry_acquire_lock("throw_lock", self_id)
-    if lock_acquired:
 
-        opponent = get_item({"state": "opponent"})
-        # if get_item returns an opponent, it means there was one stored.
-        if opponent:
-            # determine the winner and text players
-            winner_message = determine_winner(
-                [opponent["throw"], opponent["phone_number"]],
-                [current_throw, current_number],
+    def __init__(self):
+        self.items = {}
+        self.locks = {}
+        # queue -> (arrival, entry) pairs in arrival order
+        self.queues = {}
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def key(keys: dict) -> str:
+        ((value,),) = [keys.values()]
+        return value
+
+    def get_item(self, keys: dict) -> dict:
+        item = self.items.get(self.key(keys))
+        return dict(item) if item else None
+
+    def put_item(self, item: dict) -> None:
+        with self._mutex:
+            self.items[item["state"]] = dict(item)
+
+    def delete_item(self, keys: dict) -> None:
+        with self._mutex:
+            self.items.pop(self.key(keys), None)
+
+    def claim_item(self, keys: dict, unless_number: str = None) -> dict:
+        with self._mutex:
+            item = self.items.get(self.key(keys))
+            if item and unless_number is not None:
+                if item.get("phone_number", unless_number) == unless_number:
+                    return None
+            return self.items.pop(self.key(keys), None)
+
+    def put_item_if_absent(self, item: dict, key_name: str) -> bool:
+        with self._mutex:
+            if item[key_name] in self.items:
+                return False
+            self.items[item[key_name]] = dict(item)
+            return True
+
+    def claim_message(self, keys: dict, now: int, expires: int) -> bool:
+        with self._mutex:
+            stored = self.items.get(self.key(keys))
+            if stored and stored["expires"] >= now:
+                return False
+            self.items[self.key(keys)] = dict(keys, expires=expires)
+            return True
+
+    def add_pending_throw(self, entry: dict) -> None:
+        with self._mutex:
+            queue = self.queues.setdefault(entry["queue"], [])
+            bisect.insort(queue, (entry["arrival"], dict(entry)))
+
+    def claim_pending_throw(
+        self, queue: str, phone_number: str, limit: int, before: str = None
+    ) -> dict:
+        with self._mutex:
+            pending = self.queues.get(queue, [])
+            for index, (arrival, entry) in enumerate(pending[:limit]):
+                if before is not None and arrival >= before:
+                    break
+                if entry["phone_number"] != phone_number:
+                    del pending[index]
+                    return entry
+            return None
+
+    def remove_pending_throw(self, queue: str, arrival: str) -> bool:
+        with self._mutex:
+            pending = self.queues.get(queue, [])
+            for index, (stored, _) in enumerate(pending):
+                if stored == arrival:
+                    del pending[index]
+                    return True
+            return False
+
+    def fenced_put_item(
+        self, item: dict, fencing_token: int, version: int = None
+    ) -> bool:
+        with self._mutex:
+            stored = self.items.get(item["state"], {})
+            if stored.get("fencing_token", fencing_token) > fencing_token:
+                return False
+            if version is not None and stored.get("version", 0) != version:
+                return False
+            self.items[item["state"]] = dict(item, fencing_token=fencing_token)
+            return True
+
+    def acquire_lock(self, lock_name: str, self_id: str, now: int, expires: int):
+        with self._mutex:
+            lock = self.locks.setdefault(lock_name, {"fencing_token": 0})
+            if "holder" in lock and lock["lease_expires"] >= now:
+                return None
+            lock.update(holder=self_id, time_acquired=now, lease_expires=expires)
+            lock["fencing_token"] += 1
+            return lock["fencing_token"]
+
+    def renew_lock(
+        self, lock_name: str, self_id: str, fencing_token: int, expires: int
+    ) -> bool:
+        with self._mutex:
+            lock = self.locks.get(lock_name, {})
+            if lock.get("holder") != self_id or lock["fencing_token"] != fencing_token:
+                return False
+            lock["lease_expires"] = expires
+            return True
+
+    def release_lock(self, lock_name: str, self_id: str) -> bool:
+        with self._mutex:
+            lock = self.locks.get(lock_name, {})
+            if lock.get("holder") != self_id:
+                return False
+            del lock["holder"], lock["lease_expires"]
+            return True
+
+
+class RedisStore(GameStateStore):
+    """
+    Game state items and locks as hashes in a Redis-protocol store (Redis,
+    Valkey, ElastiCache) at REDIS_URL. Every conditional operation is a Lua
+    script, which the server runs atomically, so each one is a single round
+    trip of well under a millisecond from inside the same VPC.
+    Hash values come back as strings. Needs the redis package deployed.
+    """
+
+    SCRIPTS = {
+        "put_item": """
+            redis.call('DEL', KEYS[1])
+            redis.call('HSET', KEYS[1], unpack(ARGV))
+        """,
+        # ARGV[1], if given, is a phone number whose item is not claimed
+        "claim_item": """
+            if ARGV[1] then
+                local number = redis.call('HGET', KEYS[1], 'phone_number')
+                if not number or number == ARGV[1] then return {} end
+            end
+            local item = redis.call('HGETALL', KEYS[1])
+            redis.call('DEL', KEYS[1])
+            return item
+        """,
+        # KEYS[1] is the queue, a sorted set of arrivals (all scored 0, so in
+        # arrival order) each naming a hash KEYS[1]:arrival. ARGV is the
+        # arrival, then the entry
+        "add_pending_throw": """
+            redis.call('HSET', KEYS[1] .. ':' .. ARGV[1], unpack(ARGV, 2))
+            redis.call('ZADD', KEYS[1], 0, ARGV[1])
+        """,
+        # ARGV is the phone number to skip, the number of entries to look at
+        # and, if given, the arrival the entries have to come before
+        "claim_pending_throw": """
+            local arrivals = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+            for _, arrival in ipairs(arrivals) do
+                if ARGV[3] and arrival >= ARGV[3] then break end
+                local key = KEYS[1] .. ':' .. arrival
+                if redis.call('HGET', key, 'phone_number') ~= ARGV[1] then
+                    local entry = redis.call('HGETALL', key)
+                    redis.call('DEL', key)
+                    redis.call('ZREM', KEYS[1], arrival)
+                    return entry
+                end
+            end
+            return {}
+        """,
+        # ARGV is the arrival
+        "remove_pending_throw": """
+            if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then return 0 end
+            redis.call('DEL', KEYS[1] .. ':' .. ARGV[1])
+            return 1
+        """,
+        "put_item_if_absent": """
+            if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+            redis.call('HSET', KEYS[1], unpack(ARGV))
+            return 1
+        """,
+        # ARGV is now, expiry. Redis deletes the record when it expires.
+        "claim_message": """
+            local expires = redis.call('HGET', KEYS[1], 'expires')
+            if expires and tonumber(expires) >= tonumber(ARGV[1]) then
+                return 0
+            end
+            redis.call('HSET', KEYS[1], 'expires', ARGV[2])
+            redis.call('EXPIREAT', KEYS[1], ARGV[2])
+            return 1
+        """,
+        # ARGV is the new expiry
+        "complete_message": """
+            redis.call('HSET', KEYS[1], 'expires', ARGV[1])
+            redis.call('EXPIREAT', KEYS[1], ARGV[1])
+        """,
+        # ARGV[1] is the fencing token, ARGV[2] the expected version ('' for
+        # any), the rest the item
+        "fenced_put_item": """
+            local stored = redis.call('HGET', KEYS[1], 'fencing_token')
+            if stored and tonumber(stored) > tonumber(ARGV[1]) then return 0 end
+            local version = redis.call('HGET', KEYS[1], 'version') or '0'
+            if ARGV[2] ~= '' and tonumber(version) ~= tonumber(ARGV[2]) then
+                return 0
+            end
+            redis.call('DEL', KEYS[1])
+            redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+            return 1
+        """,
+        # ARGV is holder, now, lease expiry
+        "acquire_lock": """
+            local expires = redis.call('HGET', KEYS[1], 'lease_expires')
+            if redis.call('HEXISTS', KEYS[1], 'holder') == 1
+                and tonumber(expires) >= tonumber(ARGV[2]) then
+                return false
+            end
+            redis.call('HSET', KEYS[1], 'holder', ARGV[1],
+                'time_acquired', ARGV[2], 'lease_expires', ARGV[3])
+            return redis.call('HINCRBY', KEYS[1], 'fencing_token', 1)
+        """,
+        # ARGV is holder, fencing token, lease expiry
+        "renew_lock": """
+            if redis.call('HGET', KEYS[1], 'holder') ~= ARGV[1]
+                or redis.call('HGET', KEYS[1], 'fencing_token') ~= ARGV[2] then
+                return 0
+            end
+            redis.call('HSET', KEYS[1], 'lease_expires', ARGV[3])
+            return 1
+        """,
+        "release_lock": """
+            if redis.call('HGET', KEYS[1], 'holder') ~= ARGV[1] then return 0 end
+            redis.call('HDEL', KEYS[1], 'holder', 'lease_expires')
+            return 1
+        """,
+    }
+
+    def __init__(self, client=None):
+        self.client = client or get_redis_client()
+        self.scripts = {
+            name: self.client.register_script(source)
+            for name, source in self.SCRIPTS.items()
+        }
+
+    @staticmethod
+    def item_key(keys: dict) -> str:
+        ((value,),) = [keys.values()]
+        return f"{config.game_state_table_name}:{value}"
+
+    @staticmethod
+    def lock_key(lock_name: str) -> str:
+        return f"{config.lock_table_name}:{lock_name}"
+
+    @staticmethod
+    def queue_key(queue: str) -> str:
+        return f"{config.pending_throws_table_name}:{queue}"
+
+    @staticmethod
+    def fields(item: dict) -> list:
+        # flatten an item into the field, value, field, value... HSET takes
+        return [str(part) for pair in item.items() for part in pair]
+
+    def get_item(self, keys: dict) -> dict:
+        return self.client.hgetall(self.item_key(keys)) or None
+
+    def put_item(self, item: dict) -> None:
+        self.scripts["put_item"](
+            keys=[self.item_key({"state": item["state"]})], args=self.fields(item)
+        )
+
+    def delete_item(self, keys: dict) -> None:
+        self.client.delete(self.item_key(keys))
+
+    def claim_item(self, keys: dict, unless_number: str = None) -> dict:
+        flat = self.scripts["claim_item"](
+            keys=[self.item_key(keys)],
+            args=[] if unless_number is None else [unless_number],
+        )
+        return dict(zip(flat[::2], flat[1::2])) or None
+
+    def put_item_if_absent(self, item: dict, key_name: str) -> bool:
+        return bool(
+            self.scripts["put_item_if_absent"](
+                keys=[self.item_key({key_name: item[key_name]})],
+                args=self.fields(item),
             )
+        )
 
-            send_sms(
-                opponent["phone_number"], "ROCK PAPER SCISSORS:\n" + winner_message
+    def claim_message(self, keys: dict, now: int, expires: int) -> bool:
+        return bool(
+            self.scripts["claim_message"](
+                keys=[self.item_key(keys)], args=[now, expires]
             )
-            send_sms(current_number, "ROCK PAPER SCISSORS:\n" + winner_message)
-            # delete the game state for next round.
-            delete_item({"state": "opponent"})
-            logger.info("Game completed.")
-        # otherwise get_item returned None, indicating no previous game state stored.
-        else:
-            # therefore store the new game state.
-            put_item(
-                {
-                    "state": "opponent",
-                    "throw": current_throw,
-                    "phone_number": current_number,
-                }
+        )
+
+    def complete_message(self, keys: dict, expires: int) -> None:
+        # put_item would drop the key's expiry
+        self.scripts["complete_message"](keys=[self.item_key(keys)], args=[expires])
+
+    def add_pending_throw(self, entry: dict) -> None:
+        self.scripts["add_pending_throw"](
+            keys=[self.queue_key(entry["queue"])],
+            args=[entry["arrival"]] + self.fields(entry),
+        )
+
+    def claim_pending_throw(
+        self, queue: str, phone_number: str, limit: int, before: str = None
+    ) -> dict:
+        args = [phone_number, limit] + ([] if before is None else [before])
+        flat = self.scripts["claim_pending_throw"](
+            keys=[self.queue_key(queue)], args=args
+        )
+        return dict(zip(flat[::2], flat[1::2])) or None
+
+    def remove_pending_throw(self, queue: str, arrival: str) -> bool:
+        return bool(
+            self.scripts["remove_pending_throw"](
+                keys=[self.queue_key(queue)], args=[arrival]
             )
-            # notify the player the game is waiting for another throw
-            send_sms(current_number, "ROCK PAPER SCISSORS:\nWaiting for opponent...")
-        # release the lock.
-        lock_released = release_lock("throw_lock", self_id)
-        if lock_released:
-            pass
-        else:
-            logger.error("Failed to release lock %s", self_id)
-            raise FailedToReleaseLock
-    else:
-        # under normal circumstances acquire lock is very unlikely to fail.
-        logger.exception("Failed to acquire lock %s", self_id)
-        raise FailedToAcquireLock
+        )
 
+    def fenced_put_item(
+        self, item: dict, fencing_token: int, version: int = None
+    ) -> bool:
+        return bool(
+            self.scripts["fenced_put_item"](
+                keys=[self.item_key({"state": item["state"]})],
+                args=[fencing_token, "" if version is None else version]
+                + self.fields(dict(item, fencing_token=fencing_token)),
+            )
+        )
 
-def process_throw_without_locking(current_throw, current_number):
-    # same as above but without locking.
-    opponent = get_item({"state": "opponent"})
+    def acquire_lock(self, lock_name: str, self_id: str, now: int, expires: int):
+        return self.scripts["acquire_lock"](
+            keys=[self.lock_key(lock_name)], args=[self_id, now, expires]
+        )
 
-    if opponent:
-        winner_message = determine_winner(
-            [opponent["throw"], opponent["phone_number"]],
-            [current_throw, current_number],
+    def renew_lock(
+        self, lock_name: str, self_id: str, fencing_token: int, expires: int
+    ) -> bool:
+        return bool(
+            self.scripts["renew_lock"](
+                keys=[self.lock_key(lock_name)],
+                args=[self_id, fencing_token, expires],
+            )
         )
 
-        send_sms(opponent["phone_number"], "ROCK PAPER SCISSORS:\n" + winner_message)
-        send_sms(current_number, "ROCK PAPER SCISSORS:\n" + winner_message)
+    def release_lock(self, lock_name: str, self_id: str) -> bool:
+        return bool(
+            self.scripts["release_lock"](
+                keys=[self.lock_key(lock_name)], args=[self_id]
+            )
+        )
 
-        delete_item({"state": "opponent"})
-        logger.info("Game completed: %s", winner_message)
-    else:
-        put_item(
-            {
-                "state": "opponent",
-                "throw": current_throw,
-                "phone_number": current_number,
+
+GAME_STATE_STORES = {
+    "dynamodb": DynamoDBStore,
+    "memory": MemoryStore,
+    "redis": RedisStore,
+}
+
+
+### DynamoDB low-level client layer ##############################
+def serialize(value) -> dict:
+    # python value to DynamoDB attribute value, covering the types we store.
+    if isinstance(value, str):
+        return {"S": value}
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, (int, Decimal)):
+        return {"N": str(value)}
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, dict):
+        return {"M": {k: serialize(v) for k, v in value.items()}}
+    if isinstance(value, list):
+        return {"L": [serialize(v) for v in value]}
+    if isinstance(value, (set, frozenset)) and all(isinstance(v, str) for v in value):
+        return {"SS": sorted(value)}
+    raise TypeError(f"Unsupported type {type(value)} for DynamoDB: {value!r}")
+
+
+def deserialize(attribute_value: dict):
+    # DynamoDB attribute value to python value, numbers as Decimal like boto3.
+    ((type_name, value),) = attribute_value.items()
+    if type_name == "S" or type_name == "BOOL":
+        return value
+    if type_name == "N":
+        return Decimal(value)
+    if type_name == "NULL":
+        return None
+    if type_name == "M":
+        return {k: deserialize(v) for k, v in value.items()}
+    if type_name == "L":
+        return [deserialize(v) for v in value]
+    if type_name == "SS":
+        return set(value)
+    if type_name == "NS":
+        return {Decimal(v) for v in value}
+    raise TypeError(f"Unsupported DynamoDB type {type_name}")
+
+
+class ClientTable:
+    """
+    The subset of the boto3 resource Table API used by this file, on top of
+    the low-level dynamodb client. Skips the resource layer's model loading
+    and generic TypeSerializer. The serialised form of single attribute keys
+    ("state" or "lock_name") is cached; composite keys are mostly unique.
+    """
+
+    def __init__(self, client, table_name: str):
+        self.client = client
+        self.table_name = table_name
+        self.serialized_keys = {}
+
+    def serialize_key(self, key: dict) -> dict:
+        if len(key) > 1:
+            return {name: serialize(value) for name, value in key.items()}
+        ((name, value),) = key.items()
+        try:
+            return self.serialized_keys[(name, value)]
+        except KeyError:
+            serialized = self.serialized_keys[(name, value)] = {name: {"S": value}}
+            return serialized
+
+    def request(self, condition=None, values: dict = None, **kwargs) -> dict:
+        # build the keyword arguments shared by all write requests
+        kwargs["TableName"] = self.table_name
+        names = dict(kwargs.pop("ExpressionAttributeNames", None) or {})
+        values = dict(values or {})
+        if condition is not None:
+            built = ConditionExpressionBuilder().build_expression(condition)
+            kwargs["ConditionExpression"] = built.condition_expression
+            names.update(built.attribute_name_placeholders)
+            values.update(built.attribute_value_placeholders)
+        if names:
+            kwargs["ExpressionAttributeNames"] = names
+        if values:
+            kwargs["ExpressionAttributeValues"] = {
+                k: serialize(v) for k, v in values.items()
             }
+        return kwargs
+
+    @staticmethod
+    def response(response: dict) -> dict:
+        for field in ("Item", "Attributes", "LastEvaluatedKey"):
+            if field in response:
+                response[field] = {
+                    k: deserialize(v) for k, v in response[field].items()
+                }
+        if "Items" in response:
+            response["Items"] = [
+                {k: deserialize(v) for k, v in item.items()}
+                for item in response["Items"]
+            ]
+        return response
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        return self.response(
+            self.client.get_item(
+                TableName=self.table_name, Key=self.serialize_key(Key), **kwargs
+            )
         )
-        send_sms(current_number, "ROCK PAPER SCISSORS:\nWaiting for opponent...")
 
+    def put_item(self, Item: dict, ConditionExpression=None, **kwargs) -> dict:
+        request = self.request(ConditionExpression, **kwargs)
+        request["Item"] = {k: serialize(v) for k, v in Item.items()}
+        return self.response(self.client.put_item(**request))
 
-def determine_winner(first_throw, second_throw):
+    def delete_item(self, Key: dict, ConditionExpression=None, **kwargs) -> dict:
+        request = self.request(ConditionExpression, **kwargs)
+        request["Key"] = self.serialize_key(Key)
+        return self.response(self.client.delete_item(**request))
+
+    def update_item(
+        self,
+        Key: dict,
+        ConditionExpression=None,
+        ExpressionAttributeValues: dict = None,
+        **kwargs,
+    ) -> dict:
+        request = self.request(ConditionExpression, ExpressionAttributeValues, **kwargs)
+        request["Key"] = self.serialize_key(Key)
+        return self.response(self.client.update_item(**request))
+
+    def query(self, KeyConditionExpression, **kwargs) -> dict:
+        if "ExclusiveStartKey" in kwargs:
+            kwargs["ExclusiveStartKey"] = self.serialize_key(
+                kwargs["ExclusiveStartKey"]
+            )
+        built = ConditionExpressionBuilder().build_expression(
+            KeyConditionExpression, is_key_condition=True
+        )
+        request = self.request(
+            values=built.attribute_value_placeholders,
+            ExpressionAttributeNames=built.attribute_name_placeholders,
+            KeyConditionExpression=built.condition_expression,
+            **kwargs,
+        )
+        return self.response(self.client.query(**request))
+
+    def transact_item(self, entry: dict) -> dict:
+        # one TransactWriteItems entry on this table, see transact_write_items
+        ((operation, params),) = entry.items()
+        params = dict(params)
+        request = self.request(
+            params.pop("ConditionExpression", None),
+            params.pop("ExpressionAttributeValues", None),
+            **params,
+        )
+        if "Item" in request:
+            request["Item"] = {k: serialize(v) for k, v in request["Item"].items()}
+        if "Key" in request:
+            request["Key"] = self.serialize_key(request["Key"])
+        return {operation: request}
+
+
+@timed("db.transact_write_items")
+def transact_write_items(writes: list) -> None:
     """
-    input parameters are each a list with contents: ["throw", "phone_number"]
-    returns a string of format "phone_number wins."
+    Apply writes all together or not at all, in a single TransactWriteItems
+    round trip. writes are (table, entry) pairs, the tables may differ. An
+    entry is {"Put": {...}}, {"Update": {...}} etc. with the same python values
+    the Table methods take, and no TableName.
     """
-    t1 = first_throw[0]
-    t2 = second_throw[0]
-
-    if t1 == t2:
-        response = "Tie! No winner"
-    elif t1 == "paper" and t2 == "rock":
-        response = first_throw[1] + " wins."
-    elif t1 == "scissors" and t2 == "rock":
-        response = second_throw[1] + " wins."
-    elif t1 == "rock" and t2 == "scissors":
-        response = first_throw[1] + " wins."
-    elif t1 == "paper" and t2 == "scissors":
-        response = first_throw[1] + " wins."
-    elif t1 == "scissors" and t2 == "paper":
-        response = first_throw[1] + " wins."
-    elif t1 == "rock" and t2 == "paper":
-        response = first_throw[1] + " wins."
+    if config.dynamodb_layer == "client":
+        # all ClientTables share the one client
+        writes[0][0].client.transact_write_items(
+            TransactItems=[table.transact_item(entry) for table, entry in writes]
+        )
     else:
-        response = "Something went wrong..."
+        # the resource's client serialises python values like Table does, but
+        # does not build condition expressions nested in a transaction.
+        transact_items = []
+        for table, entry in writes:
+            ((operation, params),) = entry.items()
+            params = dict(params, TableName=table.name)
+            condition = params.pop("ConditionExpression", None)
+            if condition is not None:
+                built = ConditionExpressionBuilder().build_expression(condition)
+                params["ConditionExpression"] = built.condition_expression
+                params["ExpressionAttributeNames"] = built.attribute_name_placeholders
+                params["ExpressionAttributeValues"] = dict(
+                    params.get("ExpressionAttributeValues", {}),
+                    **built.attribute_value_placeholders,
+                )
+            transact_items.append({operation: params})
+        get_dynamodb_resource().meta.client.transact_write_items(
+            TransactItems=transact_items
+        )
 
-    return response
 
+def transaction_condition_failed(error: ClientError, index: int) -> bool:
+    # whether a cancelled transaction failed on the condition of write 'index'
+    if error.response["Error"]["Code"] != "TransactionCanceledException":
+        return False
+    reasons = error.response.get("CancellationReasons", [])
+    return index < len(reasons) and reasons[index]["Code"] == "ConditionalCheckFailed"
 
-### DB methods #####################################################
-def put_item(item: dict) -> None:
-    # item must at least have keys that match table primary keys
-    # see Dynamodb.py file for more info
-    try:
-        table.put_item(Item=item)
-    except ClientError as e:
-        logger.error(e.response["Error"]["Message"])
-    else:
-        logger.info(f"DB entry made {item}")
 
+### Pinpoint methods #####################################################
+# Pinpoint accepts at most this many addresses per send_messages request.
+MAX_ADDRESSES_PER_REQUEST = 100
+# Pinpoint requests in flight at once. The pinpoint client is thread safe and
+# shared by all workers.
+MAX_SMS_SEND_WORKERS = 8
+# time kept back from the Lambda timeout for returning a response.
+INVOCATION_DEADLINE_MARGIN_MS = 500
+# Lambda's longest timeout
+MAX_INVOCATION_SECONDS = 15 * 60
 
-def get_item(keys: dict) -> dict:
-    # keys must have only the dict keys that match table primary keys
-    # see Dynamodb.py file for more info
-    try:
-        response = table.get_item(Key=keys)
-    except ClientError as e:
-        logging.error(e.response["Error"]["Message"])
-    else:
-        if "Item" in response:
-            logging.info(f"DB entry retrieved {keys}")
-            return response["Item"]
-        else:
-            logging.info(f"No entry retrieved for get: {keys}")
-            return None
+sms_executor = ThreadPoolExecutor(max_workers=MAX_SMS_SEND_WORKERS)
 
 
-def delete_item(keys: dict) -> None:
-    # keys must have only the dict keys that match table primary key
-    # see Dynamodb.py file for more info
-    try:
-        table.delete_item(Key=keys)
-    except ClientError as e:
-        logger.error(e.response["Error"]["Message"])
-    else:
-        logger.info(f"DB item deleted made {keys}")
+class Outbox:
+    """
+    Outbound texts waiting to be sent. Game resolution only adds messages
+    here, so no Pinpoint call happens while the game state lock is held.
+    flush() drains the outbox once the caller is done with the game state,
+    in as few Pinpoint requests as possible, sent concurrently.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def add(self, phone_numbers: list, message: str) -> None:
+        self.messages.extend((number, message) for number in phone_numbers)
+
+    def flush(self, deadline: float = None) -> list:
+        """
+        Send every queued message and return (phone number, message, delivery
+        status) for each. The status is None if the send failed or did not
+        finish before the deadline (a time.monotonic() value). Failures are
+        counted and logged, never raised: by now the game state is committed.
+
+        A number can only appear once per request, so numbers with several
+        messages get one request round per message, also when the messages
+        are the same, e.g. the result of two games won in one batch. Rounds go out in order so
+        each player receives their texts in the order they were queued; the
+        requests within a round are sent concurrently.
+        """
+        messages, self.messages = self.messages, []
+        rounds = []
+        for number, message in messages:
+            for batch in rounds:
+                if number not in batch:
+                    batch[number] = message
+                    break
+            else:
+                rounds.append({number: message})
+
+        results = []
+        for batch in rounds:
+            numbers = list(batch)
+            futures = {
+                sms_executor.submit(
+                    in_current_context(send_sms_messages),
+                    {number: batch[number] for number in chunk},
+                ): chunk
+                for chunk in (
+                    numbers[i : i + MAX_ADDRESSES_PER_REQUEST]
+                    for i in range(0, len(numbers), MAX_ADDRESSES_PER_REQUEST)
+                )
+            }
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            done, not_done = wait(futures, timeout=timeout)
+            for future, chunk in futures.items():
+                if future in not_done:
+                    logger.error("SMS to %s not sent before the deadline.", chunk)
+                    count_send_failure("DEADLINE_EXCEEDED", len(chunk))
+                    statuses = {}
+                else:
+                    try:
+                        statuses = future.result()
+                    except Exception as error:
+                        # e.g. a connection or read timeout, or a response
+                        # missing some of the numbers
+                        logger.exception("SMS to %s failed to send.", chunk)
+                        count_send_failure(type(error).__name__, len(chunk))
+                        statuses = {}
+                results.extend(
+                    (number, batch[number], statuses.get(number)) for number in chunk
+                )
+        return results
 
 
-### Pinpoint methods #####################################################
 def send_sms(phone_number: str, message: str) -> None:
     # send an SMS to the given number. See Pinpoint.py file for more details.
-    try:
-        response = pinpoint_client.send_messages(
-            ApplicationId=PINPOINT_APP_ID,
-            MessageRequest={
-                "Addresses": {phone_number: {"ChannelType": "SMS"}},
-                "MessageConfiguration": {
-                    "SMSMessage": {"Body": message, "MessageType": "TRANSACTIONAL"}
-                },
+    send_sms_messages({phone_number: message})
+
+
+def send_sms_to_all(phone_numbers: list, message: str) -> None:
+    # send the same SMS to every given number.
+    send_sms_messages({number: message for number in phone_numbers})
+
+
+def send_sms_messages(messages: dict) -> dict:
+    """
+    Send each number in the messages dict its own message body, batching up
+    to MAX_ADDRESSES_PER_REQUEST numbers into one Pinpoint request. Bodies
+    differing from the request's default are set per address with BodyOverride.
+    :return: dict of phone number to Pinpoint delivery status, None for numbers
+    whose request failed.
+    """
+    statuses = {}
+    numbers = list(messages)
+    for i in range(0, len(numbers), MAX_ADDRESSES_PER_REQUEST):
+        batch = numbers[i : i + MAX_ADDRESSES_PER_REQUEST]
+        default_body = messages[batch[0]]
+        addresses = {}
+        for number in batch:
+            addresses[number] = {"ChannelType": "SMS"}
+            if messages[number] != default_body:
+                addresses[number]["BodyOverride"] = messages[number]
+        try:
+            response = send_pinpoint_request(addresses, default_body)
+        except ClientError as e:
+            logger.error(e.response["Error"]["Message"])
+            count_send_failure(e.response["Error"]["Code"], len(batch))
+            statuses.update((number, None) for number in batch)
+            continue
+
+        results = response["MessageResponse"]["Result"]
+        for number in batch:
+            delivery_status = results[number]["DeliveryStatus"]
+            statuses[number] = delivery_status
+            if delivery_status == "SUCCESSFUL":
+                logger.debug(
+                    "Message %s sent to %s successfully.", messages[number], number
+                )
+            else:
+                logger.error(
+                    "Message to %s failed to send: %s", number, delivery_status
+                )
+                count_send_failure(delivery_status)
+    return statuses
+
+
+@timed("pinpoint.send_messages")
+def send_pinpoint_request(addresses: dict, default_body: str) -> dict:
+    # one Pinpoint SendMessages request, see send_sms_messages
+    return get_pinpoint_client().send_messages(
+        ApplicationId=config.pinpoint_app_id,
+        MessageRequest={
+            "Addresses": addresses,
+            "MessageConfiguration": {
+                "SMSMessage": {
+                    "Body": default_body,
+                    "MessageType": "TRANSACTIONAL",
+                }
             },
-        )
-    except ClientError as e:
-        logger.error(e.response["Error"]["Message"])
-    else:
-        delivery_status = response["MessageResponse"]["Result"][phone_number][
-            "DeliveryStatus"
-        ]
-        if delivery_status == "SUCCESSFUL":
-            logger.info(f"Message {message} sent to {phone_number} successfully.")
-        else:
-            logger.error(f"Message {message} failed to send to {phone_number}.")
+        },
+    )
 
 
 ### Lock methods #####################################################
@@ -245,17 +2600,17 @@ def ms_timestamp() -> int:
     Method that returns time since epoch in milliseconds. Allows for easy math
     determining passage of time at the millisecond level.
     """
-    utc_epoch_time = datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)
-    return int(utc_epoch_time.total_seconds() * 1000)
+    return int(time.time() * 1000)
 
 
 def get_lock_table(table_name: str):
     """
     Get the table used for acquiring and releasing named locks.
     This function assumes the existence of the table.
+    The table is created once per container and reused.
     """
     try:
-        table = boto3.resource("dynamodb").Table(table_name)
+        table = clients.get("lock_table:" + table_name, lambda: make_table(table_name))
     except ClientError as e:
         logger.exception("Could not get lock table.")
         raise
@@ -263,37 +2618,47 @@ def get_lock_table(table_name: str):
         return table
 
 
-def acquire_lock(lock_name: str, self_id: str) -> bool:
+@timed("lock.acquire")
+def acquire_lock(lock_name: str, self_id: str) -> int:
     """
     Acquire named lock from the lock table, identify self with id string.
 
     requesters are uniquely identified by a UUID given to each function invocation.
+
+    Locks are leases that expire LOCK_EXPIRATION_TIME_MS after acquisition
+    unless renewed. Every acquisition increments the lock's fencing token,
+    which is returned to the new holder (None if the lock was not acquired).
+    Game state writes carry the token, so a holder whose lease ran out
+    cannot overwrite anything written by the next holder.
     """
-    table = get_lock_table(LOCK_TABLE_NAME)
-    try:
-        # Conditional expression is used to ensure locks are acquired atomically.
-        table.put_item(
-            Item={
-                "lock_name": lock_name,
-                "holder": self_id,
-                "time_acquired": ms_timestamp(),  # number type
-            },
-            # requester only gets the lock if it does not exist (exists if held by another function)
-            # or if the lock has expired.
-            ConditionExpression=Attr("lock_name").not_exists()
-            | Attr("time_acquired").lt(ms_timestamp() - LOCK_EXPIRATION_TIME_MS),
-        )
-    except ClientError as error:
-        error_code = error.response["Error"]["Code"]
-        if error_code == "ConditionalCheckFailedException":
-            return False
-        else:
-            raise
-    else:
-        logger.info("Lock acquired %s", self_id)
-        return True
+    now = ms_timestamp()
+    fencing_token = get_game_state_store().acquire_lock(
+        lock_name, self_id, now, now + config.lock_expiration_time_ms
+    )
+    if fencing_token:
+        fencing_token = int(fencing_token)
+        logger.debug("Lock acquired %s with fencing token %d", self_id, fencing_token)
+    return fencing_token
+
+
+@timed("lock.renew")
+def renew_lock(lock_name: str, self_id: str, fencing_token: int) -> bool:
+    """
+    Extend the lease on a held lock by another LOCK_EXPIRATION_TIME_MS.
+    Fails if the lock has since been taken over by another holder.
+    """
+    renewed = get_game_state_store().renew_lock(
+        lock_name,
+        self_id,
+        fencing_token,
+        ms_timestamp() + config.lock_expiration_time_ms,
+    )
+    if renewed:
+        logger.debug("Lock renewed %s", self_id)
+    return renewed
 
 
+@timed("lock.release")
 def release_lock(lock_name: str, self_id: str) -> bool:
     """
     Release the named lock.
@@ -302,59 +2667,192 @@ def release_lock(lock_name: str, self_id: str) -> bool:
     uniquely differentiate holders. One cannot release a lock not held without
     guessing a UUID correctly.
     """
-    try:
-        table = get_lock_table(LOCK_TABLE_NAME)
-        table.delete_item(
-            Key={"lock_name": lock_name}, ConditionExpression=Attr("holder").eq(self_id)
-        )
-    except ClientError as error:
-        if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            return False
-        else:
-            raise
+    released = get_game_state_store().release_lock(lock_name, self_id)
+    if released:
+        logger.debug("Lock released %s", self_id)
     else:
-        logger.info("Lock released %s", self_id)
-        return True
+        count("LockReleaseFailures")
+    return released
+
+
+class LockHeartbeat:
+    """
+    Context manager that renews a held lock in a background thread, every
+    third of LOCK_EXPIRATION_TIME_MS, until the block exits. This lets the
+    lease stay short while still covering a slow critical section.
+    Does nothing unless LOCK_HEARTBEAT is enabled in setup.py.
+    """
+
+    def __init__(self, lock_name: str, self_id: str, fencing_token: int):
+        self.lock_name = lock_name
+        self.self_id = self_id
+        self.fencing_token = fencing_token
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if config.lock_heartbeat:
+            self._thread = threading.Thread(
+                target=in_current_context(self._renew), daemon=True
+            )
+            self._thread.start()
+        return self
 
-def retry_acquire_lock(lock_name: str, self_id: str):
+    def __exit__(self, *exc_info):
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+
+    def _renew(self):
+        interval_seconds = config.lock_expiration_time_ms / 3000
+        while not self._stopped.wait(interval_seconds):
+            if not renew_lock(self.lock_name, self.self_id, self.fencing_token):
+                # fenced writes will fail from now on, nothing more to do here
+                logger.error("Lost lock %s held by %s", self.lock_name, self.self_id)
+                return
+
+
+### Lock retry policies ############################################
+class RetryPolicy:
+    """
+    Decides how long to wait between attempts at acquiring a lock, and records
+    how many attempts were made and how long was spent waiting. The base class
+    retries immediately, the other policies below only override next_delay().
+
+    Policies are stateful, use a new one for every lock acquisition.
+    """
+
+    def __init__(
+        self,
+        base_delay_seconds: float = None,
+        max_delay_seconds: float = None,
+        max_wait_seconds: float = None,
+    ):
+        self.base_delay_seconds = (
+            config.initial_lock_wait_seconds
+            if base_delay_seconds is None
+            else base_delay_seconds
+        )
+        self.max_delay_seconds = (
+            config.max_lock_retry_delay_seconds
+            if max_delay_seconds is None
+            else max_delay_seconds
+        )
+        self.max_wait_seconds = (
+            config.max_lock_wait_seconds
+            if max_wait_seconds is None
+            else max_wait_seconds
+        )
+        self.attempts = 0
+        self.waited_seconds = 0.0
+
+    def next_delay(self) -> float:
+        return 0.0
+
+    def run(self, attempt):
+        """
+        Call attempt() until it returns a truthy value or the next wait would
+        exceed max_wait_seconds. Returns the last result of attempt().
+        """
+        start = time.time()
+        while True:
+            self.attempts += 1
+            result = attempt()
+            if result:
+                return result
+            delay = self.next_delay()
+            if time.time() - start + delay >= self.max_wait_seconds:
+                return result
+            if delay:
+                time.sleep(delay)
+                self.waited_seconds += delay
+
+
+class ExponentialBackoff(RetryPolicy):
+    # base * multiplier^n, capped at max_delay_seconds
+    def next_delay(self) -> float:
+        delay = self.base_delay_seconds * config.lock_retry_backoff_multiplier ** (
+            self.attempts - 1
+        )
+        return min(self.max_delay_seconds, delay)
+
+
+class FullJitterBackoff(ExponentialBackoff):
+    # uniformly random between zero and the capped exponential delay
+    def next_delay(self) -> float:
+        return random.uniform(0, super().next_delay())
+
+
+class DecorrelatedJitterBackoff(RetryPolicy):
+    # random between base and three times the previous delay, capped
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.previous_delay = self.base_delay_seconds
+
+    def next_delay(self) -> float:
+        delay = random.uniform(self.base_delay_seconds, self.previous_delay * 3)
+        self.previous_delay = min(self.max_delay_seconds, delay)
+        return self.previous_delay
+
+
+RETRY_POLICIES = {
+    "immediate": RetryPolicy,
+    "exponential": ExponentialBackoff,
+    "full_jitter": FullJitterBackoff,
+    "decorrelated_jitter": DecorrelatedJitterBackoff,
+}
+
+
+@timed("lock.wait")
+def retry_acquire_lock(lock_name: str, self_id: str, policy: RetryPolicy = None):
     """
     Retries acquire_lock until lock acquired or maximum desired time elapsed.
-    Sufficient for low wait times and low contention.
+    Waits between attempts are decided by the given retry policy, by default a
+    new instance of the LOCK_RETRY_POLICY configured in setup.py.
+    Returns the fencing token of the acquired lock, None if not acquired.
     """
-    lock_acquired = False
-    start = time.time()
-    while (time.time() - start < MAX_LOCK_WAIT_SECONDS) and not lock_acquired:
-        lock_acquired = acquire_lock(lock_name, self_id)
-        if not lock_acquired:
-            logger.info(f"Retrying acquire lock {self_id}")
-    return lock_acquired
+    if policy is None:
+        policy = RETRY_POLICIES[config.lock_retry_policy]()
+    start = time.perf_counter()
+    fencing_token = policy.run(lambda: acquire_lock(lock_name, self_id))
+    observe("LockAttempts", policy.attempts)
+    observe("LockWaitMs", round((time.perf_counter() - start) * 1000, 3))
+    if not fencing_token:
+        count("LockAcquireFailures")
+    logger.debug(
+        "Lock %s %s after %d attempts, waited %.3fs",
+        lock_name,
+        "acquired" if fencing_token else "not acquired",
+        policy.attempts,
+        policy.waited_seconds,
+    )
+    return fencing_token
+
 
 def exponential_retry_acquire_lock(lock_name: str, self_id: str):
     """
-    Retries acquire_lock using exponential backoff until lock acquired 
+    Retries acquire_lock using exponential backoff until lock acquired
     or maximum desired time elapsed. better to use if you expect long retry times.
     """
-    delay = INITIAL_LOCK_WAIT_SECONDS
-    lock_acquired = False
-    while delay < MAX_LOCK_WAIT_SECONDS and not lock_acquired:
-        lock_acquired = acquire_lock(lock_name, self_id)
-        if not lock_acquired:
-            logger.info(f"Waiting for {delay} to retry lock acquire.")
-            time.sleep(delay)
-            delay = delay * LOCK_RETRY_BACKOFF_MULTIPLIER
-    return lock_acquired
+    return retry_acquire_lock(lock_name, self_id, ExponentialBackoff())
+
 
 def random_retry_acquire_lock(lock_name: str, self_id: str):
     """
     Retries acquire_lock using random intervals for retry. Useful for high
-    lock contention. 
+    lock contention.
     """
-    # not implemented
-    pass
+    return retry_acquire_lock(lock_name, self_id, FullJitterBackoff())
+
+
+# everything above runs once per container, on cold start.
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+cold_start = True
+
 
 if __name__ == "__main__":
-    # this 'unit' test needs to be run after setup.py constructs the file,
-    # or you'd need to add some parameters in temporarily.
+    # settings come from the environment like on Lambda, set the variables
+    # setup.py gives the function to run this against the deployed tables
     from threading import Thread
 
     with open("test_events/lambda_test_event.json") as file:
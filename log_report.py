@@ -0,0 +1,139 @@
+#
+# Latency report from the lambda handler's per-invocation JSON log lines.
+#
+# Every invocation logs one line of metrics, a line per Pinpoint status that
+# texts failed with, and a line per timed DynamoDB, lock and Pinpoint
+# operation with the duration of each call (see InvocationLog in the lambda
+# handler). This aggregates
+# those lines, from log files or stdin, into latency histograms per operation
+# and metric totals. Other log lines are skipped, so raw CloudWatch exports
+# work as they are, e.g.:
+#     aws logs tail /aws/lambda/rps-lambda-function --since 1h > rps.log
+#     python log_report.py rps.log
+#
+import argparse
+import fileinput
+import json
+
+# upper bounds of the histogram buckets in ms, the last one catches the rest
+BUCKET_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+BAR_WIDTH = 40
+
+
+def metric_documents(lines) -> list:
+    """
+    Parse the handler's Embedded Metric Format documents out of any log
+    output. The JSON object starts at the first "{", after whatever prefix
+    the log format adds.
+    """
+    documents = []
+    for line in lines:
+        start = line.find("{")
+        if start < 0 or "_aws" not in line:
+            continue
+        try:
+            document = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(document, dict) and "_aws" in document:
+            documents.append(document)
+    return documents
+
+
+def samples_by_operation(documents: list) -> dict:
+    # operation -> every duration in ms, whole invocations as "invocation"
+    samples = {
+        "invocation": [d["duration_ms"] for d in documents if "duration_ms" in d]
+    }
+    for document in documents:
+        if "Operation" in document:
+            samples.setdefault(document["Operation"], []).extend(document["LatencyMs"])
+    return samples
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def histogram(samples: list) -> list:
+    # count of samples per bucket of BUCKET_BOUNDS_MS, plus one for the rest
+    counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+    for sample in samples:
+        for index, bound in enumerate(BUCKET_BOUNDS_MS):
+            if sample <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+
+def format_report(samples: dict) -> str:
+    lines = []
+    for operation in sorted(samples, key=lambda name: (name != "invocation", name)):
+        ordered = sorted(samples[operation])
+        if not ordered:
+            continue
+        lines.append(
+            f"{operation}: {len(ordered)} calls, p50 {percentile(ordered, 0.5):.1f}ms"
+            f" p90 {percentile(ordered, 0.9):.1f}ms p99 {percentile(ordered, 0.99):.1f}ms"
+            f" max {ordered[-1]:.1f}ms"
+        )
+        counts = histogram(ordered)
+        labels = [f"<= {bound}ms" for bound in BUCKET_BOUNDS_MS]
+        labels.append(f"> {BUCKET_BOUNDS_MS[-1]}ms")
+        # only the buckets between the fastest and slowest call are shown
+        used = [index for index, count in enumerate(counts) if count]
+        for index in range(used[0], used[-1] + 1):
+            bar = "#" * round(BAR_WIDTH * counts[index] / max(counts))
+            lines.append(f"  {labels[index]:>10} {counts[index]:>8} {bar}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def format_totals(documents: list) -> str:
+    # totals of the records and every metric over all invocations. Metrics
+    # with more than one value per invocation are summed, failed texts are
+    # totalled per delivery status. Latencies are in the report above.
+    invocations = [d for d in documents if "duration_ms" in d]
+    totals = {
+        "invocations": len(invocations),
+        "cold_starts": sum(1 for i in invocations if i.get("cold_start")),
+        "records": sum(i.get("records", 0) for i in invocations),
+        "failed_records": sum(i.get("failed_records", 0) for i in invocations),
+    }
+    for document in documents:
+        if "Operation" in document:
+            continue
+        for directive in document["_aws"]["CloudWatchMetrics"]:
+            for metric in directive["Metrics"]:
+                name = metric["Name"]
+                value = document[name]
+                if "DeliveryStatus" in document:
+                    name += " " + document["DeliveryStatus"]
+                if isinstance(value, list):
+                    value = sum(value)
+                totals[name] = totals.get(name, 0) + value
+    return "\n".join(f"{name:<36} {value:>12,.0f}" for name, value in totals.items())
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Lambda handler latency report")
+    parser.add_argument("files", nargs="*", help="log files, stdin if none")
+    parser.add_argument(
+        "--operation", action="append", help="only report these operations"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    with fileinput.input(arguments.files) as lines:
+        documents = metric_documents(lines)
+    if not any("duration_ms" in document for document in documents):
+        raise SystemExit("no invocation log lines found")
+    samples = samples_by_operation(documents)
+    if arguments.operation:
+        samples = {name: samples.get(name, []) for name in arguments.operation}
+    print(format_report(samples))
+    print(format_totals(documents))
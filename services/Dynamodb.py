@@ -105,6 +105,26 @@ def delete_table(table_name: str) -> dict:
             return response
 
 
+def enable_time_to_live(table_name: str, attribute_name: str) -> dict:
+    """
+    Have DynamoDB delete items of the table once the epoch time in seconds
+    held in their 'attribute_name' attribute has passed. Deletion happens
+    in the background, usually within a few days of expiry.
+    """
+    try:
+        response = dynamodb_client.update_time_to_live(
+            TableName=table_name,
+            TimeToLiveSpecification={"Enabled": True, "AttributeName": attribute_name},
+        )
+    except ClientError as error:
+        logging.error(error.response["Error"]["Message"])
+        logging.exception("Could not enable TTL on dynamodb table %s.", table_name)
+        raise
+    else:
+        logging.info("TTL on %s enabled for table %s.", attribute_name, table_name)
+        return response
+
+
 def table_exists(table_name: str) -> bool:
     """
     Check if a table exists by name.
@@ -11,6 +11,9 @@ logging.basicConfig(filename="rps.log", level=logging.INFO)
 iam_resource = boto3.resource("iam")
 sts_client = boto3.client("sts")
 
+# IAM keeps at most this many versions of a managed policy
+MAX_POLICY_VERSIONS = 5
+
 
 def create_role(
     iam_role_name: str, assume_role_policy_json: str, policy_arns: list
@@ -96,6 +99,65 @@ def get_policy_by_name(policy_name: str) -> iam_resource.Policy:
     return policy
 
 
+def get_policy(policy_arn: str) -> iam_resource.Policy:
+    """
+    Get an existing policy by arn.
+    :return: IAM Policy object
+    """
+    return iam_resource.Policy(policy_arn)
+
+
+def get_role(iam_role_name: str) -> iam_resource.Role:
+    """
+    Get an existing role by name.
+    :return: IAM role object
+    """
+    return iam_resource.Role(iam_role_name)
+
+
+def update_policy(iam_policy, policy_json: str) -> iam_resource.Policy:
+    """
+    Replace the permissions of a policy by making 'policy_json' its default
+    version. The oldest other version is deleted first if the policy already
+    has as many versions as IAM allows.
+    :param iam_policy: IAM policy object, such as returned by create_policy()
+    :return: IAM Policy object
+    """
+    try:
+        versions = list(iam_policy.versions.all())
+        if len(versions) >= MAX_POLICY_VERSIONS:
+            oldest = min(
+                (version for version in versions if not version.is_default_version),
+                key=lambda version: version.create_date,
+            )
+            oldest.delete()
+        iam_policy.create_version(PolicyDocument=policy_json, SetAsDefault=True)
+    except ClientError as error:
+        logging.error(error.response["Error"]["Message"])
+        logging.exception("Couldn't update policy %s", iam_policy.arn)
+        raise
+    else:
+        logging.info("Updated Policy '%s'", iam_policy.arn)
+        return iam_policy
+
+
+def update_assume_role_policy(iam_role, assume_role_policy_json: str):
+    """
+    Replace the policy defining what resources are allowed to assume a role.
+    :param iam_role: IAM role object, such as returned by create_role()
+    :return: IAM role object
+    """
+    try:
+        iam_role.AssumeRolePolicy().update(PolicyDocument=assume_role_policy_json)
+    except ClientError as error:
+        logging.error(error.response["Error"]["Message"])
+        logging.exception("Couldn't update assume role policy of %s", iam_role.name)
+        raise
+    else:
+        logging.info("Updated assume role policy of role '%s'", iam_role.name)
+        return iam_role
+
+
 def delete_role(iam_role) -> dict:
     """
     Delete a role.
@@ -122,6 +184,10 @@ def delete_policy(iam_policy) -> dict:
     by create_policy()
     """
     try:
+        # a policy can only be deleted once its other versions are
+        for version in iam_policy.versions.all():
+            if not version.is_default_version:
+                version.delete()
         response = iam_policy.delete()
     except ClientError as error:
         logging.error(error.response["Error"]["Message"])
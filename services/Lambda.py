@@ -6,7 +6,7 @@
 # https://docs.aws.amazon.com/code-samples/latest/catalog/python-lambda-boto_client_examples-lambda_basics.py.html
 
 import time
-from util import return_zipped_bytes
+from util import build_artifact, mapped_artifact
 from services import IAm
 import boto3
 from botocore.exceptions import ClientError
@@ -22,7 +22,12 @@ MAX_WAIT_SECONDS = 18
 
 
 def create_lambda_function(
-    function_name: str, description: str, handler_name: str, iam_role, code_bytes: bytes
+    function_name: str,
+    description: str,
+    handler_name: str,
+    iam_role,
+    code_bytes,
+    runtime: str = "python3.8",
 ) -> dict:
     """
     Create a lambda function and publish it.
@@ -31,7 +36,9 @@ def create_lambda_function(
     :param handler_name: name of the event handler in the lambda function code
     :param iam_role: IAM role object, lambda functions need to be associated to
     a role to define access permissions
-    :param code_bytes: bytes of the zipped function code to upload to Lambda
+    :param code_bytes: the zipped function code to upload to Lambda, bytes or
+    a file object such as the memory map of util.mapped_artifact
+    :param runtime: Lambda runtime identifier the function runs on
     """
     delay = INITIAL_WAIT_SECONDS
     # add in exponential backoff waiting for AWS services (iam_role) to deploy and connect
@@ -40,7 +47,7 @@ def create_lambda_function(
             response = lambda_client.create_function(
                 FunctionName=function_name,
                 Description=description,
-                Runtime="python3.8",
+                Runtime=runtime,
                 Role=iam_role.arn,
                 Handler=handler_name,
                 Code={"ZipFile": code_bytes},
@@ -88,20 +95,20 @@ def delete_lambda_function(function_name: str) -> dict:
 
 
 def update_lambda_code(
-    function_name: str, code_bytes: bytes, publish=True, dryrun=False
+    function_name: str, code_bytes, publish=True, dryrun=False
 ) -> dict:
     """
     Use this function to update an existing lambda's code.
     You can change the publish flag to false to prevent deploy.
     You can set the dryrun to True to inspect the response and confirm it would have worked.
-    :param code_bytes: bytes of zipped new code to publish.
+    :param code_bytes: zipped new code to publish, bytes or a file object.
     """
     delay = INITIAL_WAIT_SECONDS
     # add in exponential backoff waiting for AWS services (iam_role) to deploy and connect
     while delay < MAX_WAIT_SECONDS:
         try:
             response = lambda_client.update_function_code(
-                FunctionName="string",
+                FunctionName=function_name,
                 ZipFile=code_bytes,
                 Publish=publish,
                 DryRun=dryrun,
@@ -129,6 +136,41 @@ def update_lambda_code(
             return response
 
 
+def update_lambda_configuration(function_name: str, environment: dict) -> dict:
+    """
+    Replace the environment variables of an existing lambda.
+    Retried on an exponential backoff basis while another update of the
+    function, such as of its code, is still in progress.
+    :param environment: dict of variable name to string value
+    """
+    delay = INITIAL_WAIT_SECONDS
+    while delay < MAX_WAIT_SECONDS:
+        try:
+            response = lambda_client.update_function_configuration(
+                FunctionName=function_name,
+                Environment={"Variables": environment},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceConflictException":
+                logging.error(e.response["Error"]["Message"])
+                logging.error("Couldn't configure function %s.", function_name)
+                raise
+            print("Waiting for the function update to finish...")
+            time.sleep(delay)
+            # exponential backoff, increase retry time
+            delay = delay * RETRY_BACKOFF_MULTIPLIER
+            # check if this is the last retry
+            if delay >= MAX_WAIT_SECONDS:
+                logging.error(
+                    "Couldn't configure function %s, max retry time exceeded.",
+                    function_name,
+                )
+                raise
+        else:
+            logging.info("Configured function '%s'.", function_name)
+            return response
+
+
 def add_permission(
     action: str, function_name: str, principal: str, source_arn: str, statement_id: str
 ) -> dict:
@@ -202,22 +244,23 @@ if __name__ == "__main__":
 
     iam_policy = IAm.create_policy(lambda_policy_name, lambda_policy_json)
     iam_role = IAm.create_role(lambda_role_name, assume_role_json, [iam_policy.arn])
-    function_code = return_zipped_bytes(lambda_function_filename)
-
-    response = create_lambda_function(
-        lambda_function_name,
-        lamda_function_description,
-        lambda_handler_name,
-        iam_role,
-        function_code,
-    )
+    artifact = build_artifact([(lambda_function_filename, lambda_function_filename)])
 
-    response = create_lambda_function(
-        lambda_function_name,
-        lamda_function_description,
-        lambda_handler_name,
-        iam_role,
-        function_code,
-    )
+    with mapped_artifact(artifact) as function_code:
+        response = create_lambda_function(
+            lambda_function_name,
+            lamda_function_description,
+            lambda_handler_name,
+            iam_role,
+            function_code,
+        )
+
+        response = create_lambda_function(
+            lambda_function_name,
+            lamda_function_description,
+            lambda_handler_name,
+            iam_role,
+            function_code,
+        )
 
     delete_lambda_function(lambda_function_name)
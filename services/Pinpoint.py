@@ -59,6 +59,10 @@ def enable_pinpoint_SMS(applicationID: str) -> dict:
         return response
 
 
+# Pinpoint accepts at most this many addresses per send_messages request.
+MAX_ADDRESSES_PER_REQUEST = 100
+
+
 def send_SMS_message(phone_number: str, message: str, pinpoint_app_id: str) -> None:
     """
     Send an sms message to the given phone number using the given pinpoint app.
@@ -66,26 +70,58 @@ def send_SMS_message(phone_number: str, message: str, pinpoint_app_id: str) -> N
     :param message: message to send
     :param pinpoint_app_id: the id of the pinpoint app used to send the SMS
     """
-    try:
-        response = pinpoint_client.send_messages(
-            ApplicationId=pinpoint_app_id,
-            MessageRequest={
-                "Addresses": {phone_number: {"ChannelType": "SMS"}},
-                "MessageConfiguration": {
-                    "SMSMessage": {"Body": message, "MessageType": "TRANSACTIONAL"}
+    send_SMS_messages({phone_number: message}, pinpoint_app_id)
+
+
+def send_SMS_messages(messages: dict, pinpoint_app_id: str) -> dict:
+    """
+    Send sms messages to many phone numbers using the given pinpoint app, in as
+    few requests as possible. Each number can get its own message body.
+    :param messages: dict of destination phone number to message to send
+    :param pinpoint_app_id: the id of the pinpoint app used to send the SMS
+    :return: dict of phone number to delivery status, None if the request
+    for that number failed
+    """
+    statuses = {}
+    numbers = list(messages)
+    for i in range(0, len(numbers), MAX_ADDRESSES_PER_REQUEST):
+        batch = numbers[i : i + MAX_ADDRESSES_PER_REQUEST]
+        # the first body is the request default, other bodies override it
+        # per address
+        default_body = messages[batch[0]]
+        addresses = {}
+        for number in batch:
+            addresses[number] = {"ChannelType": "SMS"}
+            if messages[number] != default_body:
+                addresses[number]["BodyOverride"] = messages[number]
+        try:
+            response = pinpoint_client.send_messages(
+                ApplicationId=pinpoint_app_id,
+                MessageRequest={
+                    "Addresses": addresses,
+                    "MessageConfiguration": {
+                        "SMSMessage": {
+                            "Body": default_body,
+                            "MessageType": "TRANSACTIONAL",
+                        }
+                    },
                 },
-            },
-        )
-    except ClientError as e:
-        logging.error(e.response["Error"]["Message"])
-    else:
-        result = response["MessageResponse"]["Result"][phone_number]
-        if result["DeliveryStatus"] == "PERMANENT_FAILURE":
-            logging.error("Message not delivered: %s", result)
-        elif result["DeliveryStatus"] == "SUCCESSFUL":
-            logging.info("Message sent!")
-        else:
-            logging.warn("Unknown delivery status of SMS message")
+            )
+        except ClientError as e:
+            logging.error(e.response["Error"]["Message"])
+            statuses.update((number, None) for number in batch)
+            continue
+
+        for number in batch:
+            result = response["MessageResponse"]["Result"][number]
+            statuses[number] = result["DeliveryStatus"]
+            if result["DeliveryStatus"] == "PERMANENT_FAILURE":
+                logging.error("Message not delivered: %s", result)
+            elif result["DeliveryStatus"] == "SUCCESSFUL":
+                logging.info("Message sent!")
+            else:
+                logging.warn("Unknown delivery status of SMS message")
+    return statuses
 
 
 if __name__ == "__main__":
@@ -95,4 +131,8 @@ if __name__ == "__main__":
     pinpoint_app_id = response["ApplicationResponse"]["Id"]
     enable_pinpoint_SMS(pinpoint_app_id)
     send_SMS_message("+18001234567", "initial message", pinpoint_app_id)
+    send_SMS_messages(
+        {"+18001234567": "first message", "+18007654321": "second message"},
+        pinpoint_app_id,
+    )
     delete_pinpoint_app(pinpoint_app_id)
@@ -30,6 +30,14 @@ def create_topic(topic_name: str) -> sns_resource.Topic:
         return topic
 
 
+def get_topic(topic_arn: str) -> sns_resource.Topic:
+    """
+    Get an existing topic by arn.
+    :return: sns Topic object
+    """
+    return sns_resource.Topic(topic_arn)
+
+
 def delete_topic(topic: sns_resource.Topic) -> dict:
     """
     Delete a given sns topic.
@@ -9,8 +9,12 @@
 
 from services import IAm, Lambda, Pinpoint, SNS, Dynamodb
 from util import *
+import argparse
+import json
 import os
 import logging
+import sys
+import time
 
 logging.basicConfig(filename="rps.log", level=logging.INFO)
 
@@ -22,11 +26,38 @@ TEARDOWN = True
 # set LOCKING to false if you wish to dismiss the use of locks to provide mutual
 # exclusion to the game state.
 LOCKING = True
+# set LOCK_FREE to true to provide mutual exclusion with atomic conditional
+# writes on the game state table instead of a lock table. Takes precedence over
+# LOCKING, and no lock table is created.
+LOCK_FREE = False
+# number of independent matchmaking queues. Each shard has its own opponent slot
+# and lock, so this many games can be resolved concurrently. Throws are sent to
+# a shard by "random" choice or by "hash" of the player's phone number.
+MATCHMAKING_SHARDS = 1
+MATCHMAKING_SHARD_STRATEGY = "random"
+# set MATCHMAKING_QUEUE to true to keep waiting throws in a queue per shard
+# instead of a single opponent slot. A player can then have several throws
+# waiting, each matched with the oldest throw of another player. Matching is
+# atomic, so neither a lock nor the lock table is needed, and looks at no more
+# than MATCHMAKING_QUEUE_SCAN_LIMIT waiting throws. Takes precedence over
+# LOCK_FREE and LOCKING.
+MATCHMAKING_QUEUE = False
+MATCHMAKING_QUEUE_SCAN_LIMIT = 10
+
+# game variant: "classic" rock paper scissors or "lizard_spock", which adds
+# the lizard and spock throws.
+GAME_RULES = "classic"
 
 # service names and parameters
 SNS_INCOMING_SMS_TOPIC_NAME = "rps_incoming_sms"
-# Lambda filenames and parameters
-LAMBDA_FUNCTION_FILE_NAME = "lambda_function_handler.py"
+# Lambda modules and parameters
+# modules and packages zipped into the lambda function, looked up in the
+# directories of LAMBDA_MODULE_PATH in order. To ship dependencies, install
+# them into a directory with `pip install --target`, add it to the path and
+# their top-level packages here.
+LAMBDA_MODULES = ["lambda_function_handler"]
+LAMBDA_MODULE_PATH = ["."]
+LAMBDA_RUNTIME = "python3.8"
 LAMBDA_HANDLER_NAME = "lambda_function_handler.lambda_handler"
 LAMBDA_FUNCTION_NAME = "rps-lambda-function"
 LAMBDA_FUNCTION_DESCRIPTION = "Rock Paper Scissors lambda function"
@@ -41,6 +72,57 @@ PINPOINT_APP_NAME = "rock_paper_scissors"
 GAME_STATE_TABLE_NAME = "game_state"
 GAME_STATE_TABLE_SCHEMA = [{"AttributeName": "state", "KeyType": "HASH"}]
 GAME_STATE_TABLE_ATTR_DEFINITIONS = [{"AttributeName": "state", "AttributeType": "S"}]
+# how the lambda talks to DynamoDB: "client" uses the low-level client with
+# precomputed keys, "resource" uses the boto3 resource Table layer.
+DYNAMODB_LAYER = "client"
+# where game state and locks are stored: "dynamodb" (the tables above),
+# "redis" for a Redis-protocol store such as ElastiCache at REDIS_URL (the
+# lambda must be able to reach it and the redis package must be deployed
+# with it), or "memory", which only lives as long as one container and is
+# meant for local runs. DynamoDB tables are only created for "dynamodb".
+GAME_STATE_STORE = "dynamodb"
+# with locking, warm lambda containers keep the game state they last read or
+# wrote for up to GAME_STATE_CACHE_TTL_SECONDS (0 to turn off) and skip reading
+# it again. Writes check the item's version, so a stale entry is never trusted.
+GAME_STATE_CACHE_TTL_SECONDS = 60
+GAME_STATE_CACHE_MAX_ENTRIES = 128
+REDIS_URL = "redis://localhost:6379/0"
+# SNS delivers texts at least once. With IDEMPOTENCY on, every text is claimed
+# by its id with a conditional write to the game state store before it is
+# processed, and a redelivery is acknowledged without being processed again.
+# Claims expire after IDEMPOTENCY_TTL_SECONDS (DynamoDB TTL on "expires"),
+# at least Lambda's six hour maximum event age. Warm containers also remember
+# up to IDEMPOTENCY_CACHE_MAX_ENTRIES ids, to skip the write for repeats.
+IDEMPOTENCY = True
+IDEMPOTENCY_TTL_SECONDS = 6 * 60 * 60
+IDEMPOTENCY_CACHE_MAX_ENTRIES = 1024
+# Pending throws table parameters, one partition per matchmaking queue holding
+# its waiting throws in order of arrival
+PENDING_THROWS_TABLE_NAME = "pending_throws"
+PENDING_THROWS_TABLE_SCHEMA = [
+    {"AttributeName": "queue", "KeyType": "HASH"},
+    {"AttributeName": "arrival", "KeyType": "RANGE"},
+]
+PENDING_THROWS_TABLE_ATTR_DEFINITIONS = [
+    {"AttributeName": "queue", "AttributeType": "S"},
+    {"AttributeName": "arrival", "AttributeType": "S"},
+]
+# Game history table parameters
+# set GAME_HISTORY to true to record every finished game and keep per player
+# counters of games, wins, losses and ties. Players can then text "stats",
+# "history" and "top".
+GAME_HISTORY = True
+GAME_HISTORY_TABLE_NAME = "game_history"
+# one partition per player, holding a "GAME#<time>#<id>" item per game and a
+# "STATS" item of counters, see record_game in the lambda handler.
+GAME_HISTORY_TABLE_SCHEMA = [
+    {"AttributeName": "phone_number", "KeyType": "HASH"},
+    {"AttributeName": "record", "KeyType": "RANGE"},
+]
+GAME_HISTORY_TABLE_ATTR_DEFINITIONS = [
+    {"AttributeName": "phone_number", "AttributeType": "S"},
+    {"AttributeName": "record", "AttributeType": "S"},
+]
 # Lock Table parameters
 LOCK_TABLE_NAME = "lock_table"
 LOCK_TABLE_SCHEMA = [{"AttributeName": "lock_name", "KeyType": "HASH"}]
@@ -49,15 +131,128 @@ LOCK_TABLE_ATTR_DEFINITIONS = [{"AttributeName": "lock_name", "AttributeType": "
 LOCK_RETRY_BACKOFF_MULTIPLIER = 2
 INITIAL_LOCK_WAIT_SECONDS = 0.05
 MAX_LOCK_WAIT_SECONDS = 6
-LOCK_EXPIRATION_TIME_MS = 5000
+# longest single wait between two attempts at acquiring the lock
+MAX_LOCK_RETRY_DELAY_SECONDS = 0.5
+# how to wait between attempts at acquiring the lock, one of "immediate",
+# "exponential", "full_jitter" or "decorrelated_jitter".
+LOCK_RETRY_POLICY = "full_jitter"
+# locks are leases, a holder that crashes blocks others for at most this long.
+LOCK_EXPIRATION_TIME_MS = 2000
+# set LOCK_HEARTBEAT to true to renew the lease while the lock is held, so
+# slow critical sections are covered even with a short expiration time.
+LOCK_HEARTBEAT = True
+# Logging
+# every invocation logs one JSON line of counters and call timings, see
+# log_report.py. Per-call DEBUG detail is only logged for this fraction of them.
+LOG_DEBUG_SAMPLE_RATE = 0.01
+# that line is also a CloudWatch Embedded Metric Format document, reporting lock
+# attempts, wait and hold times, games and failed texts under this namespace.
+METRICS_NAMESPACE = "RockPaperScissors"
+# Deployment
+# resources that do not depend on each other are created (and torn down) on
+# this many threads at once.
+DEPLOY_MAX_WORKERS = 8
+# what was deployed, with content hashes of the lambda code and the policies.
+# Running setup.py again only creates or updates what changed since.
+DEPLOY_STATE_FILE_NAME = ".deploy_state.json"
+# the lambda function zip is built the same byte for byte from the same
+# modules, and reused from this directory until one of them changes.
+ARTIFACT_CACHE_DIR = ".build_cache"
+ARTIFACT_COMPRESSION_LEVEL = 9
+# set to true to ship the modules compiled, so a cold start does not compile
+# them. Only done when this script runs on the Python version of
+# LAMBDA_RUNTIME, the runtime ignores modules compiled by any other.
+ARTIFACT_COMPILE_PYC = True
 
 
-def deploy():
+def function_environment(pinpoint_app_id: str) -> dict:
     """
-    Deploys all of the services!
+    The parameters of the lambda function, as the environment variables it
+    reads its config from (see Config in the lambda handler).
     """
-    #######################################################################
-    # Create Sns topic
+    environment = {
+        "PINPOINT_APP_ID": pinpoint_app_id,
+        "GAME_STATE_TABLE_NAME": GAME_STATE_TABLE_NAME,
+        "DYNAMODB_LAYER": DYNAMODB_LAYER,
+        "GAME_STATE_STORE": GAME_STATE_STORE,
+        "REDIS_URL": REDIS_URL,
+        "IDEMPOTENCY": IDEMPOTENCY,
+        "IDEMPOTENCY_TTL_SECONDS": IDEMPOTENCY_TTL_SECONDS,
+        "IDEMPOTENCY_CACHE_MAX_ENTRIES": IDEMPOTENCY_CACHE_MAX_ENTRIES,
+        "GAME_STATE_CACHE_TTL_SECONDS": GAME_STATE_CACHE_TTL_SECONDS,
+        "GAME_STATE_CACHE_MAX_ENTRIES": GAME_STATE_CACHE_MAX_ENTRIES,
+        "GAME_HISTORY": GAME_HISTORY,
+        "GAME_HISTORY_TABLE_NAME": GAME_HISTORY_TABLE_NAME,
+        "GAME_RULES": GAME_RULES,
+        "LOCKING": LOCKING,
+        "LOCK_FREE": LOCK_FREE,
+        "MATCHMAKING_SHARDS": MATCHMAKING_SHARDS,
+        "MATCHMAKING_SHARD_STRATEGY": MATCHMAKING_SHARD_STRATEGY,
+        "MATCHMAKING_QUEUE": MATCHMAKING_QUEUE,
+        "MATCHMAKING_QUEUE_SCAN_LIMIT": MATCHMAKING_QUEUE_SCAN_LIMIT,
+        "PENDING_THROWS_TABLE_NAME": PENDING_THROWS_TABLE_NAME,
+        "LOCK_TABLE_NAME": LOCK_TABLE_NAME,
+        "LOCK_EXPIRATION_TIME_MS": LOCK_EXPIRATION_TIME_MS,
+        "LOCK_HEARTBEAT": LOCK_HEARTBEAT,
+        "LOCK_RETRY_BACKOFF_MULTIPLIER": LOCK_RETRY_BACKOFF_MULTIPLIER,
+        "INITIAL_LOCK_WAIT_SECONDS": INITIAL_LOCK_WAIT_SECONDS,
+        "MAX_LOCK_WAIT_SECONDS": MAX_LOCK_WAIT_SECONDS,
+        "MAX_LOCK_RETRY_DELAY_SECONDS": MAX_LOCK_RETRY_DELAY_SECONDS,
+        "LOCK_RETRY_POLICY": LOCK_RETRY_POLICY,
+        "LOG_DEBUG_SAMPLE_RATE": LOG_DEBUG_SAMPLE_RATE,
+        "METRICS_NAMESPACE": METRICS_NAMESPACE,
+    }
+    return {name: str(value) for name, value in environment.items()}
+
+
+def file_hash(*file_names) -> str:
+    # content hash of the given files
+    contents = []
+    for file_name in file_names:
+        with open(file_name, "rb") as file:
+            contents.append(file.read())
+    return content_hash(*contents)
+
+
+def compile_pyc() -> bool:
+    # compiled modules only load on the Python version they were compiled by
+    if not ARTIFACT_COMPILE_PYC:
+        return False
+    if LAMBDA_RUNTIME == "python%d.%d" % sys.version_info[:2]:
+        return True
+    logging.warning(
+        "Not compiling modules for %s on Python %d.%d",
+        LAMBDA_RUNTIME,
+        *sys.version_info[:2],
+    )
+    return False
+
+
+def lambda_artifact_digest() -> str:
+    # changes whenever the zip of the lambda function would
+    files = module_files(LAMBDA_MODULES, LAMBDA_MODULE_PATH)
+    return artifact_digest(files, ARTIFACT_COMPRESSION_LEVEL, compile_pyc())
+
+
+def build_lambda_artifact() -> Artifact:
+    # the zip of the lambda function, from the cache if it was built before
+    artifact = build_artifact(
+        module_files(LAMBDA_MODULES, LAMBDA_MODULE_PATH),
+        ARTIFACT_CACHE_DIR,
+        ARTIFACT_COMPRESSION_LEVEL,
+        compile_pyc(),
+    )
+    logging.info(
+        "Lambda artifact %s: %d bytes, %s in %.3fs",
+        artifact.digest[:12],
+        artifact.size,
+        "cached" if artifact.cached else "built",
+        artifact.build_seconds,
+    )
+    return artifact
+
+
+def create_sns_topic():
     # SMS topic acts as intermediary SMS queue and trigger to the lambda function
     sns_in_topic = SNS.create_topic(SNS_INCOMING_SMS_TOPIC_NAME)
     # add a policy to allow Pinpoint to publish to this SNS topic
@@ -69,57 +264,70 @@ def deploy():
         "Resource": sns_in_topic.arn,
     }
     SNS.add_policy_statement(sns_in_topic, pinpoint_policy_statement)
+    return sns_in_topic
+
 
-    #######################################################################
-    # Create Pinpoint app
+def create_pinpoint_app() -> str:
     # The Pinpoint app will handle all SMS traffic
     response = Pinpoint.create_pinpoint_app(PINPOINT_APP_NAME)
     pinpoint_app_id = response["ApplicationResponse"]["Id"]
     Pinpoint.enable_pinpoint_SMS(pinpoint_app_id)
+    return pinpoint_app_id
 
-    #######################################################################
-    # Update Lambda Code
-    # NOTE: The following code writes these parameters into the lambda handler file.
-    # This tightly couples the files and makes it so the handler cannot run on its own.
-    # this is a little hacky, feel free to improve upon it.
-    lines_to_inject = [
-        f'PINPOINT_APP_ID = "{pinpoint_app_id}"\n',
-        f'GAME_STATE_TABLE_NAME = "{GAME_STATE_TABLE_NAME}"\n',
-        f"LOCKING = {LOCKING}\n",
-        f'LOCK_TABLE_NAME = "{LOCK_TABLE_NAME}"\n',
-        f"LOCK_EXPIRATION_TIME_MS = {LOCK_EXPIRATION_TIME_MS}\n",
-        f"LOCK_RETRY_BACKOFF_MULTIPLIER = {LOCK_RETRY_BACKOFF_MULTIPLIER}\n",
-        f"INITIAL_LOCK_WAIT_SECONDS = {INITIAL_LOCK_WAIT_SECONDS}\n",
-        f"MAX_LOCK_WAIT_SECONDS = {MAX_LOCK_WAIT_SECONDS}\n",
-    ]
-    # update the lambda file code with new parameters before deploying
-    insert_lines_at_keyword(
-        os.path.abspath(LAMBDA_FUNCTION_FILE_NAME),
-        lines_to_inject,
-        "insert new parameters after this line:",
-    )
 
-    #######################################################################
-    # Create Lambda function
-    # This function will handle Rock Paper Scissors logic when SMS are received
+def create_iam_policy():
     with open(LAMBDA_POLICY_FILE_NAME) as file:
         lambda_policy_json = file.read()
+    return IAm.create_policy(LAMBDA_POLICY_NAME, lambda_policy_json)
+
+
+def create_iam_role(iam_policy):
     with open(LAMBDA_ASSUME_ROLE_POLICY_FILE_NAME) as file:
         assume_role_json = file.read()
+    return IAm.create_role(LAMBDA_ROLE_NAME, assume_role_json, [iam_policy.arn])
 
-    iam_policy = IAm.create_policy(LAMBDA_POLICY_NAME, lambda_policy_json)
-    iam_role = IAm.create_role(LAMBDA_ROLE_NAME, assume_role_json, [iam_policy.arn])
-    function_code = return_zipped_bytes(LAMBDA_FUNCTION_FILE_NAME)
 
-    response = Lambda.create_lambda_function(
-        LAMBDA_FUNCTION_NAME,
-        LAMBDA_FUNCTION_DESCRIPTION,
-        LAMBDA_HANDLER_NAME,
-        iam_role,
-        function_code,
-    )
-    function_arn = response["FunctionArn"]
+def update_iam_policy(iam_policy):
+    with open(LAMBDA_POLICY_FILE_NAME) as file:
+        lambda_policy_json = file.read()
+    return IAm.update_policy(iam_policy, lambda_policy_json)
+
+
+def update_iam_role(iam_role, iam_policy):
+    with open(LAMBDA_ASSUME_ROLE_POLICY_FILE_NAME) as file:
+        assume_role_json = file.read()
+    return IAm.update_assume_role_policy(iam_role, assume_role_json)
+
 
+def create_lambda_function(iam_role) -> str:
+    # This function will handle Rock Paper Scissors logic when SMS are received
+    # the zip is uploaded from its memory-mapped file, not read into memory
+    with mapped_artifact(build_lambda_artifact()) as function_code:
+        response = Lambda.create_lambda_function(
+            LAMBDA_FUNCTION_NAME,
+            LAMBDA_FUNCTION_DESCRIPTION,
+            LAMBDA_HANDLER_NAME,
+            iam_role,
+            function_code,
+            LAMBDA_RUNTIME,
+        )
+    return response["FunctionArn"]
+
+
+def update_lambda_function(function_arn: str, iam_role) -> str:
+    with mapped_artifact(build_lambda_artifact()) as function_code:
+        response = Lambda.update_lambda_code(LAMBDA_FUNCTION_NAME, function_code)
+    return response["FunctionArn"]
+
+
+def configure_lambda_function(function_arn: str, pinpoint_app_id: str) -> dict:
+    # the parameters are read once per container, new containers use these
+    environment = function_environment(pinpoint_app_id)
+    Lambda.update_lambda_configuration(LAMBDA_FUNCTION_NAME, environment)
+    return environment
+
+
+def subscribe_lambda(function_arn: str, environment: dict, sns_in_topic, *tables):
     # Add lambda permission to allow sns topic to invoke the Lambda function
     Lambda.add_permission(
         action="lambda:InvokeFunction",
@@ -128,32 +336,171 @@ def deploy():
         source_arn=sns_in_topic.arn,
         statement_id="sns",
     )
-
-    #######################################################################
-    # add a lambda as a subscriber to the topic
-    response = SNS.add_subscription(
+    # add the lambda as a subscriber to the topic. Texts only reach it once
+    # it is configured and the tables it uses exist.
+    SNS.add_subscription(
         topic_arn=sns_in_topic.arn,
         protocol="lambda",
         endpoint=function_arn,
     )
 
-    #######################################################################
-    # Create the DynamoDB tables
-    # Used for game state and locks
-    game_table = Dynamodb.create_table(
-        table_name=GAME_STATE_TABLE_NAME,
-        key_schema=GAME_STATE_TABLE_SCHEMA,
-        attribute_definitions=GAME_STATE_TABLE_ATTR_DEFINITIONS,
-    )
 
-    if LOCKING:
-        lock_table = Dynamodb.create_table(
+def create_game_table(**table):
+    game_table = Dynamodb.create_table(**table)
+    if IDEMPOTENCY:
+        # message claims are deleted by DynamoDB once they expire
+        Dynamodb.enable_time_to_live(table["table_name"], "expires")
+    return game_table
+
+
+def table_step(name: str, create, **table) -> DeployStep:
+    # a DynamoDB table created with the 'table' arguments of
+    # Dynamodb.create_table, the step's result is its name
+    def create_table():
+        create(**table)
+        return table["table_name"]
+
+    return DeployStep(name, create_table, Dynamodb.delete_table)
+
+
+def table_steps() -> dict:
+    """
+    A DeployStep for every table the app can use, by step name, whatever the
+    settings. A table an earlier deploy created and the settings no longer
+    use is deleted from this.
+    """
+    steps = [
+        table_step(
+            "game_table",
+            create_game_table,
+            table_name=GAME_STATE_TABLE_NAME,
+            key_schema=GAME_STATE_TABLE_SCHEMA,
+            attribute_definitions=GAME_STATE_TABLE_ATTR_DEFINITIONS,
+        ),
+        table_step(
+            "lock_table",
+            Dynamodb.create_table,
             table_name=LOCK_TABLE_NAME,
-            key_schema=[{"AttributeName": "lock_name", "KeyType": "HASH"}],
-            attribute_definitions=[
-                {"AttributeName": "lock_name", "AttributeType": "S"}
-            ],
-        )
+            key_schema=LOCK_TABLE_SCHEMA,
+            attribute_definitions=LOCK_TABLE_ATTR_DEFINITIONS,
+        ),
+        table_step(
+            "pending_throws_table",
+            Dynamodb.create_table,
+            table_name=PENDING_THROWS_TABLE_NAME,
+            key_schema=PENDING_THROWS_TABLE_SCHEMA,
+            attribute_definitions=PENDING_THROWS_TABLE_ATTR_DEFINITIONS,
+        ),
+        table_step(
+            "history_table",
+            Dynamodb.create_table,
+            table_name=GAME_HISTORY_TABLE_NAME,
+            key_schema=GAME_HISTORY_TABLE_SCHEMA,
+            attribute_definitions=GAME_HISTORY_TABLE_ATTR_DEFINITIONS,
+        ),
+    ]
+    return {step.name: step for step in steps}
+
+
+def deployment_steps() -> list:
+    """
+    The resources of the app as DeploySteps, each depending on the ones it
+    needs to exist first. The tables, the Pinpoint app, the SNS topic and the
+    IAM policy and role are independent of each other; only the Lambda
+    function needs the role, its configuration the Pinpoint app id, and
+    subscribing it to the topic needs everything else.
+    """
+    use_dynamodb = GAME_STATE_STORE == "dynamodb"
+    used = {
+        "game_table": use_dynamodb,
+        "lock_table": use_dynamodb and LOCKING and not (LOCK_FREE or MATCHMAKING_QUEUE),
+        "pending_throws_table": use_dynamodb and MATCHMAKING_QUEUE,
+        "history_table": GAME_HISTORY,
+    }
+    tables = [step for name, step in table_steps().items() if used[name]]
+
+    return tables + [
+        DeployStep(
+            "sns_topic",
+            create_sns_topic,
+            SNS.delete_topic,
+            save=lambda topic: topic.arn,
+            load=SNS.get_topic,
+        ),
+        DeployStep("pinpoint_app", create_pinpoint_app, Pinpoint.delete_pinpoint_app),
+        DeployStep(
+            "iam_policy",
+            create_iam_policy,
+            IAm.delete_policy,
+            fingerprint=lambda: file_hash(LAMBDA_POLICY_FILE_NAME),
+            update=update_iam_policy,
+            save=lambda policy: policy.arn,
+            load=IAm.get_policy,
+        ),
+        DeployStep(
+            "iam_role",
+            create_iam_role,
+            IAm.delete_role,
+            depends_on=["iam_policy"],
+            fingerprint=lambda policy: file_hash(LAMBDA_ASSUME_ROLE_POLICY_FILE_NAME),
+            update=update_iam_role,
+            save=lambda role: role.name,
+            load=IAm.get_role,
+        ),
+        DeployStep(
+            "lambda_function",
+            create_lambda_function,
+            lambda function_arn: Lambda.delete_lambda_function(LAMBDA_FUNCTION_NAME),
+            depends_on=["iam_role"],
+            fingerprint=lambda role: lambda_artifact_digest(),
+            update=update_lambda_function,
+        ),
+        # deleted with the function
+        DeployStep(
+            "lambda_configuration",
+            configure_lambda_function,
+            depends_on=["lambda_function", "pinpoint_app"],
+            fingerprint=lambda function_arn, pinpoint_app_id: content_hash(
+                json.dumps(function_environment(pinpoint_app_id), sort_keys=True)
+            ),
+            update=lambda environment, *args: configure_lambda_function(*args),
+        ),
+        DeployStep(
+            "sns_subscription",
+            subscribe_lambda,
+            depends_on=["lambda_function", "lambda_configuration", "sns_topic"]
+            + [table.name for table in tables],
+        ),
+    ]
+
+
+def deploy(max_workers: int = DEPLOY_MAX_WORKERS):
+    """
+    Deploys all of the services!
+    Independent resources are created concurrently, see deployment_steps().
+    What was deployed is recorded in DEPLOY_STATE_FILE_NAME, and a resource
+    that is already deployed is only updated if what it is made of changed.
+    """
+    steps = deployment_steps()
+    state = load_deploy_state(DEPLOY_STATE_FILE_NAME)
+    timings = {}
+    start = time.perf_counter()
+    results, actions = apply_steps(
+        steps,
+        state,
+        max_workers,
+        timings,
+        on_change=lambda state: save_deploy_state(DEPLOY_STATE_FILE_NAME, state),
+        known=list(table_steps().values()),
+    )
+    elapsed = time.perf_counter() - start
+    seconds, path = critical_path(steps, timings)
+    logging.info(
+        "Deployed in %.1fs, critical path %.1fs: %s", elapsed, seconds, " > ".join(path)
+    )
+    for name, action in actions.items():
+        if action != "keep":
+            print(f"{action}d {name}")
 
     print(
         "\nServices are deployed. \nYou can now text your pinpoint number 'test' to confirm.\n"
@@ -165,18 +512,68 @@ def deploy():
 
     if TEARDOWN:
         input("Press enter to begin service teardown.")
-        SNS.delete_topic(sns_in_topic)
-        IAm.delete_role(iam_role)
-        IAm.delete_policy(iam_policy)
-        Lambda.delete_lambda_function(LAMBDA_FUNCTION_NAME)
-        delete_lines(os.path.abspath(LAMBDA_FUNCTION_FILE_NAME), lines_to_inject)
-        Pinpoint.delete_pinpoint_app(pinpoint_app_id)
-        Dynamodb.delete_table(game_table.table_name)
-        if LOCKING:
-            Dynamodb.delete_table(lock_table.table_name)
+        teardown(max_workers)
+
 
-        print("Service teardown complete.")
+def plan():
+    """
+    Print what deploy() would create, update or keep, without changing anything.
+    """
+    state = load_deploy_state(DEPLOY_STATE_FILE_NAME)
+    known = list(table_steps().values())
+    for name, action in plan_steps(deployment_steps(), state, known).items():
+        print(f"{action:<9} {name}")
+
+
+def build():
+    """
+    Build the zip of the lambda function and print its digest, size and how
+    long it took, without deploying it.
+    """
+    artifact = build_lambda_artifact()
+    artifact.file.close()
+    print(
+        f"{artifact.digest[:12]}  {artifact.size:,} bytes  "
+        f"{'cached' if artifact.cached else 'built'} in "
+        f"{artifact.build_seconds * 1000:.1f}ms"
+    )
+
+
+def teardown(max_workers: int = DEPLOY_MAX_WORKERS):
+    """
+    Delete every resource recorded in the deploy state file, including the
+    tables that are no longer deployed. The file is kept if any cannot be.
+    """
+    state = load_deploy_state(DEPLOY_STATE_FILE_NAME)
+    steps = deployment_steps()
+    steps += orphaned_steps(steps, state, list(table_steps().values()))
+    results = {
+        step.name: step.load(state[step.name]["id"])
+        for step in steps
+        if step.name in state
+    }
+    teardown_steps(steps, results, max_workers)
+    if os.path.exists(DEPLOY_STATE_FILE_NAME):
+        os.remove(DEPLOY_STATE_FILE_NAME)
+    print("Service teardown complete.")
 
 
 if __name__ == "__main__":
-    deploy()
+    parser = argparse.ArgumentParser(description="Deploy rock paper scissors")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["deploy", "plan", "build", "teardown"],
+        default="deploy",
+        help="deploy what changed (the default), show what would change, "
+        "build the lambda function zip, or delete what was deployed",
+    )
+    command = parser.parse_args().command
+    if command == "plan":
+        plan()
+    elif command == "build":
+        build()
+    elif command == "teardown":
+        teardown()
+    else:
+        deploy()
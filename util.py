@@ -2,47 +2,521 @@
 # Created on Thu Apr 22 2021
 # Matteo Bjornsson
 #
-import io
-from zipfile import ZipFile
-
-
-def return_zipped_bytes(file_name: str) -> bytes:
-    """
-    TODO: write function description
-    """
-    # buffer the zip file contents as a BytesIO object
-    bytes_buffer = io.BytesIO()
-    with ZipFile(bytes_buffer, "w") as zip:
-        # write the file to the buffer
-        zip.write(file_name)
-    # return the file position to the start (otherwise 'read()' returns nothing)
-    bytes_buffer.seek(0)
-    return bytes_buffer.read()
-
-
-def insert_lines_at_keyword(file_path: str, lines: list, keyword: str) -> None:
-    with open(file_path, "r+") as filehandler:
-        file_lines = filehandler.readlines()
-        index = get_keyword_index(file_lines, keyword)
-        for line in lines:
-            file_lines.insert(index + 1, line)
-        filehandler.seek(0)
-        filehandler.writelines(file_lines)
-        filehandler.truncate()
-
-
-def get_keyword_index(string_list: list, keyword: str) -> int:
-    for i, s in enumerate(string_list):
-        if keyword in s:
-            return i
-    return -1
-
-
-def delete_lines(file_path: str, line_list: list) -> None:
-    with open(file_path, "r+") as filehandler:
-        file_lines = filehandler.readlines()
-        filehandler.seek(0)
-        for line in file_lines:
-            if line not in line_list:
-                filehandler.write(line)
-        filehandler.truncate()
+import contextlib
+import hashlib
+import importlib.util
+import json
+import logging
+import marshal
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import BinaryIO, NamedTuple
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+# timestamp of every zip entry, the earliest a zip can store, so the same
+# files zip to the same bytes whatever their modification times
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+# part of every artifact digest, change it when zip_files zips differently
+ARTIFACT_FORMAT = 1
+
+
+class Artifact(NamedTuple):
+    # content hash of what the zip is built from, see artifact_digest
+    digest: str
+    # the zip, an open file positioned at its start, see mapped_artifact
+    file: BinaryIO
+    size: int
+    build_seconds: float
+    # reused from the cache rather than zipped
+    cached: bool
+
+
+def module_files(modules: list, search_path: list = (".",)) -> list:
+    """
+    The files of top-level modules and packages, as (archive name, file path)
+    pairs sorted by archive name. Like an import, each module is looked up as
+    name.py or a name/ directory in the directories of search_path in order,
+    and it is archived relative to the directory it was found in. Compiled
+    files and __pycache__ directories are left out.
+    """
+    files = {}
+    for module in modules:
+        for directory in search_path:
+            path = os.path.join(directory, module)
+            if os.path.isfile(path + ".py"):
+                files[module + ".py"] = path + ".py"
+                break
+            if os.path.isdir(path):
+                for root, directories, names in os.walk(path):
+                    directories[:] = [d for d in directories if d != "__pycache__"]
+                    for name in names:
+                        if name.endswith((".pyc", ".pyo")):
+                            continue
+                        file_path = os.path.join(root, name)
+                        archive_name = os.path.relpath(file_path, directory)
+                        files[archive_name.replace(os.sep, "/")] = file_path
+                break
+        else:
+            raise FileNotFoundError(f"module {module} not found in {search_path}")
+    return sorted(files.items())
+
+
+def compiled_name(archive_name: str) -> str:
+    # where the import system looks for the compiled module of a .py file
+    return importlib.util.cache_from_source(archive_name).replace(os.sep, "/")
+
+
+def compiled_module(source: bytes, archive_name: str) -> bytes:
+    """
+    Compile a module for this Python version, returns the contents of its
+    .pyc file. The .pyc is an unchecked hash-based one (PEP 552), without the
+    mtime of the source, so the same source compiles to the same bytes and is
+    loaded without reading the source first.
+    """
+    code = compile(source, archive_name, "exec", dont_inherit=True)
+    # flags: hash-based, source not checked
+    header = importlib.util.MAGIC_NUMBER + (1).to_bytes(4, "little")
+    header += importlib.util.source_hash(source)
+    return header + marshal.dumps(code)
+
+
+def zip_files(
+    files: list, output: BinaryIO, compression_level: int = 9, compile_pyc: bool = False
+) -> None:
+    """
+    Zip files into output, the same bytes every time they have the same
+    contents.
+    :param files: (archive name, file path) pairs
+    :param output: binary file to write the zip to, seekable
+    :param compression_level: deflate level from 0 (none) to 9 (smallest)
+    :param compile_pyc: also archive the compiled module of every .py file,
+    see compiled_module
+    Entries are sorted by archive name and have ZIP_TIMESTAMP and the same
+    permissions, whatever the files and umask they were built from. They are
+    read and written one at a time, so only one file is in memory at once.
+    """
+    # archive name, file path, archive name of the source if it is compiled
+    entries = []
+    for archive_name, file_path in files:
+        entries.append((archive_name, file_path, None))
+        if compile_pyc and archive_name.endswith(".py"):
+            entries.append((compiled_name(archive_name), file_path, archive_name))
+    with ZipFile(output, "w", ZIP_DEFLATED, compresslevel=compression_level) as zip:
+        for archive_name, file_path, source_name in sorted(entries):
+            with open(file_path, "rb") as file:
+                contents = file.read()
+            if source_name:
+                contents = compiled_module(contents, source_name)
+            info = ZipInfo(archive_name, ZIP_TIMESTAMP)
+            info.compress_type = ZIP_DEFLATED
+            # a unix rw-r--r-- file, wherever it was zipped
+            info.create_system = 3
+            info.external_attr = 0o100644 << 16
+            zip.writestr(info, contents, compresslevel=compression_level)
+            # freed before the next file is read
+            del contents
+
+
+def file_digest(file_path: str) -> str:
+    # sha256 of a file, read a chunk at a time
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifact_digest(files: list, compression_level: int, compile_pyc: bool) -> str:
+    # content hash of the names and contents of the files and how they are
+    # zipped, including the Python version modules are compiled for
+    parts = [ARTIFACT_FORMAT, compression_level]
+    parts.append(sys.implementation.cache_tag if compile_pyc else "")
+    for archive_name, file_path in files:
+        parts += [archive_name, file_digest(file_path)]
+    return content_hash(*parts)
+
+
+def build_artifact(
+    files: list,
+    cache_dir: str = None,
+    compression_level: int = 9,
+    compile_pyc: bool = False,
+    max_cached: int = 10,
+) -> Artifact:
+    """
+    Zip files with zip_files, or open the zip of an earlier build of the same
+    files with the same options from cache_dir instead. Zips are written
+    straight to the cache under their artifact_digest, and only the
+    max_cached most recently used are kept. Without a cache_dir the zip is
+    written to a temporary file. The zip is never read into memory, see
+    mapped_artifact.
+    """
+    start = time.perf_counter()
+    digest = artifact_digest(files, compression_level, compile_pyc)
+    cache_path = cache_dir and os.path.join(cache_dir, digest + ".zip")
+    cached = bool(cache_path) and os.path.exists(cache_path)
+    if cached:
+        # marks it as recently used
+        os.utime(cache_path)
+    elif cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file first, so a crash never leaves half a zip
+        with open(cache_path + ".tmp", "wb") as file:
+            zip_files(files, file, compression_level, compile_pyc)
+        os.replace(cache_path + ".tmp", cache_path)
+        prune_artifact_cache(cache_dir, max_cached)
+    if cache_path:
+        file = open(cache_path, "rb")
+    else:
+        file = tempfile.TemporaryFile()
+        zip_files(files, file, compression_level, compile_pyc)
+        file.seek(0)
+    size = os.fstat(file.fileno()).st_size
+    return Artifact(digest, file, size, time.perf_counter() - start, cached)
+
+
+@contextlib.contextmanager
+def mapped_artifact(artifact: Artifact):
+    """
+    The zip of an artifact as a read-only memory map, which can be passed as
+    the code to upload without copying the zip into memory first: it is a
+    file object, and its pages are read from the file as they are used. The
+    artifact's file is closed afterwards.
+    """
+    with artifact.file, mmap.mmap(
+        artifact.file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped:
+        yield mapped
+
+
+def prune_artifact_cache(cache_dir: str, max_cached: int) -> None:
+    # delete all but the most recently used zips
+    paths = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if name.endswith(".zip")
+    ]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[max_cached:]:
+        os.remove(path)
+
+
+class DeployStep:
+    """
+    One resource of a deployment.
+    :param name: unique name of the step, which other steps depend on it by
+    :param create: creates the resource, called with what the create functions
+    of the steps in depends_on returned, in that order. Its own return value is
+    the step's result.
+    :param delete: optional, deletes the resource, called with the step's result
+    :param depends_on: names of the steps that must be created before this one
+    and deleted after it
+    :param fingerprint: optional, called like create, returns a content_hash of
+    what the resource is made from. A step without one is never changed once
+    created.
+    :param update: optional, called with the step's current result followed by
+    the arguments of create when the fingerprint changed, returns the new
+    result. Without it the step is created again.
+    :param save: turns the result into JSON for the deploy state file
+    :param load: turns what save returned back into the result
+    """
+
+    def __init__(
+        self,
+        name: str,
+        create,
+        delete=None,
+        depends_on: list = (),
+        fingerprint=None,
+        update=None,
+        save=None,
+        load=None,
+    ):
+        self.name = name
+        self.create = create
+        self.delete = delete
+        self.depends_on = list(depends_on)
+        self.fingerprint = fingerprint
+        self.update = update
+        self.save = save or (lambda result: result)
+        self.load = load or (lambda saved: saved)
+
+
+def content_hash(*parts) -> str:
+    # sha256 over the parts, each bytes or converted to a string
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_deploy_state(file_path: str) -> dict:
+    """
+    Read the deploy state file: step name to {"id": what the step's save
+    returned, "hash": its fingerprint}. Empty if there is no file yet.
+    """
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as file:
+        return json.load(file)["steps"]
+
+
+def save_deploy_state(file_path: str, state: dict) -> None:
+    # written to a temporary file first, so a crash never leaves half a file
+    temporary_path = file_path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump({"steps": state}, file, indent=2, sort_keys=True)
+    os.replace(temporary_path, file_path)
+
+
+def topological_order(dependencies: dict) -> list:
+    """
+    Order the names of a dependency graph so that every name comes after the
+    names it depends on.
+    :param dependencies: dict of name to the list of names it depends on
+    Raises ValueError if a dependency is unknown or the graph has a cycle.
+    """
+    order, visiting, visited = [], set(), set()
+
+    def visit(name, path):
+        if name not in dependencies:
+            raise ValueError(f"Unknown deploy step {name} required by {path}")
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Deploy steps depend on each other: {path + [name]}")
+        visiting.add(name)
+        for dependency in dependencies[name]:
+            visit(dependency, path + [name])
+        visiting.remove(name)
+        visited.add(name)
+        order.append(name)
+
+    for name in dependencies:
+        visit(name, [])
+    return order
+
+
+def run_graph(dependencies: dict, run, max_workers: int) -> dict:
+    """
+    Call run(name) for every name of a dependency graph on a thread pool, each
+    as soon as every name it depends on has finished, so independent names
+    run concurrently and the whole takes as long as the slowest chain.
+    :param dependencies: dict of name to the list of names it depends on
+    :param run: called with a name, returns its result
+    :return: dict of name to result, in the order they finished
+    If a call raises, no more are started and the exception is raised once the
+    running ones have finished.
+    """
+    topological_order(dependencies)
+    results = {}
+    waiting = dict(dependencies)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while waiting or running:
+            ready = [
+                name
+                for name, needs in waiting.items()
+                if all(need in results for need in needs)
+            ]
+            for name in ready:
+                del waiting[name]
+                running[pool.submit(run, name)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            failures = []
+            for future in done:
+                name = running.pop(future)
+                if future.exception():
+                    failures.append(future.exception())
+                else:
+                    results[name] = future.result()
+            if failures:
+                wait(running)
+                raise failures[0]
+    return results
+
+
+def timed_step(function, name: str, timings: dict):
+    # wraps a step function to record how long it took in timings[name]
+    def run(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            timings[name] = time.perf_counter() - start
+            logging.info("Deploy step %s took %.2fs.", name, timings[name])
+
+    return run
+
+
+def orphaned_steps(steps: list, state: dict, known: list) -> list:
+    """
+    The steps recorded in the state that are not among steps, which an earlier
+    deploy created and are no longer deployed.
+    :param known: every DeployStep an earlier deploy may have recorded,
+    whatever it was deployed with, looked up by name
+    :return: list of the known DeploySteps
+    Raises ValueError naming the recorded steps that are not known, since
+    there is no way to delete them, before anything is changed.
+    """
+    by_name = {step.name: step for step in known}
+    deployed = {step.name for step in steps}
+    orphaned = [name for name in state if name not in deployed]
+    unknown = [name for name in orphaned if name not in by_name]
+    if unknown:
+        raise ValueError(
+            f"Cannot delete {', '.join(unknown)} recorded in the deploy state, "
+            "delete them and their entries by hand"
+        )
+    return [by_name[name] for name in orphaned]
+
+
+def apply_steps(
+    steps: list,
+    state: dict,
+    max_workers: int,
+    timings: dict = None,
+    on_change=None,
+    known: list = (),
+) -> tuple:
+    """
+    Bring the resources of the given DeploySteps in line with the steps, each
+    once the steps it depends on are done, concurrently where they are
+    independent. A step missing from the state is created. A step whose
+    fingerprint differs from the one in the state is updated, and any other
+    is kept as it is without calling AWS, its result loaded from the state.
+    :param state: deploy state as returned by load_deploy_state, changed in
+    place to record what was created or updated
+    :param timings: optional dict, filled with the seconds each step took
+    :param on_change: optional, called with the state after every change, to
+    save progress
+    :param known: every DeployStep an earlier deploy may have recorded. Steps
+    in the state that are no longer deployed are deleted with these once the
+    others are applied, see orphaned_steps.
+    :return: (dict of step name to result, dict of step name to "create",
+    "update", "keep" or "delete")
+    """
+    by_name = {step.name: step for step in steps}
+    orphaned = {step.name: step for step in orphaned_steps(steps, state, known)}
+    results, actions = {}, {}
+    timings = {} if timings is None else timings
+    mutex = threading.Lock()
+
+    def apply(name):
+        step = by_name[name]
+        args = [results[need] for need in step.depends_on]
+        recorded = state.get(name)
+        if recorded is None:
+            action, run = "create", step.create
+        elif step.fingerprint is None or step.fingerprint(*args) == recorded["hash"]:
+            action, run = "keep", lambda *args: step.load(recorded["id"])
+        elif step.update:
+            action = "update"
+            run = lambda *args: step.update(step.load(recorded["id"]), *args)
+        else:
+            action, run = "create", step.create
+        results[name] = timed_step(run, name, timings)(*args)
+        with mutex:
+            actions[name] = action
+            if action != "keep":
+                # hashed after the change, which may be to what it hashes
+                state[name] = {
+                    "id": step.save(results[name]),
+                    "hash": step.fingerprint(*args) if step.fingerprint else None,
+                }
+                if on_change:
+                    on_change(state)
+        return results[name]
+
+    def delete(name):
+        orphaned[name].delete(orphaned[name].load(state[name]["id"]))
+        with mutex:
+            actions[name] = "delete"
+            del state[name]
+            if on_change:
+                on_change(state)
+
+    run_graph({s.name: s.depends_on for s in steps}, apply, max_workers)
+    # nothing deployed needs them any more, and they need nothing deployed
+    run_graph({name: [] for name in orphaned}, delete, max_workers)
+    return results, actions
+
+
+def plan_steps(steps: list, state: dict, known: list = ()) -> dict:
+    """
+    What apply_steps would do to each step, without changing anything:
+    "create", "update", "keep", or "check" for a step whose fingerprint can
+    only be known once a dependency has been created or updated. Steps in the
+    state that are no longer deployed are to "delete" if they are known, and
+    "orphaned" if not, which apply_steps refuses.
+    :return: dict of step name to action, in dependency order
+    """
+    by_name = {step.name: step for step in steps}
+    actions = {}
+    for name in topological_order({s.name: s.depends_on for s in steps}):
+        step = by_name[name]
+        recorded = state.get(name)
+        if recorded is None:
+            actions[name] = "create"
+        elif step.fingerprint is None:
+            actions[name] = "keep"
+        elif any(need not in state for need in step.depends_on):
+            actions[name] = "check"
+        else:
+            args = [by_name[need].load(state[need]["id"]) for need in step.depends_on]
+            if step.fingerprint(*args) != recorded["hash"]:
+                actions[name] = "update" if step.update else "create"
+            elif any(actions[need] != "keep" for need in step.depends_on):
+                actions[name] = "check"
+            else:
+                actions[name] = "keep"
+    known = {step.name for step in known}
+    for name in state:
+        if name not in by_name:
+            actions[name] = "delete" if name in known else "orphaned"
+    return actions
+
+
+def teardown_steps(steps: list, results: dict, max_workers: int) -> None:
+    """
+    Delete the resources created by deploy_steps in reverse dependency order:
+    a resource is deleted once every resource depending on it is, concurrently
+    where they are independent. Steps without a result or delete function are
+    skipped.
+    """
+    by_name = {step.name: step for step in steps}
+    dependents = {step.name: [] for step in steps}
+    for step in steps:
+        for need in step.depends_on:
+            dependents[need].append(step.name)
+
+    def delete(name):
+        step = by_name[name]
+        if step.delete and name in results:
+            step.delete(results[name])
+
+    run_graph(dependents, delete, max_workers)
+
+
+def critical_path(steps: list, timings: dict) -> tuple:
+    """
+    The chain of dependent steps that took longest, which bounds how fast the
+    steps can be deployed however many run at a time.
+    :return: (total seconds, list of step names from first to last)
+    """
+    by_name = {step.name: step for step in steps}
+    longest = {}
+    for name in topological_order({s.name: s.depends_on for s in steps}):
+        before = max(
+            (longest[need] for need in by_name[name].depends_on),
+            default=(0.0, []),
+            key=lambda path: path[0],
+        )
+        longest[name] = (before[0] + timings.get(name, 0.0), before[1] + [name])
+    return max(longest.values(), default=(0.0, []), key=lambda path: path[0])